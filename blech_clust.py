@@ -3,7 +3,6 @@ import os
 import tables
 import sys
 import numpy as np
-import multiprocessing
 import json
 import glob
 import pandas as pd
@@ -12,8 +11,11 @@ import pylab as plt
 
 # Necessary blech_clust modules
 from utils import read_file
+from utils import raw_data_backend
+from utils import ingest_manifest
+from utils import session_join
 from utils.qa_utils import channel_corr
-from utils.blech_utils import entry_checker, imp_metadata
+from utils.blech_utils import entry_checker, imp_metadata, get_param_group
 from utils.blech_process_utils import path_handler
 
 # Get blech_clust path
@@ -36,12 +38,17 @@ print(f'Processing : {dir_name}')
 os.chdir(dir_name)
 
 info_dict = metadata_handler.info_dict
-file_list = metadata_handler.file_list
+# Includes the .dat files of joined sessions, see blech_dat_file_join.py
+file_list = session_join.list_session_files(dir_name)
 
 
 # Get the type of data files (.rhd or .dat)
+rhd_file_list = read_file.get_rhd_file_list(file_list)
 if 'auxiliary.dat' in file_list:
     file_type = ['one file per signal type']
+elif len(rhd_file_list) > 0 and \
+        not any([x.startswith('amp-') for x in file_list]):
+    file_type = ['traditional intan']
 else:
     file_type = ['one file per channel']
 
@@ -60,13 +67,14 @@ else:
     print(f'No HDF5 found...Creating file {hdf5_name}')
     hf5 = tables.open_file(hdf5_name, 'w', title=hdf5_name[-1])
 
-group_list = ['raw', 'raw_emg', 'digital_in', 'digital_out']
-for this_group in group_list:
-    if '/'+this_group in hf5:
-        hf5.remove_node('/', this_group, recursive=True)
-    hf5.create_group('/', this_group)
+# Raw data groups are only emptied of channels that need to be
+# imported again, see utils/ingest_manifest.py
+# Remove nodes describing raw data from a previous ingest
+for this_node in ['raw_dat_map', 'car_reference', 'session_segments',
+                  'filtered']:
+    if '/'+this_node in hf5:
+        hf5.remove_node('/', this_node, recursive=True)
 hf5.close()
-print('Created nodes in HF5')
 
 # Create directories to store waveforms, spike times, clustering results, and plots
 # And a directory for dumping files talking about memory usage in blech_process.py
@@ -76,7 +84,8 @@ dir_list = ['spike_waveforms',
             'spike_times',
             'clustering_results',
             'Plots',
-            'memory_monitor_clustering']
+            'memory_monitor_clustering',
+            'cutoff_stats']
 dir_exists = [x for x in dir_list if os.path.exists(x)]
 recreate_msg = f'Following dirs are present :' + '\n' + f'{dir_exists}' + \
     '\n' + 'Overwrite dirs? (yes/y/n/no) ::: '
@@ -99,6 +108,10 @@ if continue_bool:
             if os.path.exists(x):
                 shutil.rmtree(x)
             os.makedirs(x)
+        # Results of utils/process_scheduler.py, which are for the
+        # electrodes (and outputs) just removed
+        if os.path.exists('process_results.log'):
+            os.remove('process_results.log')
 else:
     quit()
 
@@ -111,18 +124,26 @@ if file_type == ['one file per signal type']:
 elif file_type == ['one file per channel']:
     electrodes_list = [name for name in file_list if name.startswith('amp-')]
     dig_in_file_list = [name for name in file_list if name.startswith('board-DI')]
+elif file_type == ['traditional intan']:
+    electrodes_list = rhd_file_list
+    dig_in_file_list = rhd_file_list
 
 electrodes_list = sorted(electrodes_list)
 dig_in_file_list = sorted(dig_in_file_list)
 
-# Use info file for port list calculation
-info_file = np.fromfile(dir_name + '/info.rhd', dtype=np.dtype('float32'))
-sampling_rate = int(info_file[2])
+if file_type == ['traditional intan']:
+    # .rhd files carry their own headers
+    sampling_rate = int(
+        read_file.read_rhd_header(rhd_file_list[0])['sample_rate'])
+    num_recorded_samples = read_file.count_rhd_samples(rhd_file_list)
+else:
+    # Use info file for port list calculation
+    info_file = np.fromfile(dir_name + '/info.rhd', dtype=np.dtype('float32'))
+    sampling_rate = int(info_file[2])
 
-# Read the time.dat file for use in separating out 
-# the one file per signal type data
-num_recorded_samples = len(np.fromfile(
-    dir_name + '/' + 'time.dat', dtype=np.dtype('float32')))
+    # Use the size of time.dat for use in separating out 
+    # the one file per signal type data
+    num_recorded_samples = session_join.count_recorded_samples(dir_name)
 total_recording_time = num_recorded_samples/sampling_rate  # In seconds
 
 check_str = f'Amplifier files: {electrodes_list} \nSampling rate: {sampling_rate} Hz'\
@@ -145,6 +166,11 @@ elif file_type == ['one file per signal type']:
     print("\tOne file per SIGNAL Detected")
     dig_in_int = np.arange(info_dict['dig_ins']['count'])
 
+elif file_type == ['traditional intan']:
+
+    print("\tTraditional Intan .rhd files Detected")
+    dig_in_int = np.arange(info_dict['dig_ins']['count'])
+
 check_str = f'ports used: {ports} \n sampling rate: {sampling_rate} Hz'\
             f'\n digital inputs on intan board: {dig_in_int}'
 
@@ -167,25 +193,89 @@ emg_channels = sorted(emg_info['electrodes'])
 layout_path = glob.glob(os.path.join(dir_name, "*layout.csv"))[0]
 electrode_layout_frame = pd.read_csv(layout_path)
 
+# Load params template now as ingest settings are needed to read the data
+params_template = json.load(open(params_template_path, 'r'))
+# Info on taste digins and laser should be in exp_info file
+all_params_dict = params_template.copy()
+all_params_dict['sampling_rate'] = sampling_rate
+# Ingest settings are taken from the session's params file if it has
+# one (e.g. when ingest is run again), so the user's settings are used.
+# Keys missing from both (e.g. an older copy of the template) use defaults
+ingest_params = get_param_group(
+    all_params_dict, 'ingest_params', read_file.ingest_defaults)
+session_params = getattr(metadata_handler, 'params_dict', None)
+if session_params is not None:
+    ingest_params = get_param_group(
+        session_params, 'ingest_params', ingest_params)
 
 # Read data files, and append to electrode arrays
+# With the dat backend, amplifier data is left in the .dat files
+# and only the location of every channel is recorded
+copy_raw_data = ingest_params['raw_data_backend'] == 'hdf5'
+if file_type == ['traditional intan'] and not copy_raw_data:
+    print('.rhd files can not be used in place, copying to HDF5')
+    copy_raw_data = True
+# .rhd files are decoded in a single pass over all channels,
+# so there is nothing to gain from importing only some of them
+resume_ingest = ingest_params['resume_ingest'] and \
+    file_type != ['traditional intan']
+
+# Only channels whose source file or layout entry changed since
+# the last ingest are read again
+manifest = ingest_manifest.build_manifest(
+    electrode_layout_frame if copy_raw_data else None,
+    dig_in_int, dig_in_file_list, file_type, ingest_params)
+with tables.open_file(hdf5_name, 'r+') as hf5:
+    import_nodes = ingest_manifest.prepare_ingest(
+        hf5, manifest, resume = resume_ingest)
+print('Created nodes in HF5')
+import_frame = ingest_manifest.filter_layout(
+    electrode_layout_frame, import_nodes)
+import_dig_ins = any([x.startswith('/digital_in/') for x in import_nodes])
+import_raw = copy_raw_data and len(import_frame) > 0
+
 if file_type == ['one file per channel']:
-    read_file.read_digins(hdf5_name, dig_in_int, dig_in_file_list)
-    read_file.read_electrode_channels(hdf5_name, electrode_layout_frame)
-    if len(emg_channels) > 0:
-        read_file.read_emg_channels(hdf5_name, electrode_layout_frame)
+    if import_dig_ins:
+        read_file.read_digins(hdf5_name, dig_in_int, dig_in_file_list)
+    if import_raw:
+        read_file.read_electrode_channels(
+            hdf5_name, import_frame,
+            n_workers = ingest_params['n_workers'],
+            storage_params = ingest_params)
+        if len(emg_channels) > 0:
+            read_file.read_emg_channels(
+                hdf5_name, import_frame,
+                n_workers = ingest_params['n_workers'],
+                storage_params = ingest_params)
 elif file_type == ['one file per signal type']:
-    read_file.read_digins_single_file(hdf5_name, dig_in_int, dig_in_file_list)
-    # This next line takes care of both electrodes and emgs
-    read_file.read_electrode_emg_channels_single_file(
-        hdf5_name, electrode_layout_frame, electrodes_list, num_recorded_samples, emg_channels)
+    if import_dig_ins:
+        read_file.read_digins_single_file(
+            hdf5_name, dig_in_int, dig_in_file_list,
+            block_samples = ingest_params['block_samples'])
+    if import_raw:
+        # This next line takes care of both electrodes and emgs
+        read_file.read_electrode_emg_channels_single_file(
+            hdf5_name, import_frame, electrodes_list, num_recorded_samples, emg_channels,
+            block_samples = ingest_params['block_samples'],
+            storage_params = ingest_params)
+elif file_type == ['traditional intan']:
+    read_file.read_rhd_files(
+        hdf5_name, rhd_file_list, import_frame,
+        dig_in_int if import_dig_ins else [],
+        storage_params = ingest_params)
+# Everything in the manifest is now in the HDF5 file
+with tables.open_file(hdf5_name, 'r+') as hf5:
+    ingest_manifest.write_manifest(hf5, manifest)
+    # Keep track of where each session starts in a joined recording
+    if session_join.is_joined(dir_name):
+        session_join.write_segment_table(hf5, dir_name)
+if not copy_raw_data:
+    print('Using raw .dat files in place, not copying to HDF5')
+    with tables.open_file(hdf5_name, 'r+') as hf5:
+        raw_data_backend.write_dat_map(
+            hf5, electrode_layout_frame, file_type, num_recorded_samples)
 
 # Write out template params file to directory if not present
-params_template = json.load(open(params_template_path, 'r'))
-# Info on taste digins and laser should be in exp_info file
-all_params_dict = params_template.copy()
-all_params_dict['sampling_rate'] = sampling_rate
-
 params_out_path = hdf5_name.split('.')[0] + '.params'
 if not os.path.exists(params_out_path):
     print('No params file found...Creating new params file')
@@ -220,13 +310,23 @@ channel_corr.gen_corr_output(corr_mat,
 # Also output a plot with digin and laser info
 
 # Get digin and laser info
-with tables.open_file(hdf5_name, 'r+') as hf5:
-    dig_in_array = np.stack([x[:] for x in hf5.root.digital_in])
-# Downsample to 10 seconds
-dig_in_array = dig_in_array[:, :(dig_in_array.shape[1]//sampling_rate)*sampling_rate]
-dig_in_array = np.reshape(dig_in_array, (len(dig_in_array), -1, sampling_rate)).sum(axis=2)
-dig_in_markers = np.where(dig_in_array > 0)
-del dig_in_array
+# Use the pulse table written at ingest rather than reloading the dig-ins
+with tables.open_file(hdf5_name, 'r') as hf5:
+    dig_in_names = [x._v_name for x in hf5.list_nodes('/digital_in')]
+    dig_in_events = read_file.read_dig_in_events(hf5)
+# Mark every second (within complete seconds) in which each dig-in was high
+num_recorded_secs = num_recorded_samples // sampling_rate
+marker_rows = []
+marker_secs = []
+for row_ind, this_name in enumerate(dig_in_names):
+    this_events = dig_in_events.loc[dig_in_events.dig_in_name == this_name]
+    this_secs = [np.arange(onset//sampling_rate, (offset-1)//sampling_rate + 1)
+                 for onset, offset in zip(this_events.onset, this_events.offset)]
+    this_secs = np.unique(np.concatenate([[]] + this_secs)).astype(int)
+    this_secs = this_secs[this_secs < num_recorded_secs]
+    marker_rows.append(np.repeat(row_ind, len(this_secs)))
+    marker_secs.append(this_secs)
+dig_in_markers = (np.concatenate(marker_rows), np.concatenate(marker_secs))
 
 # Check if laser is present
 laser_dig_in = info_dict['laser_params']['dig_in']
@@ -257,49 +357,8 @@ plt.close()
 
 ##############################
 
-# Write single runner file to data directory
-script_save_path = os.path.join(dir_name, 'temp')
-if not os.path.exists(script_save_path):
-    os.mkdir(script_save_path)
-
-with open(os.path.join(script_save_path, 'blech_process_single.sh'), 'w') as f:
-    f.write('#!/bin/bash \n')
-    f.write(f'BLECH_DIR={blech_clust_dir} \n')
-    f.write(f'DATA_DIR={dir_name} \n')
-    f.write('ELECTRODE_NUM=$1 \n')
-    f.write('python $BLECH_DIR/blech_process.py $DATA_DIR $ELECTRODE_NUM \n')
-    f.write('python $BLECH_DIR/utils/cluster_stability.py $DATA_DIR $ELECTRODE_NUM \n')
-
-# Dump shell file(s) for running GNU parallel job on the user's 
-# blech_clust folder on the desktop
-# First get number of CPUs - parallel be asked to run num_cpu-1 threads in parallel
-num_cpu = multiprocessing.cpu_count()
-
-electrode_bool = electrode_layout_frame.loc[
-    electrode_layout_frame.electrode_ind.isin(all_electrodes)]
-not_none_bool = electrode_bool.loc[~electrode_bool.CAR_group.isin(
-    ["none", "None", 'na'])]
-not_emg_bool = not_none_bool.loc[
-    ~not_none_bool.CAR_group.str.contains('emg')
-]
-bash_electrode_list = not_emg_bool.electrode_ind.values
-job_count = np.min(
-        (
-            len(bash_electrode_list), 
-            int(num_cpu-2), 
-            all_params_dict["max_parallel_cpu"]
-            )
-        )
-f = open(os.path.join(script_save_path, 'blech_process_parallel.sh'), 'w')
-f.write('#!/bin/bash \n')
-f.write(f'DIR={dir_name} \n')
-print(f"parallel -k -j {job_count} --noswap --load 100% --progress " +
-      "--memfree 4G --ungroup --retry-failed " +
-      f"--joblog $DIR/results.log " +
-      "bash $DIR/temp/blech_process_single.sh " +\
-      f"::: {' '.join([str(x) for x in bash_electrode_list])}",
-      file=f)
-f.close()
+# Electrodes are run through blech_process.py by
+# utils/process_scheduler.py (see blech_run_process.sh)
 
 print('blech_clust.py complete \n')
 print('*** Please check params file to make sure all is good ***\n')
@@ -8,10 +8,23 @@ import numpy as np
 import os
 import easygui
 import sys
+import multiprocessing
 from tqdm import tqdm
 import glob
 import json
-from utils.blech_utils import imp_metadata
+from utils.blech_utils import imp_metadata, get_param_group
+from utils.raw_data_backend import (
+    list_raw_channels,
+    is_dat_backend,
+    create_car_reference,
+)
+from utils.car_utils import (
+    reference_group,
+    reference_groups_parallel,
+    reference_filter_group,
+    car_defaults,
+)
+from utils.filter_utils import get_filter_settings, create_filtered_array
 
 
 def get_electrode_by_name(raw_electrodes, name):
@@ -63,42 +76,111 @@ for region, vals in zip(all_car_group_names, all_car_group_vals):
     print(f" {region} :: {vals}")
 
 # Pull out the raw electrode nodes of the HDF5 file
-raw_electrodes = hf5.list_nodes('/raw')
+# (or views of the raw .dat files if those are used in place)
+raw_electrodes = list_raw_channels(hf5, 'raw')
+dat_backend = is_dat_backend(hf5)
+params_dict = metadata_handler.params_dict
+car_params = get_param_group(params_dict, 'car_params', car_defaults)
 
-# First get the common average references by averaging across
-# the electrodes picked for each group
+# Filtered data from an earlier run is out of date once data is referenced
+if '/filtered' in hf5:
+    hf5.remove_node('/', 'filtered', recursive=True)
+if car_params['write_filtered']:
+    # Bandpass filter electrodes in the same pass, for blech_process.py
+    filter_settings = get_filter_settings(
+        [params_dict['bandpass_lower_cutoff'],
+         params_dict['bandpass_upper_cutoff']],
+        params_dict['sampling_rate'],
+        car_params['filtered_dtype'])
+    print('Filtered electrodes will be written to /filtered')
+else:
+    filter_settings = None
+
+# Median and trimmed mean references are robust to bad electrodes
+reference_params = dict(
+    method = car_params['reference_method'],
+    trim_fraction = car_params['trim_fraction'])
+print(f"Reference method : {reference_params['method']}")
+
+# Calculate the common average reference of each group and subtract
+# it from every electrode in the group, one block of time at a time
+# The raw .dat files are never modified, so for those the references
+# are stored, to be subtracted whenever an electrode is loaded instead
 print(
     "Calculating common average reference for {:d} groups".format(num_groups))
-common_average_reference = np.zeros(
-    (num_groups, raw_electrodes[0][:].shape[0]))
-print('Calculating mean values')
-for group in range(num_groups):
-    print('Processing Group {}'.format(group))
-    # First add up the voltage values from each electrode to the same array
-    # then divide by number of electrodes to get the average
-    # This is more memory efficient than loading all the electrode data into
-    # a single array and then averaging
-    for electrode_name in tqdm(CAR_electrodes[group]):
-        common_average_reference[group, :] += \
-            get_electrode_by_name(raw_electrodes, electrode_name)[:]
-    common_average_reference[group, :] /= float(len(CAR_electrodes[group]))
-
-print("Common average reference for {:d} groups calculated".format(num_groups))
-
-# Now run through the raw electrode data and
-# subtract the common average reference from each of them
-print('Performing background subtraction')
-for group_num, group_name in tqdm(enumerate(all_car_group_names)):
-    print(f"Processing group {group_name}")
-    for electrode_num in tqdm(all_car_group_vals[group_num]):
-        # Subtract the common average reference for that group from the
-        # voltage data of the electrode
-        wanted_electrode = get_electrode_by_name(raw_electrodes, electrode_num)
-        referenced_data = wanted_electrode[:] - common_average_reference[group_num]
-        # Overwrite the electrode data with the referenced data
-        wanted_electrode[:] = referenced_data
+# More workers than CPUs would only add overhead
+n_workers = min(car_params['n_workers'], multiprocessing.cpu_count())
+if n_workers > 1:
+    # Blocks are referenced by worker processes, while
+    # reference_groups_parallel opens the file to read and write them
+    hf5.close()
+    reference_groups_parallel(
+        metadata_handler.hdf5_name,
+        list(zip(all_car_group_names, CAR_electrodes)),
+        car_params['block_samples'],
+        n_workers,
+        filter_settings = filter_settings,
+        reference_params = reference_params)
+    hf5 = tables.open_file(metadata_handler.hdf5_name, 'r+')
+else:
+    if dat_backend:
+        print('Raw data is read from .dat files, writing references to HDF5')
+    for group_num, group_name in enumerate(all_car_group_names):
+        print(f"Processing group {group_name}")
+        group_electrodes = [get_electrode_by_name(raw_electrodes, x)
+                            for x in CAR_electrodes[group_num]]
+        if dat_backend:
+            reference_array = create_car_reference(
+                hf5, group_name, CAR_electrodes[group_num],
+                group_electrodes[0].shape[0])
+        else:
+            reference_array = None
+        if filter_settings is None:
+            reference_group(
+                group_electrodes,
+                car_params['block_samples'],
+                reference_array = reference_array,
+                reference_params = reference_params)
+        else:
+            filtered_arrays = [
+                create_filtered_array(
+                    hf5, x._v_name, x.shape[0],
+                    filter_settings['freq'],
+                    filter_settings['sampling_rate'],
+                    filter_settings['dtype'])
+                for x in group_electrodes]
+            reference_filter_group(
+                group_electrodes,
+                car_params['block_samples'],
+                filter_settings,
+                filtered_arrays,
+                reference_array = reference_array,
+                reference_params = reference_params)
         hf5.flush()
-        del referenced_data
+
+# EMG channels aren't referenced, but are filtered for cutoff
+# detection in blech_make_arrays.py
+raw_emg = list_raw_channels(hf5, 'raw_emg')
+if filter_settings is not None and len(raw_emg) > 0:
+    print('Filtering EMG channels')
+    filtered_arrays = [
+        create_filtered_array(
+            hf5, x._v_name, x.shape[0],
+            filter_settings['freq'],
+            filter_settings['sampling_rate'],
+            filter_settings['dtype'])
+        for x in raw_emg]
+    reference_filter_group(
+        raw_emg,
+        car_params['block_samples'],
+        filter_settings,
+        filtered_arrays,
+        reference = False)
+    hf5.flush()
+
+if not dat_backend:
+    # Mark the raw arrays as referenced so ingest won't reuse them
+    hf5.root.raw._v_attrs.car_applied = True
 
 hf5.close()
 print("Modified electrode arrays written to HDF5 file after "
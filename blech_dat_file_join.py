@@ -1,31 +1,61 @@
+"""
+Join Intan .dat sessions recorded back to back into one session
+
+By default every .dat file is physically concatenated into the
+output directory. With --virtual, only a joined_sessions.json file
+(see utils/session_join.py) and info.rhd are written, and the
+sessions are read in place as one continuous recording
+
+For help with input arguments:
+	python blech_dat_file_join.py -h
+"""
 # Import stuff!
 import easygui
 import sys
 import os
-
-# Ask for the directory where the first dataset sits
-dir_name1 = easygui.diropenbox(msg = 'Where is the data from the first session?', title = 'First session of data')
-# Change to that directory
-os.chdir(dir_name1)
-# Get the list of filenames (only the Intan .dat files)
-files1 = [filename for filename in os.listdir(dir_name1) if filename[-4:] == ".dat"]
-
-# Now do the same for the second session of data
-dir_name2 = easygui.diropenbox(msg = 'Where is the data from the second session?', title = 'Second session of data')
+import shutil
+import argparse
+from utils.session_join import write_join_file
+
+parser = argparse.ArgumentParser(
+		description = 'Join .dat files from sessions recorded back to back')
+parser.add_argument('session_dirs', nargs = '*',
+					help = 'Session directories, in recording order')
+parser.add_argument('--output', '-o', help = 'Directory for the joined session')
+parser.add_argument('--virtual', action = 'store_true',
+					help = 'Record the sessions to read instead of copying data')
+args = parser.parse_args()
+
+if len(args.session_dirs) > 0:
+	session_dirs = args.session_dirs
+else:
+	# Ask for the directory where the first dataset sits
+	dir_name1 = easygui.diropenbox(msg = 'Where is the data from the first session?', title = 'First session of data')
+	# Now do the same for the second session of data
+	dir_name2 = easygui.diropenbox(msg = 'Where is the data from the second session?', title = 'Second session of data')
+	session_dirs = [dir_name1, dir_name2]
 
 # Get the output directory for the joined files
-dir_output = easygui.diropenbox(msg = 'Where do you want to save the joined files?', title = 'Output directory')
-
-# Read through the first set of files, append the second set and save to the output directory
-for file1 in files1:
-	try:
-		os.system("cat " + dir_name1 + "/" + file1 + " " + dir_name2 + "/" + file1 + " > " + dir_output + "/" + file1)
-	except Exception:
-		continue
+if args.output:
+	dir_output = args.output
+	if not os.path.exists(dir_output):
+		os.makedirs(dir_output)
+else:
+	dir_output = easygui.diropenbox(msg = 'Where do you want to save the joined files?', title = 'Output directory')
+
+if args.virtual:
+	join_info = write_join_file(dir_output, session_dirs)
+	print(f'Joined {len(session_dirs)} sessions '
+		  f'({sum(join_info["num_samples"])} samples) into {dir_output}')
+else:
+	# Get the list of filenames (only the Intan .dat files)
+	files1 = [filename for filename in os.listdir(session_dirs[0]) if filename[-4:] == ".dat"]
+	# Read through the first set of files, append the other sets and save to the output directory
+	for file1 in files1:
+		try:
+			os.system("cat " + " ".join([os.path.join(x, file1) for x in session_dirs]) + " > " + os.path.join(dir_output, file1))
+		except Exception:
+			continue
 
 # Copy one of the info.rhd files to the output folder
-os.system("cp " + dir_name1 + "/info.rhd " + dir_output)
-
-
-
-
+shutil.copy(os.path.join(session_dirs[0], 'info.rhd'), dir_output)
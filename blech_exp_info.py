@@ -26,6 +26,8 @@ import pandas as pd
 # When running in Spyder, throws an error,
 # so cd to utils folder and then back out
 from utils.blech_utils import entry_checker, imp_metadata
+from utils import read_file
+from utils import session_join
 
 
 # Get name of directory with the data files
@@ -68,12 +70,16 @@ if args.template:
 else:
 
     # Find all ports used
-    file_list = os.listdir(dir_path)
+    file_list = session_join.list_session_files(dir_path)
+    rhd_file_list = read_file.get_rhd_file_list(file_list)
     try:
         file_list.index('auxiliary.dat')
         file_type = ['one file per signal type']
     except:
         file_type = ['one file per channel']
+    if file_type == ['one file per channel'] and len(rhd_file_list) > 0 \
+            and not any([x.startswith('amp-') for x in file_list]):
+        file_type = ['traditional intan']
 
     if file_type == ['one file per signal type']:
         electrodes_list = ['amplifier.dat']
@@ -83,6 +89,9 @@ else:
             name for name in file_list if name.startswith('amp-')]
         dig_in_list = [
             name for name in file_list if name.startswith('board-DI')]
+    elif file_type == ['traditional intan']:
+        electrodes_list = rhd_file_list
+        dig_in_list = []
     dig_in_list = sorted(dig_in_list)
 
     if file_type == ['one file per channel']:
@@ -96,15 +105,23 @@ else:
         print("\tSingle Amplifier File Detected")
         # Import amplifier data and calculate the number of electrodes
         print("\t\tCalculating Number of Ports")
-        num_recorded_samples = len(np.fromfile(
-            dir_path + 'time.dat', dtype=np.dtype('float32')))
-        amplifier_data = np.fromfile(
-            dir_path + 'amplifier.dat', dtype=np.dtype('uint16'))
-        num_electrodes = int(len(amplifier_data)/num_recorded_samples)
+        num_recorded_samples = session_join.count_recorded_samples(dir_path)
+        amplifier_bytes = session_join.get_file_size(
+            dir_path + 'amplifier.dat')
+        num_electrodes = int(amplifier_bytes/2/num_recorded_samples)
         electrode_files = ['amplifier.dat' for i in range(num_electrodes)]
         ports = ['A']*num_electrodes
         electrode_num_list = list(np.arange(num_electrodes))
-        del amplifier_data, num_electrodes
+        del num_electrodes
+    elif file_type == ['traditional intan']:
+        print("\tTraditional Intan .rhd Files Detected")
+        # Channels are listed in the header, in the order they are stored
+        amp_channels = read_file.read_rhd_header(
+            dir_path + rhd_file_list[0])['amplifier']
+        electrode_files = [rhd_file_list[0] for x in amp_channels]
+        ports = [x['port_prefix'] for x in amp_channels]
+        electrode_num_list = [int(x['native_channel_name'].split('-')[-1])
+                              for x in amp_channels]
 
     # Write out file and ask user to define regions in file
     layout_file_path = os.path.join(
@@ -188,8 +205,8 @@ else:
         dig_in_trials = []
         num_dig_ins = len(dig_in_list)
         for i in range(num_dig_ins):
-            dig_inputs = np.array(np.fromfile(
-                dir_path + dig_in_list[i], dtype=np.dtype('uint16')))
+            dig_inputs = np.array(session_join.map_dat_file(
+                dir_path + dig_in_list[i], 'uint16')[:])
             d_diff = np.diff(dig_inputs)
             start_ind = np.where(d_diff == 1)[0]
             if len(start_ind) == 0:
@@ -204,27 +221,29 @@ else:
             ",\n".join([str(x) for x in indexed_digin_list])
         dig_in_present_bool = len(dig_in_list) > 0
 
-    elif file_type == ['one file per signal type']:
-        d_inputs = np.fromfile(
-            dir_path + dig_in_list[0], dtype=np.dtype('uint16'))
-        d_inputs_str = d_inputs.astype('str')
-        del d_inputs
-        d_in_str_int = d_inputs_str.astype('int64')
-        del d_inputs_str
-        d_diff = np.diff(d_in_str_int)
-        del d_in_str_int
-        dig_in = list(np.unique(np.abs(d_diff)) - 1)
-        dig_in.remove(-1)
-        num_dig_ins = len(dig_in)
+    elif file_type in [['one file per signal type'], ['traditional intan']]:
+        if file_type == ['one file per signal type']:
+            d_inputs = np.array(session_join.map_dat_file(
+                dir_path + dig_in_list[0], 'uint16')[:])
+        else:
+            d_inputs = read_file.read_rhd_dig_in_words(
+                [dir_path + x for x in rhd_file_list])
+        # Every bit of digitalin.dat holds the state of one digital input,
+        # so count inputs up to the highest one that was ever active
+        num_dig_ins = int(np.bitwise_or.reduce(d_inputs)).bit_length()
         dig_in_trials = []
         for n_i in range(num_dig_ins):
-            start_ind = np.where(d_diff == n_i + 1)[0]
+            this_dig_in = read_file.decode_dig_in_words(d_inputs, [n_i])[0]
+            start_ind = np.where(np.diff(this_dig_in.astype(np.int8)) == 1)[0]
             if len(start_ind) == 0:
-                print(f"== No deliveries detected for {dig_in_list[i]} ==")
+                print(f"== No deliveries detected for dig_in_{n_i} ==")
                 print("== blech_clust is sad and can't work under these conditions ==")
-                print(f"== Please delete {dig_in_list[i]} and try again ==")
+                print(f"== Please delete dig_in_{n_i} and try again ==")
                 exit()
             dig_in_trials.append(int(len(start_ind)))
+        del d_inputs
+        if file_type == ['traditional intan']:
+            dig_in_list = [f'dig_in_{i}' for i in range(num_dig_ins)]
         dig_in_print_str = "A total of " + str(num_dig_ins)
         dig_in_present_bool = num_dig_ins > 0
 
@@ -5,9 +5,37 @@ import sys
 import os
 import pandas as pd
 from tqdm import tqdm
-from utils.clustering import get_filtered_electrode
-from utils.blech_process_utils import return_cutoff_values
 from utils.blech_utils import imp_metadata
+from utils.read_file import read_dig_in_events
+from utils.raw_data_backend import list_raw_channels
+from utils.ingest_manifest import get_channel_fingerprint
+from utils.filter_utils import get_filtered_node, read_filtered, filter_chunked
+from utils.cutoff_utils import (
+    cutoff_stats_accumulator, calc_cutoff_values,
+    save_cutoff_stats, load_cutoff_stats)
+
+def get_dig_in_events(hf5):
+    """
+    Get pulse start and end points for every dig-in from the
+    /digital_in_events table written at ingest, without loading
+    the dig-in arrays themselves
+
+    start and end follow np.diff indexing, i.e. the sample before
+    the rising edge and the last high sample, to match get_dig_in_data
+    (pulses touching the edges of the recording aren't in the table,
+    see read_file.dig_in_edge_tracker.write_table)
+    """
+    dig_in_nodes = hf5.list_nodes('/digital_in')
+    dig_in_pathname = [node._v_pathname for node in dig_in_nodes]
+    dig_in_basename = [os.path.basename(x) for x in dig_in_pathname]
+    events = read_dig_in_events(hf5)
+    start_points = []
+    end_points = []
+    for this_name in dig_in_basename:
+        this_events = events.loc[events.dig_in_name == this_name]
+        start_points.append(this_events.onset.values - 1)
+        end_points.append(this_events.offset.values - 1)
+    return dig_in_pathname, dig_in_basename, start_points, end_points
 
 def get_dig_in_data(hf5):
     dig_in_nodes = hf5.list_nodes('/digital_in')
@@ -17,7 +45,9 @@ def get_dig_in_data(hf5):
         dig_in_pathname.append(node._v_pathname)
         dig_in_data.append(node[:])
     dig_in_basename = [os.path.basename(x) for x in dig_in_pathname]
-    dig_in_data = np.array(dig_in_data)
+    # Dig-ins may be stored unsigned (uint8), so cast to a signed type
+    # to make sure falling edges show up as -1 in np.diff
+    dig_in_data = np.array(dig_in_data, dtype = np.int8)
     return dig_in_pathname, dig_in_basename, dig_in_data
 
 def create_spike_trains_for_digin(
@@ -108,12 +138,18 @@ if __name__ == '__main__':
     hf5 = tables.open_file(metadata_handler.hdf5_name, 'r+')
 
     # Grab the names of the arrays containing digital inputs, 
-    # and pull the data into a numpy array
-    dig_in_pathname, dig_in_basename, dig_in_data = get_dig_in_data(hf5)
-    dig_in_diff = np.diff(dig_in_data,axis=-1)
-    # Calculate start and end points of pulses
-    start_points = [np.where(x==1)[0] for x in dig_in_diff]
-    end_points = [np.where(x==-1)[0] for x in dig_in_diff]
+    # and the start and end points of pulses
+    if '/digital_in_events' in hf5:
+        dig_in_pathname, dig_in_basename, start_points, end_points = \
+                get_dig_in_events(hf5)
+    else:
+        # Older files without an event table, pull the data into
+        # a numpy array
+        dig_in_pathname, dig_in_basename, dig_in_data = get_dig_in_data(hf5)
+        dig_in_diff = np.diff(dig_in_data,axis=-1)
+        # Calculate start and end points of pulses
+        start_points = [np.where(x==1)[0] for x in dig_in_diff]
+        end_points = [np.where(x==-1)[0] for x in dig_in_diff]
 
     # Extract taste dig-ins from experimental info file
     info_dict = metadata_handler.info_dict
@@ -291,10 +327,8 @@ if __name__ == '__main__':
     # If sorting hasn't been done, use only emg channels
     # to calculate cutoff...don't need to go through all channels
 
-    if '/raw_emg' in hf5:
-        raw_emg_electrodes = [x for x in hf5.get_node('/','raw_emg')]
-    else:
-        raw_emg_electrodes = []
+    # EMG channels may be HDF5 arrays or views of the raw .dat files
+    raw_emg_electrodes = list_raw_channels(hf5, 'raw_emg')
 
     if len(raw_emg_electrodes) > 0:
         emg_electrode_names = [x._v_pathname for x in raw_emg_electrodes]
@@ -304,27 +338,47 @@ if __name__ == '__main__':
         print(emg_electrode_names)
         print('===============================================')
         cutoff_data = []
+        freq = [params_dict['bandpass_lower_cutoff'],
+                params_dict['bandpass_upper_cutoff']]
         for this_el in tqdm(raw_emg_electrodes): 
-            raw_el = this_el[:]
-            # High bandpass filter the raw electrode recordings
-            filt_el = get_filtered_electrode(
-                raw_el,
-                freq=[params_dict['bandpass_lower_cutoff'],
-                      params_dict['bandpass_upper_cutoff']],
-                sampling_rate=params_dict['sampling_rate'])
-
-            # Cut data to have integer number of seconds
-            sampling_rate = params_dict['sampling_rate']
-            filt_el = filt_el[:int(sampling_rate)*int(len(filt_el)/sampling_rate)]
-
-            # Delete raw electrode recording from memory
-            del raw_el
+            # Per second statistics are saved the first time a channel is
+            # filtered, so it isn't filtered again on later runs
+            fingerprint = get_channel_fingerprint(hf5, this_el)
+            cutoff_stats = load_cutoff_stats(
+                metadata_handler.dir_name, this_el._v_name,
+                sampling_rate, params_dict['voltage_cutoff'], freq,
+                this_el.shape[0], fingerprint)
+            if cutoff_stats is None:
+                accumulator = cutoff_stats_accumulator(
+                    sampling_rate, params_dict['voltage_cutoff'])
+                # Use the filtered signal written by
+                # blech_common_avg_reference.py if there is one
+                filtered_node = get_filtered_node(
+                    hf5, this_el._v_name, freq, sampling_rate)
+                if filtered_node is not None:
+                    accumulator.update(read_filtered(filtered_node))
+                else:
+                    raw_el = this_el[:]
+                    # High bandpass filter the raw electrode recordings
+                    filter_chunked(
+                        raw_el,
+                        freq=freq,
+                        sampling_rate=sampling_rate,
+                        chunk_samples=params_dict.get('bandpass_chunk_samples', 1200000),
+                        on_chunk=accumulator.update)
+                    # Delete raw electrode recording from memory
+                    del raw_el
+                cutoff_stats = accumulator.get_stats()
+                save_cutoff_stats(
+                    metadata_handler.dir_name, this_el._v_name, cutoff_stats,
+                    sampling_rate, params_dict['voltage_cutoff'], freq,
+                    fingerprint)
 
             # Get parameters for recording cutoff
-            this_out = return_cutoff_values(
-                            filt_el,
-                            params_dict['sampling_rate'],
-                            params_dict['voltage_cutoff'],
+            # (incomplete seconds at the end are left out)
+            this_out = calc_cutoff_values(
+                            cutoff_stats['breaches_per_sec'],
+                            sampling_rate,
                             params_dict['max_breach_rate'],
                             params_dict['max_secs_above_cutoff'],
                             params_dict['max_mean_breach_rate_persec']
@@ -434,16 +488,14 @@ if __name__ == '__main__':
     else:
         print('No sorted units found...NOT MAKING SPIKE TRAINS')
 
-    if '/raw_emg' in hf5:
-        if len(list(hf5.get_node('/','raw_emg'))) > 0:
-        
-            print('EMG Data found ==> Making EMG Trial Arrays')
+    if len(raw_emg_electrodes) > 0:
+        print('EMG Data found ==> Making EMG Trial Arrays')
 
-            # Grab the names of the arrays containing emg recordings
-            emg_nodes = hf5.list_nodes('/raw_emg')
-            emg_pathname = []
-            for node in emg_nodes:
-                emg_pathname.append(node._v_pathname)
+        # Grab the names of the arrays containing emg recordings
+        emg_nodes = list_raw_channels(hf5, 'raw_emg')
+        emg_pathname = []
+        for node in emg_nodes:
+            emg_pathname.append(node._v_pathname)
 
         # Delete /emg_data in hf5 file if it exists, and then create it
         if '/emg_data' in hf5:
@@ -57,8 +57,9 @@ data_dir_name = sys.argv[1]
 metadata_handler = imp_metadata([[], data_dir_name])
 os.chdir(metadata_handler.dir_name)
 
-electrode_num = int(sys.argv[2])
-print(f'Processing electrode {electrode_num}')
+# More than one electrode can be given, to be processed as a batch
+electrode_nums = [int(x) for x in sys.argv[2:]]
+print(f'Processing electrodes {electrode_nums}')
 params_dict = metadata_handler.params_dict
 auto_params = params_dict['clustering_params']['auto_params']
 auto_cluster = auto_params['auto_cluster']
@@ -66,165 +67,197 @@ auto_cluster = auto_params['auto_cluster']
 # Check if the directories for this electrode number exist -
 # if they do, delete them (existence of the directories indicates a
 # job restart on the cluster, so restart afresh)
-dir_list = [f'./Plots/{electrode_num:02}',
-            f'./spike_waveforms/electrode{electrode_num:02}',
-            f'./spike_times/electrode{electrode_num:02}',
-            f'./clustering_results/electrode{electrode_num:02}']
-for this_dir in dir_list:
-    bpu.ifisdir_rmdir(this_dir)
-    os.makedirs(this_dir)
+for electrode_num in electrode_nums:
+    dir_list = [f'./Plots/{electrode_num:02}',
+                f'./spike_waveforms/electrode{electrode_num:02}',
+                f'./spike_times/electrode{electrode_num:02}',
+                f'./clustering_results/electrode{electrode_num:02}']
+    for this_dir in dir_list:
+        bpu.ifisdir_rmdir(this_dir)
+        os.makedirs(this_dir)
 
 ############################################################
 # Preprocessing
 ############################################################
-# Open up hdf5 file, and load this electrode number
-electrode = bpu.electrode_handler(
+# Open up hdf5 file, and load these electrodes
+# They are filtered together, as rows of one array
+electrode_group = bpu.electrode_group_handler(
                   metadata_handler.hdf5_name,
-                  electrode_num,
+                  electrode_nums,
                   params_dict)
 
-electrode.filter_electrode()
+electrode_group.filter_electrodes()
 
-# Calculate the 3 voltage parameters
-electrode.cut_to_int_seconds()
-electrode.calc_recording_cutoff()
+for electrode in electrode_group.electrodes:
+    # Calculate the 3 voltage parameters
+    electrode.cut_to_int_seconds()
+    electrode.calc_recording_cutoff()
 
-# Dump a plot showing where the recording was cut off at
-electrode.make_cutoff_plot()
+    # Dump a plot showing where the recording was cut off at
+    electrode.make_cutoff_plot()
 
-# Then cut the recording accordingly
-electrode.cutoff_electrode()
+    # Then cut the recording accordingly
+    electrode.cutoff_electrode()
 
 #############################################################
 # Process Spikes
 #############################################################
 
-# Extract spike times and waveforms from filtered data
-spike_set = bpu.spike_handler(electrode.filt_el, 
-                              params_dict, data_dir_name, electrode_num)
-spike_set.extract_waveforms()
-
-############################################################
-# Extract windows from filt_el and plot with threshold overlayed
-window_len= 0.2  # sec
-window_count= 10
-fig= bpu.gen_window_plots(
-    electrode.filt_el,
-    window_len,
-    window_count,
-    params_dict['sampling_rate'],
-    spike_set.spike_times,
-    spike_set.mean_val,
-    spike_set.threshold,
-)
-fig.savefig(f'./Plots/{electrode_num:02}/bandapass_trace_snippets.png',
-            bbox_inches='tight', dpi=300)
-plt.close(fig)
-############################################################
-
-# Delete filtered electrode from memory
-del electrode
-
-# Dejitter these spike waveforms, and get their maximum amplitudes
-# Slices are returned sorted by amplitude polaity
-spike_set.dejitter_spikes()
+# Extract spike times and waveforms from filtered data,
+# for all electrodes at once
+spike_sets = [
+    bpu.spike_handler(electrode.filt_el, 
+                      params_dict, data_dir_name, electrode.electrode_num)
+    for electrode in electrode_group.electrodes]
+electrode_group.extract_waveforms(spike_sets)
+
+# Random state of every electrode after plotting, so each electrode
+# is clustered exactly as if it were processed on its own
+random_states = []
+for electrode, spike_set in zip(electrode_group.electrodes, spike_sets):
+    electrode_num = electrode.electrode_num
+    spike_set.make_noise_plot()
+
+    ############################################################
+    # Extract windows from filt_el and plot with threshold overlayed
+    np.random.seed(0)
+    window_len= 0.2  # sec
+    window_count= 10
+    fig= bpu.gen_window_plots(
+        electrode.filt_el,
+        window_len,
+        window_count,
+        params_dict['sampling_rate'],
+        spike_set.spike_times,
+        spike_set.mean_val,
+        spike_set.threshold,
+    )
+    fig.savefig(f'./Plots/{electrode_num:02}/bandapass_trace_snippets.png',
+                bbox_inches='tight', dpi=300)
+    plt.close(fig)
+    random_states.append(np.random.get_state())
+    # Filtered electrode isn't needed after spike extraction
+    spike_set.filt_el = None
+    ############################################################
+
+# Delete filtered electrodes from memory
+del electrode_group, electrode
 
 ############################################################
 # Load classifier if specificed
+# (the same for every electrode of the batch)
 classifier_params_path = \
         bpu.classifier_handler.return_waveform_classifier_params_path(
                 blech_clust_dir)
 classifier_params = json.load(open(classifier_params_path, 'r'))
-
-
 if classifier_params['use_classifier'] and \
     classifier_params['use_neuRecommend']:
-    classifier_handler = bpu.classifier_handler(
-            data_dir_name, electrode_num, params_dict)
-    sys.path.append(classifier_handler.create_pipeline_path)
+    # Classes needed to load the classifier pipelines
+    sys.path.append(
+            bpu.classifier_handler(
+                data_dir_name, electrode_nums[0], params_dict
+                ).create_pipeline_path)
     from feature_engineering_pipeline import *
-    classifier_handler.load_pipelines()
-    classifier_handler.classify_waveforms(
-            spike_set.slices_dejittered,
-            spike_set.times_dejittered,
-            )
-    classifier_handler.gen_plots()
-    classifier_handler.write_out_recommendations()
-
-    if classifier_params['throw_out_noise'] or auto_cluster:
-        # Remaining data is now only spikes
-        slices_dejittered, times_dejittered, clf_prob = \
-            classifier_handler.pos_spike_dict.values()
-        spike_set.slices_dejittered = slices_dejittered
-        spike_set.times_dejittered = times_dejittered
-        classifier_handler.clf_prob = clf_prob
-        classifier_handler.clf_pred = clf_prob > classifier_handler.clf_threshold
+if not classifier_params['use_neuRecommend']:
+    import utils.blech_spike_features as bsf
 
-############################################################
+for electrode_num, random_state in zip(electrode_nums, random_states):
+    print(f'Clustering electrode {electrode_num}')
+    # Taken off the list so waveforms are freed once clustered
+    spike_set = spike_sets.pop(0)
+    np.random.set_state(random_state)
+
+    # Dejitter these spike waveforms, and get their maximum amplitudes
+    # Slices are returned sorted by amplitude polaity
+    spike_set.dejitter_spikes()
+
+    ############################################################
+    # Classify waveforms if specificed
+    if classifier_params['use_classifier'] and \
+        classifier_params['use_neuRecommend']:
+        classifier_handler = bpu.classifier_handler(
+                data_dir_name, electrode_num, params_dict)
+        classifier_handler.load_pipelines()
+        classifier_handler.classify_waveforms(
+                spike_set.slices_dejittered,
+                spike_set.times_dejittered,
+                )
+        classifier_handler.gen_plots()
+        classifier_handler.write_out_recommendations()
+
+        if classifier_params['throw_out_noise'] or auto_cluster:
+            # Remaining data is now only spikes
+            slices_dejittered, times_dejittered, clf_prob = \
+                classifier_handler.pos_spike_dict.values()
+            spike_set.slices_dejittered = slices_dejittered
+            spike_set.times_dejittered = times_dejittered
+            classifier_handler.clf_prob = clf_prob
+            classifier_handler.clf_pred = clf_prob > classifier_handler.clf_threshold
+
+    ############################################################
+
+    if classifier_params['use_neuRecommend']:
+        print('Using neuRecommend features')
+        spike_set.extract_features(
+                classifier_handler.feature_pipeline,
+                classifier_handler.feature_names,
+                fitted_transformer=True,
+                )
+    else:
+        print('Using blech_spike_features')
+        bsf_feature_pipeline = bsf.return_feature_pipeline(data_dir_name)
+        # Set fitted_transformer to False so transformer is fit to new data
+        spike_set.extract_features(
+                bsf_feature_pipeline,
+                bsf.feature_names,
+                fitted_transformer=False,
+                )
 
-if classifier_params['use_neuRecommend']:
-    print('Using neuRecommend features')
-    spike_set.extract_features(
-            classifier_handler.feature_pipeline,
-            classifier_handler.feature_names,
-            fitted_transformer=True,
-            )
-else:
-    print('Using blech_spike_features')
-    import utils.blech_spike_features as bsf
-    bsf_feature_pipeline = bsf.return_feature_pipeline(data_dir_name)
-    # Set fitted_transformer to False so transformer is fit to new data
-    spike_set.extract_features(
-            bsf_feature_pipeline,
-            bsf.feature_names,
-            fitted_transformer=False,
-            )
-
-spike_set.write_out_spike_data()
-
-
-if auto_cluster == False:
-    print('=== Performing manual clustering ===')
-    # Run GMM, from 2 to max_clusters
-    max_clusters = params_dict['clustering_params']['max_clusters']
-    for cluster_num in range(2, max_clusters+1):
+    spike_set.write_out_spike_data()
+
+
+    if auto_cluster == False:
+        print('=== Performing manual clustering ===')
+        # Run GMM, from 2 to max_clusters
+        max_clusters = params_dict['clustering_params']['max_clusters']
+        for cluster_num in range(2, max_clusters+1):
+            cluster_handler = bpu.cluster_handler(
+                    params_dict, 
+                    data_dir_name, 
+                    electrode_num,
+                    cluster_num,
+                    spike_set,
+                    fit_type = 'manual',
+                    )
+            cluster_handler.perform_prediction()
+            cluster_handler.remove_outliers(params_dict)
+            cluster_handler.calc_mahalanobis_distance_matrix()
+            cluster_handler.save_cluster_labels()
+            cluster_handler.create_output_plots(params_dict)
+            if classifier_params['use_classifier'] and \
+                classifier_params['use_neuRecommend']:
+                cluster_handler.create_classifier_plots(classifier_handler)
+    else:
+        print('=== Performing auto_clustering ===')
+        max_clusters = auto_params['max_autosort_clusters']
         cluster_handler = bpu.cluster_handler(
                 params_dict, 
                 data_dir_name, 
                 electrode_num,
-                cluster_num,
+                max_clusters, 
                 spike_set,
-                fit_type = 'manual',
+                fit_type = 'auto',
                 )
         cluster_handler.perform_prediction()
         cluster_handler.remove_outliers(params_dict)
         cluster_handler.calc_mahalanobis_distance_matrix()
         cluster_handler.save_cluster_labels()
         cluster_handler.create_output_plots(params_dict)
-        if classifier_params['use_classifier'] and \
-            classifier_params['use_neuRecommend']:
-            cluster_handler.create_classifier_plots(classifier_handler)
-else:
-    print('=== Performing auto_clustering ===')
-    max_clusters = auto_params['max_autosort_clusters']
-    cluster_handler = bpu.cluster_handler(
-            params_dict, 
-            data_dir_name, 
-            electrode_num,
-            max_clusters, 
-            spike_set,
-            fit_type = 'auto',
-            )
-    cluster_handler.perform_prediction()
-    cluster_handler.remove_outliers(params_dict)
-    cluster_handler.calc_mahalanobis_distance_matrix()
-    cluster_handler.save_cluster_labels()
-    cluster_handler.create_output_plots(params_dict)
-    cluster_handler.create_classifier_plots(classifier_handler)
-
-
-# Make file for dumping info about memory usage
-f= open(f'./memory_monitor_clustering/{electrode_num:02}.txt', 'w')
-print(mm.memory_usage_resource(), file=f)
-f.close()
-print(f'Electrode {electrode_num} complete.')
+        cluster_handler.create_classifier_plots(classifier_handler)
+
+
+    # Make file for dumping info about memory usage
+    f= open(f'./memory_monitor_clustering/{electrode_num:02}.txt', 'w')
+    print(mm.memory_usage_resource(), file=f)
+    f.close()
+    print(f'Electrode {electrode_num} complete.')
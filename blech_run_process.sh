@@ -26,7 +26,6 @@ if [ ! -d "$DIR" ]; then
 fi
 
 echo "Processing $DIR"
-for i in {1..10}; do
-    echo Retry $i
-    bash "$DIR/temp/blech_process_parallel.sh"
-done
+# Runs every electrode, retrying failures, and skipping electrodes
+# already complete (see utils/process_scheduler.py)
+python utils/process_scheduler.py "$DIR"
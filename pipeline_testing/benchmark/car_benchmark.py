@@ -0,0 +1,192 @@
+"""
+Benchmark of common average referencing with a pool of processes
+
+Times car_utils.reference_groups_parallel for every --n_workers on a
+copy of an HDF5 file (e.g. a synthetic session ingested by
+ingest_benchmark.py, before blech_common_avg_reference.py is run),
+against the serial path used when car_params.n_workers is 1.
+Outputs are checked to be identical to the serial path.
+
+The main process reads and writes every block, so it limits how far
+this scales. The time of that reading and writing alone (io_seconds)
+is measured too: serial_seconds / io_seconds is the most speedup any
+number of workers can give on this file and machine.
+
+For help with input arguments:
+    python car_benchmark.py -h
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+import tables
+
+script_path = os.path.realpath(__file__)
+blech_clust_dir = os.path.dirname(os.path.dirname(os.path.dirname(script_path)))
+sys.path.append(blech_clust_dir)
+from utils import car_utils  # noqa: E402
+from utils.filter_utils import (  # noqa: E402
+    get_filter_settings, create_filtered_array, to_filtered_dtype)
+from utils.raw_data_backend import is_dat_backend  # noqa: E402
+
+
+def run_serial(hdf5_name, groups, block_samples, filter_settings):
+    """
+    Reference groups one after another, as blech_common_avg_reference.py
+    does with car_params.n_workers = 1
+    """
+    with tables.open_file(hdf5_name, 'r+') as hf5:
+        for group_name, electrode_inds in groups:
+            electrodes = [hf5.get_node('/raw', f'electrode{x:02}')
+                          for x in electrode_inds]
+            if filter_settings is None:
+                car_utils.reference_group(electrodes, block_samples)
+                continue
+            filtered_arrays = [
+                create_filtered_array(
+                    hf5, x._v_name, x.shape[0],
+                    filter_settings['freq'],
+                    filter_settings['sampling_rate'],
+                    filter_settings['dtype'])
+                for x in electrodes]
+            car_utils.reference_filter_group(
+                electrodes, block_samples, filter_settings, filtered_arrays)
+
+
+def run_io_only(hdf5_name, groups, block_samples, filter_settings):
+    """
+    Read every block and write it back (and append it to /filtered),
+    without referencing or filtering it
+    """
+    with tables.open_file(hdf5_name, 'r+') as hf5:
+        n_samples = hf5.get_node('/raw', f'electrode{groups[0][1][0]:02}').shape[0]
+        for group_name, electrode_inds in groups:
+            electrodes = [hf5.get_node('/raw', f'electrode{x:02}')
+                          for x in electrode_inds]
+            block_samples = car_utils.get_block_samples(electrodes, block_samples)
+            if filter_settings is not None:
+                filtered_arrays = [
+                    create_filtered_array(
+                        hf5, x._v_name, n_samples,
+                        filter_settings['freq'],
+                        filter_settings['sampling_rate'],
+                        filter_settings['dtype'])
+                    for x in electrodes]
+            for block_start in range(0, n_samples, block_samples):
+                block_end = min(block_start + block_samples, n_samples)
+                data = np.stack([x[block_start:block_end] for x in electrodes])
+                for electrode, this_data in zip(electrodes, data):
+                    electrode[block_start:block_end] = this_data
+                if filter_settings is not None:
+                    for filtered_array, this_data in zip(filtered_arrays, data):
+                        filtered_array.append(to_filtered_dtype(
+                            this_data.astype(np.float64),
+                            filter_settings['dtype']))
+
+
+def outputs_match(hdf5_a, hdf5_b):
+    with tables.open_file(hdf5_a, 'r') as hf5_a, \
+            tables.open_file(hdf5_b, 'r') as hf5_b:
+        for group in ['raw', 'filtered']:
+            if f'/{group}' not in hf5_a:
+                continue
+            for node in hf5_a.list_nodes(f'/{group}'):
+                if not np.array_equal(
+                        node[:], hf5_b.get_node(f'/{group}', node._v_name)[:]):
+                    return False
+    return True
+
+
+def timed_copy(hdf5_name, work_dir, name, func, *args):
+    """
+    Run func on a fresh copy of hdf5_name, returning seconds and the copy
+    """
+    copy_name = os.path.join(work_dir, name)
+    shutil.copy(hdf5_name, copy_name)
+    start_time = time.perf_counter()
+    func(copy_name, *args)
+    return time.perf_counter() - start_time, copy_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time parallel CAR against the serial path')
+    parser.add_argument('hdf5', help='HDF5 file with unreferenced /raw electrodes')
+    parser.add_argument('--n_workers', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--group_size', type=int, default=16,
+                        help='Electrodes per CAR group')
+    parser.add_argument('--block_samples', type=int, default=600000)
+    parser.add_argument('--filter', action='store_true',
+                        help='Also bandpass filter, as car_params.write_filtered')
+    parser.add_argument('--sampling_rate', type=int, default=30000)
+    parser.add_argument('--output', default='car_benchmark_results.csv',
+                        help='csv to append results to')
+    args = parser.parse_args()
+
+    with tables.open_file(args.hdf5, 'r') as hf5:
+        if is_dat_backend(hf5):
+            raise Exception('Raw data must be stored in the HDF5 file')
+        electrode_inds = sorted(
+            [int(x._v_name.replace('electrode', ''))
+             for x in hf5.list_nodes('/raw')])
+        for node in ['filtered', 'car_reference']:
+            if f'/{node}' in hf5:
+                raise Exception(f'{args.hdf5} has /{node}, use an '
+                                'unreferenced copy')
+    groups = [
+        (f'group{i}', electrode_inds[i*args.group_size:(i+1)*args.group_size])
+        for i in range(int(np.ceil(len(electrode_inds) / args.group_size)))]
+    if args.filter:
+        filter_settings = get_filter_settings([300, 3000], args.sampling_rate)
+    else:
+        filter_settings = None
+
+    work_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(args.hdf5)))
+    try:
+        io_seconds, io_copy = timed_copy(
+            args.hdf5, work_dir, 'io.h5', run_io_only,
+            groups, args.block_samples, filter_settings)
+        os.remove(io_copy)
+        serial_seconds, serial_copy = timed_copy(
+            args.hdf5, work_dir, 'serial.h5', run_serial,
+            groups, args.block_samples, filter_settings)
+        print(f'Serial : {serial_seconds:.1f} s, reading and writing alone '
+              f'{io_seconds:.1f} s (at most {serial_seconds / io_seconds:.1f}x '
+              'speedup)')
+        results = []
+        for n_workers in args.n_workers:
+            seconds, parallel_copy = timed_copy(
+                args.hdf5, work_dir, f'parallel_{n_workers}.h5',
+                car_utils.reference_groups_parallel,
+                groups, args.block_samples, n_workers, filter_settings)
+            matches = outputs_match(serial_copy, parallel_copy)
+            os.remove(parallel_copy)
+            print(f'{n_workers} workers : {seconds:.1f} s, '
+                  f'{serial_seconds / seconds:.2f}x, matches serial {matches}')
+            results.append({
+                'hdf5': os.path.basename(args.hdf5),
+                'cpu_count': multiprocessing.cpu_count(),
+                'filter': args.filter,
+                'block_samples': args.block_samples,
+                'n_workers': n_workers,
+                'seconds': seconds,
+                'serial_seconds': serial_seconds,
+                'io_seconds': io_seconds,
+                'speedup': serial_seconds / seconds,
+                'matches_serial': matches})
+    finally:
+        shutil.rmtree(work_dir)
+
+    results_frame = pd.DataFrame(results)
+    write_header = not os.path.exists(args.output)
+    results_frame.to_csv(args.output, mode='a', header=write_header, index=False)
+    print(f'Results appended to {args.output}')
+    if not results_frame.matches_serial.all():
+        print('=== Parallel output did not match the serial path ===')
+        exit(1)
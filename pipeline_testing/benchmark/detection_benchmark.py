@@ -0,0 +1,178 @@
+"""
+Benchmark of spike detection methods on single filtered traces
+
+Times every detection method in utils/clustering.py on synthetic traces
+(noise and spikes, see synthetic_intan.py, bandpass filtered as in
+blech_process.py) and, if an HDF5 file is given, on real electrodes.
+Outputs of methods finding the same spikes (exact_methods) are checked
+against extract_waveforms_abu; for the others the fraction of abu spikes
+they also find is reported. Times (median of repeats, after a warm-up
+call so compilation isn't counted) are appended to a csv.
+
+For help with input arguments:
+    python detection_benchmark.py -h
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import tables
+from synthetic_intan import spike_template
+
+script_path = os.path.realpath(__file__)
+blech_clust_dir = os.path.dirname(os.path.dirname(os.path.dirname(script_path)))
+sys.path.append(blech_clust_dir)
+import utils.clustering as clust  # noqa: E402
+from utils.filter_utils import (  # noqa: E402
+    filter_chunked, get_filtered_node, read_filtered)
+from utils.raw_data_backend import (  # noqa: E402
+    is_dat_backend, get_referenced_channel)
+
+methods = {
+    'abu': clust.extract_waveforms_abu,
+    'abu_numba': clust.extract_waveforms_numba,
+    'adaptive': clust.extract_waveforms_adaptive,
+}
+exact_methods = ['abu', 'abu_numba']
+
+
+def synthetic_trace(duration, sampling_rate, spike_rate, seed=0,
+                    spike_amplitude=600, noise_sd=50):
+    """
+    Raw amplifier trace of gaussian noise with spikes at spike_rate
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration * sampling_rate)
+    trace = rng.normal(0, noise_sd, n_samples)
+    template = spike_template(sampling_rate, spike_amplitude)
+    n_spikes = rng.poisson(spike_rate * duration)
+    spike_times = rng.integers(0, n_samples - len(template), n_spikes)
+    for spike_time in spike_times:
+        trace[spike_time:spike_time + len(template)] += template
+    return trace
+
+
+def load_electrode(hdf5_path, electrode_num, freq, sampling_rate, chunk_samples):
+    """
+    Filtered trace of a real electrode, from /filtered if it has been
+    cached, otherwise filtered from the (referenced) raw data
+    """
+    name = f'electrode{electrode_num:02}'
+    with tables.open_file(hdf5_path, 'r') as hf5:
+        filtered_array = get_filtered_node(hf5, name, freq, sampling_rate)
+        if filtered_array is not None:
+            return read_filtered(filtered_array)
+        if is_dat_backend(hf5):
+            raw_el = get_referenced_channel(hf5, 'raw', name)
+        else:
+            raw_el = hf5.get_node('/raw', name)[:]
+    return filter_chunked(raw_el, freq, sampling_rate, chunk_samples)
+
+
+def benchmark_trace(filt_el, snapshot, sampling_rate, threshold_mult, repeats):
+    """
+    Time every method on filt_el, with the noise estimated once
+
+    Output:
+        list of dicts, one per method
+    """
+    block_samples = int(sampling_rate)
+    noise_sd, block_noise = clust.estimate_noise_streaming(
+        filt_el, block_samples=block_samples)
+    reference = None
+    results = []
+    for method, func in methods.items():
+        kwargs = dict(spike_snapshot=snapshot, sampling_rate=sampling_rate,
+                      threshold_mult=threshold_mult)
+        if method == 'adaptive':
+            kwargs.update(block_samples=block_samples, block_noise=block_noise)
+        else:
+            kwargs.update(noise_sd=noise_sd)
+        output = func(filt_el, **kwargs)
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            func(filt_el, **kwargs)
+            times.append(time.perf_counter() - start_time)
+        if reference is None:
+            reference = output
+        if method in exact_methods:
+            matches = all([
+                np.array_equal(x, y) for x, y in zip(output, reference)])
+        else:
+            matches = np.nan
+        results.append({
+            'method': method,
+            'n_samples': len(filt_el),
+            'n_spikes': len(output[1]),
+            'seconds': np.median(times),
+            'matches_abu': matches,
+            'abu_spikes_found': np.isin(reference[1], output[1]).mean()})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time spike detection methods on synthetic and real traces')
+    parser.add_argument('--duration', type=float, nargs='+', default=[600],
+                        help='Synthetic trace lengths in seconds')
+    parser.add_argument('--spike_rate', type=float, nargs='+', default=[20])
+    parser.add_argument('--sampling_rate', type=int, default=30000,
+                        help='Of synthetic traces and of --hdf5')
+    parser.add_argument('--hdf5', help='HDF5 file of a session, to also '
+                        'benchmark its electrodes')
+    parser.add_argument('--electrodes', type=int, nargs='+', default=[0],
+                        help='Electrodes of --hdf5 to benchmark')
+    parser.add_argument('--freq', type=float, nargs=2, default=[300, 3000],
+                        help='Bandpass cutoffs')
+    parser.add_argument('--snapshot', type=float, nargs=2, default=[0.5, 1.0],
+                        help='ms before and after spikes')
+    parser.add_argument('--threshold_mult', type=float, default=5.0)
+    parser.add_argument('--chunk_samples', type=int, default=1200000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='detection_benchmark_results.csv',
+                        help='csv to append results to')
+    args = parser.parse_args()
+
+    traces = []
+    for duration in args.duration:
+        for spike_rate in args.spike_rate:
+            traces.append((
+                f'synthetic_{duration}s_{spike_rate}Hz',
+                args.sampling_rate,
+                lambda duration=duration, spike_rate=spike_rate: filter_chunked(
+                    synthetic_trace(duration, args.sampling_rate, spike_rate),
+                    args.freq, args.sampling_rate, args.chunk_samples)))
+    if args.hdf5:
+        for electrode_num in args.electrodes:
+            traces.append((
+                f'{os.path.basename(args.hdf5)}:electrode{electrode_num:02}',
+                args.sampling_rate,
+                lambda electrode_num=electrode_num: load_electrode(
+                    args.hdf5, electrode_num, args.freq,
+                    args.sampling_rate, args.chunk_samples)))
+
+    all_results = []
+    for trace_name, sampling_rate, load_trace in traces:
+        print(f'Benchmarking {trace_name}')
+        filt_el = load_trace()
+        for result in benchmark_trace(
+                filt_el, args.snapshot, sampling_rate,
+                args.threshold_mult, args.repeats):
+            print(f'\t{result["method"]} : {result["seconds"]:.3f} s, '
+                  f'{result["n_spikes"]} spikes, '
+                  f'matches abu {result["matches_abu"]}, '
+                  f'{result["abu_spikes_found"]:.1%} of abu spikes found')
+            all_results.append({'trace': trace_name, **result})
+        del filt_el
+
+    results_frame = pd.DataFrame(all_results)
+    write_header = not os.path.exists(args.output)
+    results_frame.to_csv(args.output, mode='a', header=write_header, index=False)
+    print(f'Results appended to {args.output}')
+    exact_frame = results_frame[results_frame.method.isin(exact_methods)]
+    if not exact_frame.matches_abu.astype(bool).all():
+        print('=== Some methods did not match extract_waveforms_abu ===')
+        exit(1)
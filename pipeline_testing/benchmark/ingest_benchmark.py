@@ -0,0 +1,198 @@
+"""
+Offline benchmark of ingest, CAR and per-electrode processing
+
+Generates synthetic Intan sessions (see synthetic_intan.py), then runs
+blech_clust.py, blech_common_avg_reference.py and blech_process.py
+on them. Wall-clock time and peak RSS of every stage are measured and
+appended to a csv. If a baseline csv is given, stages which got slower
+or used more memory than the tolerance allows are reported, and the
+script exits with an error, so regressions can be caught without the
+test dataset.
+
+For help with input arguments:
+    python ingest_benchmark.py -h
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import pandas as pd
+from synthetic_intan import generate_session
+
+script_path = os.path.realpath(__file__)
+blech_clust_dir = os.path.dirname(os.path.dirname(os.path.dirname(script_path)))
+
+
+def run_stage(args):
+    """
+    Run a pipeline script, returning wall-clock seconds and peak RSS (MB)
+
+    Uses os.wait4 so the peak RSS is that of this process only
+    """
+    start_time = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable] + args,
+        cwd=blech_clust_dir,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    # Read stderr before waiting, so a full pipe can't block the process
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    # os.waitstatus_to_exitcode needs Python 3.9
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    elapsed = time.perf_counter() - start_time
+    if process.returncode:
+        raise Exception(
+            f'{" ".join(args)} failed :\n{stderr.decode("utf-8")}')
+    # ru_maxrss is in KB on Linux
+    return elapsed, usage.ru_maxrss / 2**10
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=blech_clust_dir).decode('utf-8').strip()
+    except Exception:
+        return 'unknown'
+
+
+def benchmark_session(data_dir, n_process):
+    """
+    Run all stages on a generated session
+
+    Output:
+        list of (stage, seconds, peak RSS MB)
+    """
+    results = []
+    for stage, script in [
+            ('ingest', 'blech_clust.py'),
+            ('car', 'blech_common_avg_reference.py')]:
+        elapsed, peak_rss = run_stage([script, data_dir])
+        results.append((stage, elapsed, peak_rss))
+    for electrode_num in range(n_process):
+        elapsed, peak_rss = run_stage(
+            ['blech_process.py', data_dir, str(electrode_num)])
+        results.append(('process', elapsed, peak_rss))
+    return results
+
+
+def compare_to_baseline(results_frame, baseline_path, tolerance):
+    """
+    Print stages slower or more memory hungry than the median of
+    the same configuration in the baseline, by more than tolerance
+
+    Output:
+        bool, True if there were regressions
+    """
+    baseline_frame = pd.read_csv(baseline_path)
+    config_cols = ['stage', 'format', 'n_channels', 'duration', 'spike_rate']
+    baseline_median = baseline_frame.groupby(config_cols)[
+        ['seconds', 'peak_rss_mb']].median()
+    this_median = results_frame.groupby(config_cols)[
+        ['seconds', 'peak_rss_mb']].median()
+    merged = this_median.join(
+        baseline_median, rsuffix='_baseline', how='inner')
+    regressions = []
+    for col in ['seconds', 'peak_rss_mb']:
+        ratio = merged[col] / merged[col + '_baseline']
+        for config in ratio.index[ratio > 1 + tolerance]:
+            regressions.append(
+                f'{dict(zip(config_cols, config))} : {col} '
+                f'{merged.loc[config, col + "_baseline"]:.1f} -> '
+                f'{merged.loc[config, col]:.1f}')
+    if len(regressions) > 0:
+        print('=== Regressions compared to baseline ===')
+        print('\n'.join(regressions))
+    else:
+        print('No regressions compared to baseline')
+    return len(regressions) > 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time and measure memory of pipeline stages on synthetic data')
+    parser.add_argument('--formats', nargs='+', default=['channel', 'signal'],
+                        choices=['channel', 'signal', 'rhd'])
+    parser.add_argument('--n_channels', type=int, nargs='+', default=[32])
+    parser.add_argument('--duration', type=float, nargs='+', default=[600],
+                        help='Recording lengths in seconds')
+    parser.add_argument('--spike_rate', type=float, default=20)
+    parser.add_argument('--n_process', type=int, default=2,
+                        help='Number of electrodes to run blech_process.py on')
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--work_dir', help='Where to generate data, '
+                        'defaults to a temporary directory')
+    parser.add_argument('--output', default='benchmark_results.csv',
+                        help='csv to append results to')
+    parser.add_argument('--baseline', help='csv of earlier results to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fractional increase counted as a regression')
+    args = parser.parse_args()
+
+    params_template_path = os.path.join(
+        blech_clust_dir, 'params', 'sorting_params_template.json')
+    if not os.path.exists(params_template_path):
+        print('=== Sorting Params Template file not found. ===')
+        print('==> Please copy [[ blech_clust/params/_templates/sorting_params_template.json ]] to [[ blech_clust/params/sorting_params_template.json ]] and update as needed.')
+        exit()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='blech_benchmark_')
+    commit = get_git_commit()
+    all_results = []
+    for file_format in args.formats:
+        for n_channels in args.n_channels:
+            for duration in args.duration:
+                for repeat in range(args.repeats):
+                    data_dir = os.path.join(
+                        work_dir, f'bench_{file_format}_{n_channels}ch')
+                    print(f'Generating {file_format} session, {n_channels} '
+                          f'channels, {duration} s')
+                    generate_session(
+                        data_dir,
+                        file_format=file_format,
+                        n_channels=n_channels,
+                        duration=duration,
+                        spike_rate=args.spike_rate,
+                        seed=repeat)
+                    # int16 samples at the default 30 kHz
+                    channel_mb = duration * 30000 * 2 / 2**20
+                    for stage, elapsed, peak_rss in benchmark_session(
+                            data_dir, min(args.n_process, n_channels)):
+                        # blech_process.py handles a single channel
+                        stage_mb = channel_mb * \
+                            (1 if stage == 'process' else n_channels)
+                        print(f'\t{stage} : {elapsed:.1f} s, '
+                              f'peak RSS {peak_rss:.0f} MB')
+                        all_results.append({
+                            'commit': commit,
+                            'stage': stage,
+                            'format': file_format,
+                            'n_channels': n_channels,
+                            'duration': duration,
+                            'spike_rate': args.spike_rate,
+                            'repeat': repeat,
+                            'seconds': elapsed,
+                            'peak_rss_mb': peak_rss,
+                            'raw_mb_per_s': stage_mb / elapsed})
+                    shutil.rmtree(data_dir)
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+
+    results_frame = pd.DataFrame(all_results)
+    print(results_frame.groupby(['format', 'n_channels', 'duration', 'stage'])[
+        ['seconds', 'peak_rss_mb', 'raw_mb_per_s']].median())
+    write_header = not os.path.exists(args.output)
+    results_frame.to_csv(args.output, mode='a', header=write_header, index=False)
+    print(f'Results appended to {args.output}')
+
+    if args.baseline:
+        if compare_to_baseline(results_frame, args.baseline, args.tolerance):
+            exit(1)
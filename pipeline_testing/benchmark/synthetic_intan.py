@@ -0,0 +1,317 @@
+"""
+Generate synthetic Intan recordings for offline testing and benchmarking
+
+Writes a data directory which blech_clust.py can ingest without user
+input: Intan data files, an electrode layout csv and a .info file.
+Amplifier channels hold gaussian noise, common mode noise (so CAR has
+something to remove) and spikes from one unit per channel at a given
+rate. Digital inputs hold taste delivery pulses. Spike times and pulse
+onsets are saved to ground_truth.npz.
+
+Data is generated block by block, so long recordings can be
+written with little memory.
+
+Formats:
+    channel : one file per channel (amp-A-000.dat, board-DIN-00.dat)
+    signal : one file per signal type (amplifier.dat, digitalin.dat)
+    rhd : traditional Intan .rhd files
+
+For help with input arguments:
+    python synthetic_intan.py -h
+"""
+import os
+import json
+import struct
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+
+rhd_samples_per_block = 128
+
+
+def spike_template(sampling_rate, amplitude):
+    """
+    Biphasic extracellular spike, in amplifier units, 1.5 ms long
+    """
+    t = np.arange(int(1.5e-3*sampling_rate)) / sampling_rate
+    trough = -np.exp(-((t - 0.4e-3) / 0.12e-3)**2)
+    peak = 0.4*np.exp(-((t - 0.8e-3) / 0.3e-3)**2)
+    return amplitude * (trough + peak)
+
+
+def get_pulse_onsets(duration, sampling_rate, n_dig_ins, trials_per_dig_in):
+    """
+    Evenly spaced pulse onsets, taking dig-ins in turn, leaving time
+    before the first and after the last pulse for trial arrays
+    """
+    n_pulses = n_dig_ins * trials_per_dig_in
+    onsets = np.linspace(5, duration - 10, n_pulses) * sampling_rate
+    return [onsets[i::n_dig_ins].astype(int) for i in range(n_dig_ins)]
+
+
+def write_rhd_header(file, n_channels, n_dig_ins, sampling_rate):
+    """
+    Minimal version 2.0 .rhd header with amplifier channels on port A,
+    three aux inputs, one supply voltage and the digital inputs
+    """
+    def qstring(x):
+        x = x.encode('utf-16-le')
+        return struct.pack('<I', len(x)) + x
+
+    def channel(name, signal_type, order):
+        return qstring(name) + qstring(name) + struct.pack(
+            '<hhhhhhhhhhff', order, order, signal_type, 1, order, 0,
+            0, 0, 0, 0, 0, 0)
+
+    header = struct.pack('<Ihhf', 0xc6912702, 2, 0, sampling_rate)
+    header += struct.pack('<h6fh2f', 1, 1, 0.1, 7500, 1, 0.1, 7500, 0, 1000, 1000)
+    header += qstring('') * 3 + struct.pack('<hh', 0, 0) + qstring('')
+    header += struct.pack('<h', 2)
+    header += qstring('Port A') + qstring('A') + \
+        struct.pack('<hhh', 1, n_channels + 4, n_channels)
+    header += b''.join(
+        [channel(f'A-{i:03}', 0, i) for i in range(n_channels)])
+    header += b''.join([channel(f'A-AUX{i+1}', 1, i) for i in range(3)])
+    header += channel('A-VDD1', 2, 0)
+    header += qstring('Board Digital Inputs') + qstring('DIN') + \
+        struct.pack('<hhh', 1, n_dig_ins, 0)
+    header += b''.join(
+        [channel(f'DIN-{i:02}', 4, i) for i in range(n_dig_ins)])
+    file.write(header)
+
+
+def generate_session(
+        dir_name,
+        file_format='signal',
+        n_channels=32,
+        duration=600,
+        sampling_rate=30000,
+        spike_rate=20,
+        spike_amplitude=600,
+        noise_sd=50,
+        common_noise_sd=30,
+        n_dig_ins=4,
+        trials_per_dig_in=30,
+        pulse_duration=0.5,
+        emg_channels=(),
+        block_duration=10,
+        seed=0):
+    """
+    Write a synthetic session to dir_name, replacing anything there
+    (ground_truth.npz holds spike_times with the matching spike_channels,
+    and pulse_onsets as (n_dig_ins, trials_per_dig_in))
+
+    Inputs:
+        dir_name: str, basename is used for the layout and info files
+        file_format: 'channel', 'signal' or 'rhd'
+        n_channels: int, amplifier channels
+        duration: recording length in seconds
+        spike_rate: Hz, per channel
+        spike_amplitude, noise_sd, common_noise_sd: amplifier units
+            (0.195 uV each)
+        n_dig_ins, trials_per_dig_in, pulse_duration (s): taste deliveries
+        emg_channels: amplifier channels labelled as emg in the layout
+        block_duration: seconds of data generated at a time
+        seed: for np.random.default_rng
+
+    Output:
+        dict with spike_times (list per channel) and pulse_onsets
+        (list per dig-in), in samples
+    """
+    rng = np.random.default_rng(seed)
+    if os.path.exists(dir_name):
+        shutil.rmtree(dir_name)
+    os.makedirs(dir_name)
+    base_name = os.path.basename(os.path.normpath(dir_name))
+
+    n_samples = int(duration * sampling_rate)
+    if file_format == 'rhd':
+        # .rhd files only hold whole data blocks
+        n_samples -= n_samples % rhd_samples_per_block
+    template = spike_template(sampling_rate, spike_amplitude)
+    pulse_onsets = get_pulse_onsets(
+        duration, sampling_rate, n_dig_ins, trials_per_dig_in)
+    pulse_samples = int(pulse_duration * sampling_rate)
+    spike_times = [[] for i in range(n_channels)]
+
+    if file_format == 'channel':
+        amp_files = [open(os.path.join(dir_name, f'amp-A-{i:03}.dat'), 'wb')
+                     for i in range(n_channels)]
+        dig_files = [open(os.path.join(dir_name, f'board-DIN-{i:02}.dat'), 'wb')
+                     for i in range(n_dig_ins)]
+    elif file_format == 'signal':
+        amp_files = [open(os.path.join(dir_name, 'amplifier.dat'), 'wb')]
+        dig_files = [open(os.path.join(dir_name, 'digitalin.dat'), 'wb')]
+        aux_file = open(os.path.join(dir_name, 'auxiliary.dat'), 'wb')
+    elif file_format == 'rhd':
+        amp_files = [open(os.path.join(dir_name, f'{base_name}.rhd'), 'wb')]
+        write_rhd_header(amp_files[0], n_channels, n_dig_ins, sampling_rate)
+        dig_files = []
+    else:
+        raise Exception(f'Unknown format {file_format}')
+
+    block_samples = int(block_duration * sampling_rate)
+    if file_format == 'rhd':
+        block_samples -= block_samples % rhd_samples_per_block
+    for block_start in range(0, n_samples, block_samples):
+        this_samples = min(block_samples, n_samples - block_start)
+        data = rng.normal(0, noise_sd, (n_channels, this_samples))
+        data += rng.normal(0, common_noise_sd, this_samples)[None, :]
+        for channel in range(n_channels):
+            this_count = rng.poisson(spike_rate * this_samples / sampling_rate)
+            if this_samples <= len(template):
+                this_count = 0
+            this_times = np.sort(rng.integers(
+                0, max(this_samples - len(template), 1), this_count))
+            inds = this_times[:, None] + np.arange(len(template))[None, :]
+            np.add.at(data[channel], inds.ravel(), np.tile(template, this_count))
+            spike_times[channel].append(this_times + block_start)
+        data = np.clip(np.round(data), -32768, 32767).astype(np.int16)
+
+        dig_data = np.zeros((n_dig_ins, this_samples), dtype=np.uint16)
+        for dig_in, onsets in enumerate(pulse_onsets):
+            for onset in onsets - block_start:
+                dig_data[dig_in, max(onset, 0):max(onset + pulse_samples, 0)] = 1
+        dig_words = np.zeros(this_samples, dtype=np.uint16)
+        for dig_in in range(n_dig_ins):
+            dig_words |= dig_data[dig_in] << dig_in
+
+        if file_format == 'channel':
+            for channel in range(n_channels):
+                data[channel].tofile(amp_files[channel])
+            for dig_in in range(n_dig_ins):
+                dig_data[dig_in].tofile(dig_files[dig_in])
+        elif file_format == 'signal':
+            data.T.tofile(amp_files[0])
+            dig_words.tofile(dig_files[0])
+            np.zeros((this_samples // 4, 3), dtype=np.uint16).tofile(aux_file)
+        elif file_format == 'rhd':
+            n_blocks = this_samples // rhd_samples_per_block
+            block_dtype = np.dtype([
+                ('timestamps', '<i4', (rhd_samples_per_block,)),
+                ('amplifier', '<u2', (n_channels, rhd_samples_per_block)),
+                ('aux_input', '<u2', (3, rhd_samples_per_block//4)),
+                ('supply_voltage', '<u2', (1,)),
+                ('board_dig_in', '<u2', (rhd_samples_per_block,))])
+            blocks = np.zeros(n_blocks, dtype=block_dtype)
+            blocks['timestamps'] = np.arange(
+                block_start, block_start + this_samples).reshape(n_blocks, -1)
+            blocks['amplifier'] = (data.view(np.uint16) ^ np.uint16(0x8000)).\
+                reshape(n_channels, n_blocks, -1).transpose(1, 0, 2)
+            blocks['board_dig_in'] = dig_words.reshape(n_blocks, -1)
+            blocks.tofile(amp_files[0])
+
+    for this_file in amp_files + dig_files:
+        this_file.close()
+    if file_format == 'signal':
+        aux_file.close()
+    if file_format != 'rhd':
+        np.arange(n_samples, dtype=np.int32).tofile(
+            os.path.join(dir_name, 'time.dat'))
+        # .dat exports come with the header in info.rhd
+        with open(os.path.join(dir_name, 'info.rhd'), 'wb') as info_file:
+            write_rhd_header(info_file, n_channels, n_dig_ins, sampling_rate)
+
+    write_metadata(
+        dir_name, base_name, file_format, n_channels, n_dig_ins,
+        trials_per_dig_in, emg_channels)
+    spike_times = [np.concatenate(x) for x in spike_times]
+    np.savez(
+        os.path.join(dir_name, 'ground_truth.npz'),
+        spike_times=np.concatenate(spike_times),
+        spike_channels=np.repeat(
+            np.arange(n_channels), [len(x) for x in spike_times]),
+        pulse_onsets=np.array(pulse_onsets))
+    return {'spike_times': spike_times, 'pulse_onsets': pulse_onsets}
+
+
+def write_metadata(
+        dir_name, base_name, file_format, n_channels, n_dig_ins,
+        trials_per_dig_in, emg_channels):
+    """
+    Electrode layout and .info file, as blech_exp_info.py would write them
+    with every non-emg channel in a single 'gc' CAR group
+    """
+    if file_format == 'channel':
+        filenames = [f'amp-A-{i:03}.dat' for i in range(n_channels)]
+    elif file_format == 'signal':
+        filenames = ['amplifier.dat'] * n_channels
+    else:
+        filenames = [f'{base_name}.rhd'] * n_channels
+    car_groups = ['emg' if i in emg_channels else 'gc'
+                  for i in range(n_channels)]
+    layout_frame = pd.DataFrame(dict(
+        filename=filenames,
+        electrode_ind=np.arange(n_channels),
+        electrode_num=np.arange(n_channels),
+        port='A',
+        CAR_group=car_groups))
+    layout_frame.to_csv(
+        os.path.join(dir_name, base_name + '_electrode_layout.csv'),
+        index=False)
+
+    electrode_layout = {
+        'gc': [[i for i in range(n_channels) if i not in emg_channels]]}
+    if len(emg_channels) > 0:
+        electrode_layout['emg'] = [list(emg_channels)]
+    info_dict = {
+        'name': base_name,
+        'exp_type': 'synthetic',
+        'date': '000000',
+        'timestamp': '000000',
+        'regions': list(electrode_layout.keys()),
+        'ports': ['A'],
+        'dig_ins': {
+            'filenames': [],
+            'count': n_dig_ins,
+            'trial_counts': [trials_per_dig_in] * n_dig_ins},
+        'emg': {
+            'port': ['A'] if len(emg_channels) > 0 else [],
+            'electrodes': list(emg_channels)},
+        'electrode_layout': electrode_layout,
+        'taste_params': {
+            'dig_ins': list(range(n_dig_ins)),
+            'trial_count': [trials_per_dig_in] * n_dig_ins,
+            'tastes': [f'taste{i}' for i in range(n_dig_ins)],
+            'concs': [1.0] * n_dig_ins,
+            'pal_rankings': list(range(1, n_dig_ins + 1))},
+        'laser_params': {
+            'dig_in': [],
+            'onset': None,
+            'duration': None},
+        'notes': 'Synthetic data'}
+    with open(os.path.join(dir_name, base_name + '.info'), 'w') as info_file:
+        json.dump(info_dict, info_file, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic Intan recording')
+    parser.add_argument('dir_name', help='Directory to write data to')
+    parser.add_argument('--format', default='signal',
+                        choices=['channel', 'signal', 'rhd'])
+    parser.add_argument('--n_channels', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=600,
+                        help='Recording length in seconds')
+    parser.add_argument('--sampling_rate', type=int, default=30000)
+    parser.add_argument('--spike_rate', type=float, default=20,
+                        help='Spikes per second per channel')
+    parser.add_argument('--n_dig_ins', type=int, default=4)
+    parser.add_argument('--trials', type=int, default=30,
+                        help='Pulses per digital input')
+    parser.add_argument('--emg_channels', type=int, nargs='*', default=[])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_session(
+        args.dir_name,
+        file_format=args.format,
+        n_channels=args.n_channels,
+        duration=args.duration,
+        sampling_rate=args.sampling_rate,
+        spike_rate=args.spike_rate,
+        n_dig_ins=args.n_dig_ins,
+        trials_per_dig_in=args.trials,
+        emg_channels=args.emg_channels,
+        seed=args.seed)
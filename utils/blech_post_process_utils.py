@@ -527,6 +527,13 @@ def delete_raw_recordings(hdf5_name):
     print("Removing raw recordings from hdf5 file")
     print()
 
+    with tables.open_file(hdf5_name, 'r') as hf5:
+        dat_backend = '/raw_dat_map' in hf5
+    if dat_backend:
+        print("Raw recordings are read from .dat files, nothing to remove")
+        print('==============================')
+        return False
+
     try:
         with tables.open_file(hdf5_name, 'r+') as hf5:
             # Remove the raw recordings from the hdf5 file
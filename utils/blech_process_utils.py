@@ -6,6 +6,15 @@ from sklearn.mixture import GaussianMixture as gmm
 from sklearn.mixture import BayesianGaussianMixture as BGM
 from scipy.spatial.distance import mahalanobis
 from utils import blech_waveforms_datashader
+from utils.blech_utils import get_param_group
+from utils.raw_data_backend import (
+    is_dat_backend, get_referenced_channel, list_raw_channels)
+from utils.filter_utils import get_filtered_node, read_filtered, filter_chunked
+from utils.cutoff_utils import (
+    cutoff_stats_accumulator, get_cutoff_stats, calc_cutoff_values,
+    save_cutoff_stats, load_cutoff_stats)
+from utils.ingest_manifest import get_channel_fingerprint
+from utils.car_utils import car_defaults
 import subprocess
 from scipy.stats import zscore
 import pylab as plt
@@ -23,6 +32,17 @@ from sklearn.cluster import AgglomerativeClustering, KMeans
 from scipy.cluster.hierarchy import cut_tree, linkage, dendrogram
 from matplotlib.patches import ConnectionPatch
 
+# Detection settings used for keys missing from
+# params_dict['detection_params'], matching
+# params/_templates/sorting_params_template.json
+detection_defaults = {
+    'method': 'abu',
+    'noise_estimator': 'exact',
+    'noise_block_secs': 1,
+    'adaptive_window_secs': 60,
+    'batch_size': 1,
+}
+
 ############################################################
 # Define Functions
 ############################################################
@@ -785,21 +805,91 @@ class electrode_handler():
         self.params_dict = params_dict
         self.hdf5_path = hdf5_path
         self.electrode_num = electrode_num
+        # float32 halves the memory used for the filtered electrode
+        self.dtype = np.dtype(params_dict.get('processing_dtype', 'float64'))
 
         hf5 = tables.open_file(hdf5_path, 'r')
         el_path = f'/raw/electrode{electrode_num:02}'
-        if el_path in hf5:
+        self.load_cutoff_stats(hf5)
+        filtered_node = get_filtered_node(
+            hf5,
+            f'electrode{electrode_num:02}',
+            [params_dict['bandpass_lower_cutoff'],
+             params_dict['bandpass_upper_cutoff']],
+            params_dict['sampling_rate'])
+        if filtered_node is not None:
+            # Already referenced and filtered by blech_common_avg_reference.py
+            self.filt_el = read_filtered(filtered_node, self.dtype)
+            self.raw_el = None
+        elif el_path in hf5:
             self.raw_el = hf5.get_node(el_path)[:]
+        elif is_dat_backend(hf5):
+            # Raw data is read from the .dat files in place,
+            # and the common average reference subtracted here
+            self.raw_el = get_referenced_channel(
+                hf5, 'raw', f'electrode{electrode_num:02}')
         else:
             raise Exception(f'{el_path} not in HDF5')
         hf5.close()
 
+    def load_cutoff_stats(self, hf5):
+        """
+        Per second statistics saved by an earlier run on this electrode
+        (self.cutoff_stats), or None if there are none up to date.
+        Referenced data is summarized, so the statistics are checked
+        against the CAR settings as well as the ingested channel
+        """
+        name = f'electrode{self.electrode_num:02}'
+        channel = [x for x in list_raw_channels(hf5, 'raw')
+                   if x._v_name == name][0]
+        car_params = get_param_group(
+            self.params_dict, 'car_params', car_defaults)
+        self.fingerprint = '|'.join([
+            get_channel_fingerprint(hf5, channel),
+            car_params['reference_method'],
+            str(car_params['trim_fraction'])])
+        self.cutoff_stats = load_cutoff_stats(
+            os.path.dirname(self.hdf5_path),
+            name,
+            self.params_dict['sampling_rate'],
+            self.params_dict['voltage_cutoff'],
+            [self.params_dict['bandpass_lower_cutoff'],
+             self.params_dict['bandpass_upper_cutoff']],
+            channel.shape[0],
+            self.fingerprint)
+        self.saved_stats = self.cutoff_stats is not None
+
     def filter_electrode(self):
-        self.filt_el = clust.get_filtered_electrode(
+        """
+        Filter the electrode, collecting per second statistics
+        for the recording cutoff (self.cutoff_stats) on the way,
+        unless they were saved by an earlier run
+        """
+        if self.raw_el is None:
+            # Filtered data was read from /filtered
+            if not self.saved_stats:
+                self.cutoff_stats = get_cutoff_stats(
+                    self.filt_el,
+                    self.params_dict['sampling_rate'],
+                    self.params_dict['voltage_cutoff'])
+            return
+        if self.saved_stats:
+            accumulator = None
+        else:
+            accumulator = cutoff_stats_accumulator(
+                self.params_dict['sampling_rate'],
+                self.params_dict['voltage_cutoff'])
+        # Filtered in chunks so memory doesn't scale with recording length
+        self.filt_el = filter_chunked(
             self.raw_el,
             freq=[self.params_dict['bandpass_lower_cutoff'],
                   self.params_dict['bandpass_upper_cutoff']],
-            sampling_rate=self.params_dict['sampling_rate'],)
+            sampling_rate=self.params_dict['sampling_rate'],
+            chunk_samples=self.params_dict.get('bandpass_chunk_samples', 1200000),
+            dtype=self.dtype,
+            on_chunk=None if accumulator is None else accumulator.update)
+        if accumulator is not None:
+            self.cutoff_stats = accumulator.get_stats()
         # Delete raw electrode recording from memory
         del self.raw_el
 
@@ -818,18 +908,20 @@ class electrode_handler():
         self.filt_el = data[:int(sampling_rate)*int(len(data)/sampling_rate)]
 
     def calc_recording_cutoff(self):
+        """
+        Find the recording cutoff from the per second statistics
+        collected while filtering, and save them for later runs
+        """
         keywords = (
-            'filt_el',
+            'breaches_per_sec',
             'sampling_rate',
-            'voltage_cutoff',
             'max_breach_rate',
             'max_secs_above_cutoff',
             'max_mean_breach_rate_persec'
         )
         values = (
-            self.filt_el,
+            self.cutoff_stats['breaches_per_sec'],
             self.params_dict['sampling_rate'],
-            self.params_dict['voltage_cutoff'],
             self.params_dict['max_breach_rate'],
             self.params_dict['max_secs_above_cutoff'],
             self.params_dict['max_mean_breach_rate_persec'],
@@ -841,9 +933,19 @@ class electrode_handler():
             secs_above_cutoff,
             mean_breach_rate_persec,
             recording_cutoff
-        ) = return_cutoff_values(**kwarg_dict)
+        ) = calc_cutoff_values(**kwarg_dict)
 
         self.recording_cutoff = recording_cutoff
+        if not self.saved_stats:
+            save_cutoff_stats(
+                os.path.dirname(self.hdf5_path),
+                f'electrode{self.electrode_num:02}',
+                self.cutoff_stats,
+                self.params_dict['sampling_rate'],
+                self.params_dict['voltage_cutoff'],
+                [self.params_dict['bandpass_lower_cutoff'],
+                 self.params_dict['bandpass_upper_cutoff']],
+                self.fingerprint)
 
     def make_cutoff_plot(self):
         """
@@ -853,15 +955,13 @@ class electrode_handler():
         recording_cutoff: int
         """
         fig = plt.figure()
-        second_data = np.reshape(
-            self.filt_el,
-            (-1, self.params_dict['sampling_rate']))
-        plt.plot(np.mean(second_data, axis=1))
+        mean_per_sec = self.cutoff_stats['mean_per_sec']
+        plt.plot(mean_per_sec)
         plt.axvline(self.recording_cutoff,
                     color='k', linewidth=4.0, linestyle='--')
         plt.xlabel('Recording time (secs)')
         plt.ylabel('Average voltage recorded per sec (microvolts)')
-        plt.title(f'Recording length : {len(second_data)}s' + '\n' +
+        plt.title(f'Recording length : {len(mean_per_sec)}s' + '\n' +
                   f'Cutoff time : {self.recording_cutoff}s')
         fig.savefig(
             f'./Plots/{self.electrode_num:02}/cutoff_time.png',
@@ -875,6 +975,102 @@ class electrode_handler():
                                     self.params_dict['sampling_rate']]
 
 
+class electrode_group_handler():
+    """
+    Class to handle a group of electrodes processed in one process
+
+    Electrodes are filtered together, as rows of one 2-D array, and
+    spikes are detected on all of them at once (see extract_waveforms)
+    Every electrode is also available as an electrode_handler, whose
+    filt_el is a view of its row, for the per electrode steps
+    """
+
+    def __init__(self, hdf5_path, electrode_nums, params_dict):
+        self.params_dict = params_dict
+        self.electrode_nums = electrode_nums
+        self.electrodes = [
+            electrode_handler(hdf5_path, electrode_num, params_dict)
+            for electrode_num in electrode_nums]
+
+    def filter_electrodes(self):
+        """
+        Filter all electrodes along time into rows of self.filt_els
+        (electrodes already filtered in /filtered are copied in)
+        """
+        dtype = self.electrodes[0].dtype
+        raw_inds = [i for i, x in enumerate(self.electrodes)
+                    if x.raw_el is not None]
+        if len(raw_inds) == len(self.electrodes):
+            # Filled one row at a time, freeing each raw electrode as it
+            # is copied, so the raw data is only held once
+            raw_els = np.empty(
+                (len(self.electrodes), len(self.electrodes[0].raw_el)),
+                dtype=self.electrodes[0].raw_el.dtype)
+            for raw_row, electrode in zip(raw_els, self.electrodes):
+                raw_row[:] = electrode.raw_el
+                del electrode.raw_el
+            # Statistics are collected unless all were saved by an earlier run
+            if all([x.saved_stats for x in self.electrodes]):
+                accumulator = None
+            else:
+                accumulator = cutoff_stats_accumulator(
+                    self.params_dict['sampling_rate'],
+                    self.params_dict['voltage_cutoff'])
+            self.filt_els = filter_chunked(
+                raw_els,
+                freq=[self.params_dict['bandpass_lower_cutoff'],
+                      self.params_dict['bandpass_upper_cutoff']],
+                sampling_rate=self.params_dict['sampling_rate'],
+                chunk_samples=self.params_dict.get('bandpass_chunk_samples', 1200000),
+                dtype=dtype,
+                on_chunk=None if accumulator is None else accumulator.update)
+            del raw_els
+            if accumulator is not None:
+                # Rows of the statistics of all electrodes
+                group_stats = accumulator.get_stats()
+                for i, electrode in enumerate(self.electrodes):
+                    electrode.cutoff_stats = {
+                        key: val[i] for key, val in group_stats.items()}
+                    electrode.saved_stats = False
+        else:
+            for electrode in self.electrodes:
+                electrode.filter_electrode()
+            self.filt_els = np.stack([x.filt_el for x in self.electrodes])
+        for electrode, filt_el in zip(self.electrodes, self.filt_els):
+            electrode.filt_el = filt_el
+
+    def extract_waveforms(self, spike_sets):
+        """
+        Detect spikes on all electrodes at once, and hand them to the
+        spike_handler of every electrode
+
+        Inputs:
+            spike_sets: list of spike_handler, in the order of electrodes
+                (filt_el of each may have been cut short)
+        """
+        detection_params = get_param_group(
+            self.params_dict, 'detection_params', detection_defaults)
+        if detection_params['method'] != 'abu':
+            # Only the threshold crossings of extract_waveforms_abu are
+            # found for all rows at once
+            for spike_set in spike_sets:
+                spike_set.extract_waveforms()
+            return
+        noise_sds = [x.estimate_noise() for x in spike_sets]
+        if any([x is None for x in noise_sds]):
+            noise_sds = None
+        outputs = clust.extract_waveforms_batch(
+            self.filt_els,
+            [len(x.filt_el) for x in spike_sets],
+            spike_snapshot=[self.params_dict['spike_snapshot_before'],
+                            self.params_dict['spike_snapshot_after']],
+            sampling_rate=self.params_dict['sampling_rate'],
+            threshold_mult=self.params_dict['waveform_threshold'],
+            noise_sds=noise_sds)
+        for spike_set, output in zip(spike_sets, outputs):
+            spike_set.set_waveforms(*output)
+
+
 class spike_handler():
     """
     Class to handler processing of spikes
@@ -885,20 +1081,69 @@ class spike_handler():
         self.params_dict = params_dict
         self.dir_name = dir_name
         self.electrode_num = electrode_num
+        # Waveforms and features are kept in the type of the filtered data
+        self.dtype = np.dtype(params_dict.get('processing_dtype', 'float64'))
+
+    def estimate_noise(self):
+        """
+        Noise of the filtered electrode to set the threshold with,
+        None if it is to be calculated when extracting waveforms
+        """
+        detection_params = get_param_group(
+            self.params_dict, 'detection_params', detection_defaults)
+        if detection_params['noise_estimator'] == 'histogram':
+            # One pass estimate, also giving the noise of every block for QA
+            noise_sd, self.block_noise = clust.estimate_noise_streaming(
+                self.filt_el,
+                block_samples=int(detection_params['noise_block_secs'] *
+                                  self.params_dict['sampling_rate']))
+        else:
+            noise_sd = None
+            self.block_noise = None
+        return noise_sd
 
     def extract_waveforms(self):
         """
         Extract waveforms from filtered electrode
         """
-        slices, spike_times, polarity, mean_val, threshold = \
-                clust.extract_waveforms_abu(
-                        self.filt_el,
-                        spike_snapshot=[self.params_dict['spike_snapshot_before'],
-                                     self.params_dict['spike_snapshot_after']],
-                        sampling_rate=self.params_dict['sampling_rate'],
-                        threshold_mult=self.params_dict['waveform_threshold'])
-
-        self.slices = slices
+        detection_params = get_param_group(
+            self.params_dict, 'detection_params', detection_defaults)
+        method = detection_params['method']
+        noise_sd = self.estimate_noise()
+        kwargs = dict(
+            spike_snapshot=[self.params_dict['spike_snapshot_before'],
+                            self.params_dict['spike_snapshot_after']],
+            sampling_rate=self.params_dict['sampling_rate'],
+            threshold_mult=self.params_dict['waveform_threshold'])
+        if method == 'abu':
+            output = clust.extract_waveforms_abu(
+                self.filt_el, noise_sd=noise_sd, **kwargs)
+        elif method == 'abu_numba':
+            # Same spikes, found in one compiled pass
+            output = clust.extract_waveforms_numba(
+                self.filt_el, noise_sd=noise_sd, **kwargs)
+        elif method == 'adaptive':
+            # Threshold follows the noise of every block, smoothed over
+            # adaptive_window_secs
+            output = clust.extract_waveforms_adaptive(
+                self.filt_el,
+                block_samples=int(detection_params['noise_block_secs'] *
+                                  self.params_dict['sampling_rate']),
+                window_blocks=int(round(
+                    detection_params['adaptive_window_secs'] /
+                    detection_params['noise_block_secs'])),
+                block_noise=self.block_noise,
+                **kwargs)
+        else:
+            raise Exception(f'Detection method {method} not supported, '
+                            'use "abu", "abu_numba" or "adaptive"')
+        self.set_waveforms(*output)
+
+    def set_waveforms(self, slices, spike_times, polarity, mean_val, threshold):
+        """
+        Keep the output of waveform extraction
+        """
+        self.slices = slices.astype(self.dtype, copy=False)
         self.spike_times = spike_times
         self.polarity = polarity
         self.mean_val = mean_val
@@ -914,7 +1159,8 @@ class spike_handler():
             polarity=self.polarity,
             spike_snapshot=[self.params_dict['spike_snapshot_before'],
                             self.params_dict['spike_snapshot_after']],
-            sampling_rate=self.params_dict['sampling_rate'])
+            sampling_rate=self.params_dict['sampling_rate'],
+            subsample=self.params_dict.get('dejitter_subsample', False))
 
         # Sort data by time
         spike_order = np.argsort(times_dejittered)
@@ -940,6 +1186,9 @@ class spike_handler():
         else:
             self.spike_features = feature_transformer.fit_transform(
                 self.slices_dejittered)
+        # Some transformers (e.g. loaded classifier pipelines) return float64
+        self.spike_features = self.spike_features.astype(
+            self.dtype, copy=False)
 
     def return_feature(self, wanted_feature):
         wanted_inds = [i for i, x in enumerate(self.feature_names) \
@@ -949,6 +1198,33 @@ class spike_handler():
             raise Exception(f'Feature {wanted_feature} seems to have 0 shape')
         return wanted_data
 
+    def make_noise_plot(self):
+        """
+        Plot the noise level of every block of the recording, to spot
+        changes in recording quality, and save the values
+        """
+        if self.block_noise is None:
+            return
+        np.save(f'{self.dir_name}/spike_waveforms/'
+                f'electrode{self.electrode_num:02}/block_noise.npy',
+                self.block_noise)
+        block_secs = get_param_group(
+            self.params_dict, 'detection_params',
+            detection_defaults)['noise_block_secs']
+        fig = plt.figure()
+        plt.plot(np.arange(len(self.block_noise)) * block_secs,
+                 self.block_noise)
+        plt.axhline(self.threshold / self.params_dict['waveform_threshold'],
+                    color='k', linestyle='--', label='Recording noise')
+        plt.legend()
+        plt.xlabel('Recording time (secs)')
+        plt.ylabel('Noise (MAD / 0.6745, microvolts)')
+        plt.title(f'Electrode {self.electrode_num:02} noise per block')
+        fig.savefig(
+            f'./Plots/{self.electrode_num:02}/block_noise.png',
+            bbox_inches='tight')
+        plt.close(fig)
+
     def write_out_spike_data(self):
         """
         Save the pca_slices, energy and amplitudes to the
@@ -1003,31 +1279,17 @@ def return_cutoff_values(
     max_secs_above_cutoff,
     max_mean_breach_rate_persec
 ):
-
-    breach_rate = float(len(np.where(filt_el > voltage_cutoff)[0])
-                        * int(sampling_rate))/len(filt_el)
-    test_el = np.reshape(filt_el, (-1, sampling_rate))
-    breaches_per_sec = (test_el > voltage_cutoff).sum(axis=-1)
-    secs_above_cutoff = (breaches_per_sec > 0).sum()
-    if secs_above_cutoff == 0:
-        mean_breach_rate_persec = 0
-    else:
-        mean_breach_rate_persec = np.mean(breaches_per_sec[
-            breaches_per_sec > 0])
-
-    # And if they all exceed the cutoffs,
-    # assume that the headstage fell off mid-experiment
-    recording_cutoff = int(len(filt_el)/sampling_rate)
-    if breach_rate >= max_breach_rate and \
-            secs_above_cutoff >= max_secs_above_cutoff and \
-            mean_breach_rate_persec >= max_mean_breach_rate_persec:
-        # Find the first 1 second epoch where the number of cutoff breaches
-        # is higher than the maximum allowed mean breach rate
-        recording_cutoff = np.where(breaches_per_sec >
-                                    max_mean_breach_rate_persec)[0][0]
-
-    return (breach_rate, breaches_per_sec, secs_above_cutoff,
-            mean_breach_rate_persec, recording_cutoff)
+    """
+    Recording cutoff of a whole filtered channel (cut to whole seconds),
+    see cutoff_utils.calc_cutoff_values
+    """
+    cutoff_stats = get_cutoff_stats(filt_el, sampling_rate, voltage_cutoff)
+    return calc_cutoff_values(
+        cutoff_stats['breaches_per_sec'],
+        sampling_rate,
+        max_breach_rate,
+        max_secs_above_cutoff,
+        max_mean_breach_rate_persec)
 
 
 def gen_window_plots(
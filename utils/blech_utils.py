@@ -21,6 +21,13 @@ def entry_checker(msg, check_func, fail_response):
             print(fail_response)
     return msg_input, continue_bool
 
+def get_param_group(params_dict, group_name, defaults):
+    """
+    Return params_dict[group_name] with defaults filled in for missing keys,
+    as params files written before a group was added do not have it
+    """
+    return {**defaults, **params_dict.get(group_name, {})}
+
 
 class imp_metadata():
     def __init__(self, args):
@@ -0,0 +1,533 @@
+"""
+Block-wise common average referencing
+
+Each CAR group is referenced one block of time at a time. Every
+electrode of the group is read for the block, the reference is
+calculated, and the referenced block is written back, so every sample
+is read and written once. Peak memory is set by block size and the
+number of electrodes in a group, not by the length of the recording.
+
+Blocks can also be referenced by a pool of processes, see
+reference_groups_parallel.
+
+Optionally, blocks are also bandpass filtered in the same pass
+(see reference_filter_group), and the filtered signal is written to
+/filtered, so later steps don't have to filter the raw data again.
+"""
+
+import numpy as np
+import tables
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+from tqdm import tqdm
+from utils.raw_data_backend import (
+    list_raw_channels,
+    is_dat_backend,
+    create_car_reference,
+)
+from utils.filter_utils import (
+    bandpass_block,
+    create_filtered_array,
+    to_filtered_dtype,
+)
+
+# CAR settings used for keys missing from params_dict['car_params'],
+# matching params/_templates/sorting_params_template.json
+car_defaults = {
+    'block_samples': 600000,
+    'n_workers': 1,
+    'reference_method': 'mean',
+    'trim_fraction': 0.1,
+    'write_filtered': False,
+    'filtered_dtype': 'float32',
+}
+
+
+def get_block_samples(electrodes, block_samples):
+    """
+    Round block_samples up to a whole number of HDF5 chunks, so
+    writing a block never has to re-read chunks shared with its neighbours
+    """
+    chunkshape = getattr(electrodes[0], 'chunkshape', None)
+    if chunkshape is None:
+        return block_samples
+    return int(np.ceil(block_samples / chunkshape[0]) * chunkshape[0])
+
+
+def get_reference(data, method='mean', trim_fraction=0.1):
+    """
+    Common average reference of a block
+
+    median and trimmed_mean are robust to a few noisy or bridged
+    electrodes in the group. Both select values across electrodes
+    for all samples of the block at once with np.partition, rather
+    than sorting every sample
+
+    Inputs:
+        data: np.array (n_electrodes, n_samples)
+        method: 'mean', 'median' or 'trimmed_mean'
+        trim_fraction: float, fraction of electrodes dropped from
+            each end for 'trimmed_mean'
+
+    Output:
+        np.array (n_samples,), float64
+    """
+    n_electrodes = data.shape[0]
+    if method == 'mean':
+        return np.mean(data, axis=0)
+    if method == 'median':
+        middle = n_electrodes // 2
+        if n_electrodes % 2:
+            return np.partition(data, middle, axis=0)[middle].astype(np.float64)
+        selected = np.partition(data, [middle - 1, middle], axis=0)
+        return np.mean(selected[middle - 1:middle + 1], axis=0)
+    if method == 'trimmed_mean':
+        n_trim = int(trim_fraction * n_electrodes)
+        if n_trim == 0 or 2 * n_trim >= n_electrodes:
+            return np.mean(data, axis=0)
+        # Everything between the two kth values ends up between them
+        selected = np.partition(
+            data, [n_trim, n_electrodes - n_trim - 1], axis=0)
+        return np.mean(selected[n_trim:n_electrodes - n_trim], axis=0)
+    raise Exception(f'CAR method {method} not supported, '
+                    'use "mean", "median" or "trimmed_mean"')
+
+
+def subtract_reference(data, reference):
+    """
+    Subtract the reference from every electrode of a block
+
+    Raw data may be stored as int16, so referenced data is kept within
+    the range of the stored type rather than letting it wrap
+
+    Output:
+        np.array like data
+    """
+    dtype_info = np.iinfo(data.dtype)
+    referenced = np.empty_like(data)
+    for i, this_data in enumerate(data):
+        referenced[i] = np.clip(
+            this_data - reference, dtype_info.min, dtype_info.max)
+    return referenced
+
+
+def reference_group(
+        electrodes, block_samples, reference_array=None,
+        reference_params=None):
+    """
+    Common average reference a group of electrodes, block by block
+
+    Inputs:
+        electrodes: list of tables.EArray (or dat_channel), all same length
+        block_samples: int, samples per block
+        reference_array: tables.EArray, if given the electrodes are left
+            untouched and the reference is appended to it instead
+            (for read only raw data, see utils/raw_data_backend.py)
+        reference_params: dict of keyword arguments to get_reference
+    """
+    reference_params = reference_params or {}
+    n_samples = electrodes[0].shape[0]
+    block_samples = get_block_samples(electrodes, block_samples)
+    block_starts = np.arange(0, n_samples, block_samples)
+    for block_start in tqdm(block_starts):
+        block_end = min(block_start + block_samples, n_samples)
+        data = np.stack([x[block_start:block_end] for x in electrodes])
+        reference = get_reference(data, **reference_params)
+        if reference_array is not None:
+            reference_array.append(reference.astype(np.float32))
+            continue
+        referenced = subtract_reference(data, reference)
+        for electrode, this_data in zip(electrodes, referenced):
+            electrode[block_start:block_end] = this_data
+        del data, reference, referenced
+
+
+def reference_filter_block(
+        electrodes,
+        block_start,
+        block_end,
+        pad,
+        sos,
+        in_place=True,
+        left_context=None,
+        reference=True,
+        reference_params=None):
+    """
+    Reference a block of a group and bandpass filter it
+
+    pad samples either side of the block are referenced too, so the
+    block is filtered with the context it has in the whole recording.
+    Samples before the block are read from electrodes, unless
+    left_context is given (once they have been overwritten by their
+    referenced values)
+
+    Inputs:
+        electrodes: list of tables.EArray (or dat_channel), all same length
+        block_start, block_end: int
+        pad: int, samples of context, see filter_utils.get_pad_samples
+        sos: np.array, bandpass filter second order sections
+        in_place: bool, if True referenced data is kept within the type
+            of electrodes (to be written back), else it is float32,
+            as in raw_data_backend.get_referenced_channel
+        left_context: np.array (n_electrodes, pad), referenced data
+            before block_start
+        reference: bool, if False the block is only filtered (e.g. EMG)
+        reference_params: dict of keyword arguments to get_reference
+
+    Output:
+        block_reference: np.array (n_samples,), None if not referenced
+        referenced: np.array (n_electrodes, n_samples)
+        filtered: np.array (n_electrodes, n_samples), float64, microvolts
+    """
+    n_samples = electrodes[0].shape[0]
+    if left_context is None:
+        read_start = max(block_start - pad, 0)
+    else:
+        read_start = block_start
+    read_end = min(block_end + pad, n_samples)
+    data = np.stack([x[read_start:read_end] for x in electrodes])
+    block_slice = slice(block_start - read_start, block_end - read_start)
+    return reference_filter_data(
+        data,
+        block_slice,
+        sos,
+        in_place=in_place,
+        left_context=left_context,
+        reference=reference,
+        reference_params=reference_params)
+
+
+def reference_filter_data(
+        data,
+        block_slice,
+        sos,
+        in_place=True,
+        left_context=None,
+        reference=True,
+        reference_params=None):
+    """
+    Reference and bandpass filter a block already read, with the
+    context around it (see reference_filter_block)
+
+    Inputs:
+        data: np.array (n_electrodes, n_samples), raw data of the block
+            and its context
+        block_slice: slice of the block in data
+
+    Output:
+        as reference_filter_block
+    """
+    if not reference:
+        block_reference = None
+        referenced = data
+    else:
+        # Reference of the context is the same as its own block would get
+        reference_vals = get_reference(data, **(reference_params or {}))
+        if in_place:
+            referenced = subtract_reference(data, reference_vals)
+        else:
+            referenced = data - reference_vals.astype(np.float32)
+        block_reference = reference_vals[block_slice]
+    del data
+
+    if left_context is None:
+        filtered = bandpass_block(referenced, sos)[:, block_slice]
+    else:
+        filtered = bandpass_block(
+            np.concatenate([left_context, referenced], axis=1), sos)
+        filtered = filtered[:, left_context.shape[1]:][:, block_slice]
+    return block_reference, referenced[:, block_slice], filtered
+
+
+def reference_filter_group(
+        electrodes,
+        block_samples,
+        filter_settings,
+        filtered_arrays,
+        reference_array=None,
+        reference=True,
+        reference_params=None):
+    """
+    Common average reference a group of electrodes and bandpass filter
+    them, block by block, appending the filtered signal to filtered_arrays
+
+    Inputs:
+        electrodes: list of tables.EArray (or dat_channel), all same length
+        block_samples: int, samples per block
+        filter_settings: dict, from filter_utils.get_filter_settings
+        filtered_arrays: list of tables.EArray, one per electrode,
+            from filter_utils.create_filtered_array
+        reference_array: tables.EArray, if given the electrodes are left
+            untouched and the reference is appended to it instead
+        reference: bool, if False electrodes are only filtered (e.g. EMG)
+        reference_params: dict of keyword arguments to get_reference
+    """
+    n_samples = electrodes[0].shape[0]
+    pad = filter_settings['pad']
+    block_samples = max(get_block_samples(electrodes, block_samples), pad)
+    in_place = reference and reference_array is None
+    left_context = None
+    for block_start in tqdm(np.arange(0, n_samples, block_samples)):
+        block_end = min(block_start + block_samples, n_samples)
+        block_reference, referenced, filtered = reference_filter_block(
+            electrodes,
+            block_start,
+            block_end,
+            pad,
+            filter_settings['sos'],
+            in_place=in_place,
+            left_context=left_context,
+            reference=reference,
+            reference_params=reference_params)
+        if in_place:
+            for electrode, this_data in zip(electrodes, referenced):
+                electrode[block_start:block_end] = this_data
+            # Context for the next block can no longer be read unreferenced
+            left_context = referenced[:, -pad:]
+        elif reference_array is not None:
+            reference_array.append(block_reference.astype(np.float32))
+        for filtered_array, this_data in zip(filtered_arrays, filtered):
+            filtered_array.append(
+                to_filtered_dtype(this_data, filter_settings['dtype']))
+        del block_reference, referenced, filtered
+
+
+# Shared buffers of the blocks in flight, set in every worker process
+# by init_block_worker
+block_slots = None
+
+
+def init_block_worker(slots):
+    global block_slots
+    block_slots = slots
+
+
+def create_block_slots(n_slots, n_electrodes, n_data, n_block, raw_dtype,
+                       filtered_dtype=None):
+    """
+    Shared memory for blocks in flight, so blocks and their results
+    aren't copied through pipes between processes
+
+    Inputs:
+        n_electrodes: int, electrodes in the largest group
+        n_data: int, samples of a block with its context
+        n_block: int, samples of a block
+        raw_dtype: np.dtype of the raw data
+        filtered_dtype: str, stored type of filtered data, None if not filtered
+
+    Output:
+        list of (data, result, filtered) multiprocessing.RawArray per slot
+    """
+    data_bytes = n_electrodes * n_data * np.dtype(raw_dtype).itemsize
+    # Referenced data, or the reference alone (float32)
+    result_bytes = max(
+        n_electrodes * n_block * np.dtype(raw_dtype).itemsize, n_block * 4)
+    filtered_bytes = 0
+    if filtered_dtype is not None:
+        filtered_bytes = n_electrodes * n_block * np.dtype(filtered_dtype).itemsize
+    return [
+        (RawArray('b', data_bytes), RawArray('b', result_bytes),
+         RawArray('b', max(filtered_bytes, 1)))
+        for i in range(n_slots)]
+
+
+def get_slot_arrays(slot, n_electrodes, n_data, n_block, raw_dtype,
+                    reference_only, filtered_dtype=None):
+    """
+    numpy views of the buffers of a slot
+
+    Output:
+        data: (n_electrodes, n_data), raw_dtype
+        result: (n_block,) float32 if reference_only,
+            else (n_electrodes, n_block) raw_dtype
+        filtered: (n_electrodes, n_block) filtered_dtype, None if not filtered
+    """
+    data_buffer, result_buffer, filtered_buffer = slot
+    data = np.frombuffer(
+        data_buffer, raw_dtype, n_electrodes * n_data).reshape(
+        n_electrodes, n_data)
+    if reference_only:
+        result = np.frombuffer(result_buffer, np.float32, n_block)
+    else:
+        result = np.frombuffer(
+            result_buffer, raw_dtype, n_electrodes * n_block).reshape(
+            n_electrodes, n_block)
+    filtered = None
+    if filtered_dtype is not None:
+        filtered = np.frombuffer(
+            filtered_buffer, filtered_dtype, n_electrodes * n_block).reshape(
+            n_electrodes, n_block)
+    return data, result, filtered
+
+
+def reference_block_task(task):
+    """
+    Reference one block of one group, in a worker process,
+    from and to the buffers of its slot (see get_slot_arrays)
+
+    Inputs:
+        task: (slot_ind, n_electrodes, n_data, block_slice, raw_dtype,
+               reference_only, reference_params, filter_settings)
+            data holds the raw block, with filter_settings['pad'] samples
+            of context either side if the block is to be filtered
+            (filter_settings is None otherwise), see reference_filter_data
+    """
+    (slot_ind, n_electrodes, n_data, block_slice, raw_dtype, reference_only,
+     reference_params, filter_settings) = task
+    filtered_dtype = None
+    if filter_settings is not None:
+        filtered_dtype = filter_settings['dtype']
+    data, result, filtered = get_slot_arrays(
+        block_slots[slot_ind], n_electrodes, n_data,
+        block_slice.stop - block_slice.start, raw_dtype, reference_only,
+        filtered_dtype)
+    if filter_settings is None:
+        reference = get_reference(data, **reference_params)
+        if reference_only:
+            result[:] = reference
+        else:
+            result[:] = subtract_reference(data, reference)
+        return
+    block_reference, referenced, block_filtered = reference_filter_data(
+        data,
+        block_slice,
+        filter_settings['sos'],
+        in_place=not reference_only,
+        reference_params=reference_params)
+    filtered[:] = to_filtered_dtype(block_filtered, filtered_dtype)
+    if reference_only:
+        result[:] = block_reference
+    else:
+        result[:] = referenced
+
+
+def reference_groups_parallel(
+        hdf5_name, groups, block_samples, n_workers,
+        filter_settings=None, reference_params=None):
+    """
+    Common average reference all groups with a pool of processes
+
+    Work is split into (group, time block) tasks. This process keeps
+    the HDF5 file open, reads each block and writes back its result,
+    while workers reference (and filter) the blocks read before it.
+    HDF5 files can't be read by other processes while they are
+    written, so workers only get data in memory: blocks and results
+    are passed in n_workers + 2 shared memory slots (see
+    create_block_slots), which also bound memory. Results are written
+    in task order, so references and filtered data are appended in order.
+
+    For filtering, blocks are read with pad samples of context either
+    side. Context before a block is kept from the (raw) block before
+    it, as that has been overwritten with referenced data by then.
+
+    Reading and writing in this process limit how far this scales,
+    see pipeline_testing/benchmark/car_benchmark.py
+
+    Inputs:
+        hdf5_name: str
+        groups: list of (group_name, electrode_inds)
+        block_samples: int, samples per block
+        n_workers: int, number of processes
+        filter_settings: dict, from filter_utils.get_filter_settings,
+            if given blocks are also filtered and written to /filtered
+        reference_params: dict of keyword arguments to get_reference
+    """
+    reference_params = reference_params or {}
+    with tables.open_file(hdf5_name, 'r') as hf5:
+        raw_electrodes = list_raw_channels(hf5, 'raw')
+        n_samples = raw_electrodes[0].shape[0]
+        raw_dtype = raw_electrodes[0].dtype
+        block_samples = get_block_samples(raw_electrodes, block_samples)
+    pad = 0
+    filtered_dtype = None
+    if filter_settings is not None:
+        pad = filter_settings['pad']
+        filtered_dtype = filter_settings['dtype']
+        block_samples = max(block_samples, pad)
+    n_slots = n_workers + 2
+    slots = create_block_slots(
+        n_slots, max([len(x[1]) for x in groups]), block_samples + 2*pad,
+        block_samples, raw_dtype, filtered_dtype)
+
+    # Started before the file is opened, so workers don't inherit it
+    with Pool(n_workers, initializer=init_block_worker, initargs=(slots,)) \
+            as pool, tables.open_file(hdf5_name, 'r+') as hf5:
+        dat_backend = is_dat_backend(hf5)
+        channels = {x._v_name: x for x in list_raw_channels(hf5, 'raw')}
+        if dat_backend:
+            print('Raw data is read from .dat files, writing references to HDF5')
+            for group_name, electrode_inds in groups:
+                create_car_reference(hf5, group_name, electrode_inds, n_samples)
+        if filter_settings is not None:
+            for group_name, electrode_inds in groups:
+                for electrode_ind in electrode_inds:
+                    create_filtered_array(
+                        hf5, f'electrode{electrode_ind:02}', n_samples,
+                        filter_settings['freq'],
+                        filter_settings['sampling_rate'],
+                        filter_settings['dtype'])
+
+        block_starts = np.arange(0, n_samples, block_samples)
+        progress = tqdm(total=len(groups) * len(block_starts))
+        # (group_name, electrode_names, block_start, block_end,
+        #  slot arrays, AsyncResult) of blocks in flight, in task order
+        pending = deque()
+        task_num = 0
+        for group_name, electrode_inds in groups:
+            electrode_names = [f'electrode{x:02}' for x in electrode_inds]
+            electrodes = [channels[x] for x in electrode_names]
+            left_raw = np.empty((len(electrodes), 0), dtype=raw_dtype)
+            for block_start in block_starts:
+                # Slots are used in turn, so wait for the result
+                # last held by this one to be written
+                while len(pending) >= n_slots:
+                    write_block_result(hf5, dat_backend, *pending.popleft())
+                    progress.update(1)
+                slot_ind = task_num % n_slots
+                task_num += 1
+                block_end = min(block_start + block_samples, n_samples)
+                read_end = min(block_end + pad, n_samples)
+                n_left = left_raw.shape[1]
+                n_data = n_left + read_end - block_start
+                block_slice = slice(n_left, n_left + block_end - block_start)
+                data, result, filtered = get_slot_arrays(
+                    slots[slot_ind], len(electrodes), n_data,
+                    block_end - block_start, raw_dtype, dat_backend,
+                    filtered_dtype)
+                data[:, :n_left] = left_raw
+                for this_data, electrode in zip(data, electrodes):
+                    this_data[n_left:] = electrode[block_start:read_end]
+                if pad > 0:
+                    left_raw = data[:, block_slice][:, -pad:].copy()
+                pending.append((
+                    group_name, electrode_names, block_start, block_end,
+                    result, filtered,
+                    pool.apply_async(
+                        reference_block_task,
+                        ((slot_ind, len(electrodes), n_data, block_slice,
+                          raw_dtype, dat_backend, reference_params,
+                          filter_settings),))))
+        while len(pending) > 0:
+            write_block_result(hf5, dat_backend, *pending.popleft())
+            progress.update(1)
+        progress.close()
+        hf5.flush()
+
+
+def write_block_result(
+        hf5, dat_backend, group_name, electrode_names, block_start,
+        block_end, result, filtered, async_result):
+    """
+    Write the result of reference_block_task for a block back to hf5,
+    once it is done
+    """
+    async_result.get()
+    if filtered is not None:
+        for name, this_data in zip(electrode_names, filtered):
+            hf5.get_node('/filtered', name).append(this_data)
+    if dat_backend:
+        hf5.get_node('/car_reference', group_name).append(result)
+        return
+    for name, this_data in zip(electrode_names, result):
+        hf5.get_node('/raw', name)[block_start:block_end] = this_data
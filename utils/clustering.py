@@ -7,6 +7,7 @@ import pylab as plt
 from sklearn.decomposition import PCA
 from scipy.signal import fftconvolve
 from sklearn.cluster import KMeans
+from numba import jit
 
 def get_filtered_electrode(data, freq = [300.0, 3000.0], sampling_rate = 30000.0):
 		el = 0.195*(data)
@@ -14,31 +15,127 @@ def get_filtered_electrode(data, freq = [300.0, 3000.0], sampling_rate = 30000.0
 		filt_el = filtfilt(m, n, el)
 		return filt_el
 
+def get_run_extrema(data, inds, func, row_inds = None):
+		"""
+		Find the extremum of every run of consecutive indices in inds,
+		for all runs at once
+
+		Inputs:
+			data: np.array, 1-D
+			inds: sorted np.array of indices into data (threshold crossings)
+			func: np.minimum or np.maximum
+			row_inds: np.array like inds, if data is a flattened 2-D array,
+				the row of every index, so runs don't continue across rows
+
+		Output:
+			np.array, index (into data) of the first extremum of every
+			run, except the last run of every row (as only runs followed
+			by another one are marked as complete)
+		"""
+		if len(inds) == 0:
+				return np.zeros(0, dtype = np.int64)
+		# Marking breaks in detected threshold crossings 
+		breaks = np.diff(inds) > 1
+		if row_inds is not None:
+				breaks |= np.diff(row_inds) != 0
+		run_starts = np.concatenate(([0],np.where(breaks)[0]+1))
+		# Only runs followed by another run in the same row are complete
+		if row_inds is None:
+				complete = np.arange(len(run_starts)) < len(run_starts) - 1
+		else:
+				run_rows = row_inds[run_starts]
+				complete = np.append(run_rows[1:] == run_rows[:-1], False)
+		values = data[inds]
+		run_extrema = func.reduceat(values, run_starts)
+		run_ids = np.repeat(
+				np.arange(len(run_starts)), np.diff(np.append(run_starts, len(inds))))
+		# First sample of every run equal to the extremum, like argmin/argmax
+		is_extremum = np.where(values == run_extrema[run_ids])[0]
+		first_extremum = np.concatenate(
+				([True], run_ids[is_extremum][1:] != run_ids[is_extremum][:-1]))
+		return inds[is_extremum[first_extremum][complete]]
+
+def get_hist_median(hist, bins_per_octave, min_octave):
+		"""
+		Median of the values counted in log spaced bins by
+		estimate_noise_streaming, interpolating within its bin
+		"""
+		cum_hist = np.cumsum(hist)
+		target = cum_hist[-1] / 2
+		median_bin = np.searchsorted(cum_hist, target)
+		bin_count = hist[median_bin]
+		bin_fraction = (target - (cum_hist[median_bin] - bin_count)) / bin_count
+		return 2**((median_bin + bin_fraction) / bins_per_octave + min_octave)
+
+def estimate_noise_streaming(filt_el, block_samples = 30000,
+							 bins_per_octave = 1024, min_octave = -16, n_octaves = 40):
+		"""
+		Estimate the noise (median absolute value / 0.6745) of a filtered
+		electrode, and of every block of it, in one pass without sorting,
+		or making an absolute valued copy of the whole recording
+
+		Absolute values of every block are counted in log spaced bins
+		(bins_per_octave per doubling, from 2**min_octave). The median of
+		a block is read off its histogram, and the median of the recording
+		off the sum of all of them, interpolating within the median bin.
+		With the defaults, estimates are within ~0.1% of the exact median.
+
+		Inputs:
+			filt_el: np.array, filtered electrode (microvolts)
+			block_samples: int, samples per block
+
+		Outputs:
+			noise_sd: float
+			block_noise: np.array (n_blocks,), noise of every block
+		"""
+		n_bins = bins_per_octave * n_octaves
+		hist = np.zeros(n_bins, dtype = np.int64)
+		block_noise = []
+		for block_start in range(0, len(filt_el), block_samples):
+				abs_block = np.abs(filt_el[block_start:block_start + block_samples])
+				with np.errstate(divide = 'ignore'):
+						bin_inds = (np.log2(abs_block) - min_octave) * bins_per_octave
+				bin_inds = np.clip(np.nan_to_num(bin_inds, neginf = 0), 0, n_bins - 1)
+				block_hist = np.bincount(bin_inds.astype(np.int64), minlength = n_bins)
+				block_noise.append(
+						get_hist_median(block_hist, bins_per_octave, min_octave)/0.6745)
+				hist += block_hist
+		median = get_hist_median(hist, bins_per_octave, min_octave)
+		return median/0.6745, np.array(block_noise)
+
 def extract_waveforms_abu(filt_el, spike_snapshot = [0.5, 1.0], 
 								    sampling_rate = 30000.0,
-								    threshold_mult = 5.0):
+								    threshold_mult = 5.0,
+								    noise_sd = None):
+		"""
+		noise_sd: if given (e.g. from estimate_noise_streaming), used
+			instead of calculating the median absolute value of filt_el
+		"""
 
 		m = np.mean(filt_el)
-		th = threshold_mult*np.median(np.abs(filt_el)/0.6745)
+		if noise_sd is None:
+				noise_sd = np.median(np.abs(filt_el)/0.6745)
+		th = threshold_mult*noise_sd
 
 		negative = np.where(filt_el <= m-th)[0] 
 		positive = np.where(filt_el >= m+th)[0] 
-		# Marking breaks in detected threshold crossings 
-		neg_changes = np.concatenate(([0],np.where(np.diff(negative) > 1)[0]+1))
-		pos_changes = np.concatenate(([0],np.where(np.diff(positive) > 1)[0]+1))
-		
-		# Mark indices to be extracted
-		neg_inds = [(negative[neg_changes[x]],negative[neg_changes[x+1]-1]) \
-				for x in range(len(neg_changes)-1)]
-		pos_inds = [(positive[pos_changes[x]],positive[pos_changes[x+1]-1]) \
-				for x in range(len(pos_changes)-1)]
 
 		# Mark the extremum of every threshold crossing
-		minima = [np.argmin(filt_el[start:(end+1)]) + start \
-				for start,end in neg_inds]
-		maxima = [np.argmax(filt_el[start:(end+1)]) + start \
-				for start,end in pos_inds]
+		minima = get_run_extrema(filt_el, negative, np.minimum)
+		maxima = get_run_extrema(filt_el, positive, np.maximum)
 
+		slices, spike_times, polarity = get_snippets(
+				filt_el, minima, maxima, spike_snapshot, sampling_rate)
+		return slices, spike_times, polarity, m, th
+
+def get_snippets(filt_el, minima, maxima, spike_snapshot, sampling_rate):
+		"""
+		Cut out waveforms around negative (minima) and positive (maxima)
+		spikes, dropping spikes too close to the ends of filt_el
+
+		Output:
+			slices, spike_times, polarity
+		"""
 		polarity = np.concatenate(([-1]*len(minima),[1]*len(maxima)))
 
 		spike_times = np.concatenate((minima,maxima))
@@ -51,11 +148,241 @@ def extract_waveforms_abu(filt_el, spike_snapshot = [0.5, 1.0],
 		# Make sure event has required window around it
 		relevant_inds = (before_inds > 0) * (after_inds < len(filt_el))
 		before_inds = before_inds[relevant_inds]
-		after_inds = after_inds[relevant_inds]
-		slices = np.array([filt_el[start:end] \
-				for start,end in zip(before_inds,after_inds)])
+		# Every snippet is a row of samples indexed from its start
+		slices = filt_el[before_inds[:, None] +
+				np.arange(needed_before + needed_after)]
 
-		return slices, spike_times[relevant_inds], polarity[relevant_inds], m, th
+		return slices, spike_times[relevant_inds], polarity[relevant_inds]
+
+@jit(nopython = True, nogil = True, cache = True)
+def _append_time(times, count, t):
+		"""
+		Set times[count] = t, doubling the size of times if it is full
+		"""
+		if count == len(times):
+				grown = np.empty(2*count, dtype = np.int64)
+				grown[:count] = times
+				times = grown
+		times[count] = t
+		return times
+
+@jit(nopython = True, nogil = True, cache = True)
+def _detect_and_snip(filt_el, lower, upper, needed_before, needed_after):
+		"""
+		Single pass over filt_el, marking the first extremum of every
+		run of samples beyond lower (negative) or upper (positive),
+		then cutting snippets around them into a preallocated array.
+		Matches get_run_extrema + get_snippets: the last run of each
+		polarity is not complete, and is dropped
+		"""
+		n_samples = len(filt_el)
+		minima = np.empty(1024, dtype = np.int64)
+		maxima = np.empty(1024, dtype = np.int64)
+		n_minima = 0
+		n_maxima = 0
+		# Extremum of the current (or last) run of each polarity, -1 if none
+		min_time = -1
+		max_time = -1
+		min_value = lower
+		max_value = upper
+		in_neg = False
+		in_pos = False
+		for i in range(n_samples):
+				x = filt_el[i]
+				if x <= lower:
+						if not in_neg:
+								# A new run completes the previous one
+								if min_time >= 0:
+										minima = _append_time(minima, n_minima, min_time)
+										n_minima += 1
+								in_neg = True
+								min_time = i
+								min_value = x
+						elif x < min_value:
+								min_time = i
+								min_value = x
+				else:
+						in_neg = False
+				if x >= upper:
+						if not in_pos:
+								if max_time >= 0:
+										maxima = _append_time(maxima, n_maxima, max_time)
+										n_maxima += 1
+								in_pos = True
+								max_time = i
+								max_value = x
+						elif x > max_value:
+								max_time = i
+								max_value = x
+				else:
+						in_pos = False
+
+		# Keep events with the required window around them
+		spike_times = np.empty(n_minima + n_maxima, dtype = np.int64)
+		polarity = np.empty(n_minima + n_maxima, dtype = np.int64)
+		n_kept = 0
+		for j in range(n_minima + n_maxima):
+				if j < n_minima:
+						t = minima[j]
+				else:
+						t = maxima[j - n_minima]
+				if t - needed_before > 0 and t + needed_after < n_samples:
+						spike_times[n_kept] = t
+						polarity[n_kept] = -1 if j < n_minima else 1
+						n_kept += 1
+		slices = np.empty((n_kept, needed_before + needed_after), dtype = filt_el.dtype)
+		for j in range(n_kept):
+				start = spike_times[j] - needed_before
+				for k in range(needed_before + needed_after):
+						slices[j, k] = filt_el[start + k]
+		return slices, spike_times[:n_kept], polarity[:n_kept]
+
+def extract_waveforms_numba(filt_el, spike_snapshot = [0.5, 1.0], 
+								    sampling_rate = 30000.0,
+								    threshold_mult = 5.0,
+								    noise_sd = None):
+		"""
+		Same as extract_waveforms_abu, but threshold crossings are
+		found, and snippets cut, in one compiled pass over filt_el,
+		without the index arrays of every crossing sample.
+		Compiled on first use (and cached to disk)
+		"""
+		m = np.mean(filt_el)
+		if noise_sd is None:
+				noise_sd = np.median(np.abs(filt_el)/0.6745)
+		th = threshold_mult*noise_sd
+
+		needed_before = int((spike_snapshot[0] + 0.1)*(sampling_rate/1000.0))
+		needed_after = int((spike_snapshot[1]+ 0.1)*(sampling_rate/1000.0))
+		# Bounds are compared in the type of the data, as in extract_waveforms_abu
+		slices, spike_times, polarity = _detect_and_snip(
+				np.ascontiguousarray(filt_el),
+				filt_el.dtype.type(m - th), filt_el.dtype.type(m + th),
+				needed_before, needed_after)
+		return slices, spike_times, polarity, m, th
+
+def extract_waveforms_batch(filt_els, lengths, spike_snapshot = [0.5, 1.0], 
+								    sampling_rate = 30000.0,
+								    threshold_mult = 5.0,
+								    noise_sds = None):
+		"""
+		extract_waveforms_abu for many electrodes in one go, with
+		threshold crossings and their extrema found for all rows at once
+
+		Inputs:
+			filt_els: np.array (n_electrodes, n_samples), filtered electrodes
+			lengths: samples to use from the start of every row
+			noise_sds: noise of every row, if None calculated as in
+				extract_waveforms_abu
+
+		Output:
+			list of outputs of extract_waveforms_abu, one per row
+		"""
+		n_rows, n_samples = filt_els.shape
+		lengths = np.asarray(lengths)
+		means = [np.mean(x[:length]) for x, length in zip(filt_els, lengths)]
+		if noise_sds is None:
+				noise_sds = [np.median(np.abs(x[:length])/0.6745) 
+						for x, length in zip(filt_els, lengths)]
+		ths = [threshold_mult*noise_sd for noise_sd in noise_sds]
+		flat_els = filt_els.reshape(-1)
+
+		# Bounds are calculated per row, and compared in the type of the
+		# data, exactly as the scalar bounds of extract_waveforms_abu
+		row_extrema = []
+		for bounds, compare, func in [
+						([m - th for m, th in zip(means, ths)], np.less_equal, np.minimum),
+						([m + th for m, th in zip(means, ths)], np.greater_equal, np.maximum)]:
+				bounds = np.array(bounds).astype(filt_els.dtype)
+				rows, cols = np.nonzero(compare(filt_els, bounds[:,None]))
+				keep = cols < lengths[rows]
+				rows, cols = rows[keep], cols[keep]
+				extrema = get_run_extrema(
+						flat_els, rows*n_samples + cols, func, row_inds = rows)
+				extrema_rows = extrema // n_samples
+				row_extrema.append(
+						[extrema[extrema_rows == i] - i*n_samples for i in range(n_rows)])
+
+		outputs = []
+		for i in range(n_rows):
+				slices, spike_times, polarity = get_snippets(
+						filt_els[i, :lengths[i]], row_extrema[0][i], row_extrema[1][i],
+						spike_snapshot, sampling_rate)
+				outputs.append((slices, spike_times, polarity, means[i], ths[i]))
+		return outputs
+
+def rolling_median(values, window):
+		"""
+		Centred running median of values over window entries,
+		over fewer entries at the ends
+		"""
+		half = int(window)//2
+		if half == 0 or len(values) == 0:
+				return np.asarray(values, dtype = np.float64)
+		padded = np.pad(np.asarray(values, dtype = np.float64), half,
+				constant_values = np.nan)
+		windows = padded[np.arange(len(values))[:, None] +
+				np.arange(2*half + 1)]
+		return np.nanmedian(windows, axis = 1)
+
+def extract_waveforms_adaptive(filt_el, spike_snapshot = [0.5, 1.0], 
+								    sampling_rate = 30000.0,
+								    threshold_mult = 5.0,
+								    block_samples = 30000,
+								    window_blocks = 60,
+								    block_noise = None,
+								    chunk_samples = 2**20):
+		"""
+		Threshold crossings with a threshold that follows slow changes
+		in the mean and noise of a nonstationary recording
+
+		The mean and noise (median absolute value / 0.6745) of every
+		block are smoothed with a running median over window_blocks
+		blocks, so a burst of spikes doesn't lift the threshold, and
+		interpolated linearly between block centres to give the bounds
+		of every sample. Bounds are made chunk_samples at a time.
+
+		Inputs:
+			block_noise: np.array (n_blocks,), noise of every block of
+				block_samples (e.g. from estimate_noise_streaming),
+				calculated if None
+
+		Outputs:
+			as extract_waveforms_abu, with the mean of filt_el and the
+			median threshold over blocks as m and th
+		"""
+		n_samples = len(filt_el)
+		block_starts = np.arange(0, n_samples, block_samples)
+		block_lens = np.diff(np.append(block_starts, n_samples))
+		block_means = np.add.reduceat(
+				filt_el, block_starts, dtype = np.float64) / block_lens
+		if block_noise is None:
+				block_noise = np.array([
+						np.median(np.abs(filt_el[start:start + block_samples]))/0.6745
+						for start in block_starts])
+		m = np.sum(block_means * block_lens) / n_samples
+		smooth_means = rolling_median(block_means, window_blocks)
+		smooth_ths = threshold_mult*rolling_median(block_noise, window_blocks)
+		th = np.median(smooth_ths)
+		block_centres = block_starts + (block_lens - 1)/2
+
+		negative = []
+		positive = []
+		for chunk_start in range(0, n_samples, chunk_samples):
+				chunk = filt_el[chunk_start:chunk_start + chunk_samples]
+				inds = np.arange(chunk_start, chunk_start + len(chunk))
+				lower = np.interp(inds, block_centres, smooth_means - smooth_ths)
+				upper = np.interp(inds, block_centres, smooth_means + smooth_ths)
+				negative.append(np.where(chunk <= lower)[0] + chunk_start)
+				positive.append(np.where(chunk >= upper)[0] + chunk_start)
+
+		# Runs continue across chunks, as indices are into filt_el
+		minima = get_run_extrema(filt_el, np.concatenate(negative), np.minimum)
+		maxima = get_run_extrema(filt_el, np.concatenate(positive), np.maximum)
+
+		slices, spike_times, polarity = get_snippets(
+				filt_el, minima, maxima, spike_snapshot, sampling_rate)
+		return slices, spike_times, polarity, m, th
 
 def extract_waveforms_hannah(filt_el, spike_snapshot = [0.5, 1.0], 
 								    sampling_rate = 30000.0,
@@ -198,10 +525,17 @@ def dejitter_abu3(slices,
 				spike_times, 
 				polarity,
 				spike_snapshot = [0.5, 1.0], 
-				sampling_rate = 30000.0):
+				sampling_rate = 30000.0,
+				subsample = False):
 
 		"""
 		Dejitter without interpolation and see what breaks :P
+
+		Windows around the minimum of every spike (maximum for positive
+		spikes) are gathered from slices in one indexing operation.
+		If subsample is True, the minimum is located between samples by
+		fitting a parabola through it and its neighbours, and windows
+		are linearly interpolated to start at that point
 		"""
 		# Calculate the number of samples to be sliced 
 		#out around each spike's minimum
@@ -210,12 +544,8 @@ def dejitter_abu3(slices,
 
 		# Determine positive or negative spike and flip
 		# positive spikes so everything is aligned by minimum
-		# Then flip positive spikes back to being positive
-		flipped_slices = np.copy(slices)
-		flipped_slices[polarity > 0] *= -1
-
-		#interp_slices = np.array([interp1d(x, this_slice)(xnew) \
-		#		for this_slice in flipped_slices])
+		# (only the part used to find the minima is flipped)
+		flip = np.where(polarity > 0, -1, 1).astype(slices.dtype)[:,None]
 
 		# Cut out part around focus of spike snapshot to use
 		# for finding minima
@@ -225,18 +555,37 @@ def dejitter_abu3(slices,
 		# We will use 0.1ms around the minimum to dejitter the spike 
 		cut_radius = 3
 		cut_tuple = (int((before) + (cut_radius/2)), 
-				int(flipped_slices.shape[1] - (after) - (cut_radius/2)))
+				int(slices.shape[1] - (after) - (cut_radius/2)))
+		flipped_cut = slices[:,cut_tuple[0]:cut_tuple[1]] * flip
 		# minima will tell us how much each spike needs to be shifted
-		minima = np.argmin(flipped_slices[:,cut_tuple[0]:cut_tuple[1]],
-						axis=-1) + (before) + (cut_radius/2) 
-
-		# Extract windows AROUND minima
-		slices_dejittered = np.array([this_slice[\
-		    int(this_min - (before)) : int(this_min + (after))] \
-		    for this_slice, this_min in zip(flipped_slices, minima)])
-
-		# Flip positive slices
-		slices_dejittered[polarity > 0] *= -1
+		minima = np.argmin(flipped_cut, axis=-1)
+
+		# Windows AROUND minima start (before) samples before the minimum
+		window_starts = minima + cut_tuple[0] - before
+		window_inds = np.arange(before + after)
+		rows = np.arange(len(slices))[:,None]
+		if not subsample:
+				slices_dejittered = slices[rows, window_starts[:,None] + window_inds]
+				return slices_dejittered, spike_times
+
+		# Vertex of the parabola through the minimum and its neighbours
+		# (which can be outside the cut), within half a sample of the minimum
+		neighbours = slices[rows, 
+				(minima + cut_tuple[0])[:,None] + np.arange(-1, 2)] * flip
+		y_prev, y_min, y_next = neighbours.T
+		curvature = y_prev - 2*y_min + y_next
+		offsets = np.divide(0.5*(y_prev - y_next), curvature,
+				out = np.zeros(len(curvature), dtype = curvature.dtype),
+				where = curvature > 0)
+		offsets = np.clip(offsets, -0.5, 0.5)
+		positions = window_starts + offsets
+		base = np.floor(positions).astype(int)
+		fraction = (positions - base).astype(slices.dtype)[:,None]
+		window_cols = np.clip(base[:,None] + window_inds, 0, slices.shape[1] - 1)
+		next_cols = np.minimum(window_cols + 1, slices.shape[1] - 1)
+		slices_dejittered = slices[rows, window_cols]
+		slices_dejittered *= (1 - fraction)
+		slices_dejittered += fraction * slices[rows, next_cols]
 
 		return slices_dejittered, spike_times
 
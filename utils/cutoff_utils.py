@@ -0,0 +1,172 @@
+"""
+Per second statistics of filtered channels, used to find when the
+headstage fell off (the recording cutoff)
+
+Statistics are accumulated chunk by chunk while a channel is filtered
+(see filter_utils.filter_chunked), rather than by reshaping the whole
+filtered channel again for every statistic. They are saved per channel
+in cutoff_stats/{channel}.npz in the data directory, so later steps
+(cutoff plots, blech_make_arrays.py) reuse them instead of filtering
+the channel again.
+"""
+
+import os
+import numpy as np
+
+
+class cutoff_stats_accumulator():
+    """
+    Count voltage cutoff breaches and average voltage every second,
+    of data fed in consecutive chunks along the last axis
+
+    Incomplete seconds are held until the next chunk, and the
+    incomplete second at the end of the data is ignored, as the
+    recording is cut to whole seconds before the cutoff is used
+    """
+
+    def __init__(self, sampling_rate, voltage_cutoff):
+        self.sampling_rate = int(sampling_rate)
+        self.voltage_cutoff = voltage_cutoff
+        self.breaches_per_sec = []
+        self.mean_per_sec = []
+        self.leftover = None
+
+    def update(self, chunk):
+        """
+        Inputs:
+            chunk: np.array (..., n_samples), next samples of the data
+        """
+        if self.leftover is not None and self.leftover.shape[-1] > 0:
+            chunk = np.concatenate([self.leftover, chunk], axis=-1)
+        n_secs = chunk.shape[-1] // self.sampling_rate
+        whole_secs = n_secs * self.sampling_rate
+        second_data = chunk[..., :whole_secs].reshape(
+            chunk.shape[:-1] + (n_secs, self.sampling_rate))
+        self.breaches_per_sec.append(
+            (second_data > self.voltage_cutoff).sum(axis=-1))
+        self.mean_per_sec.append(np.mean(second_data, axis=-1))
+        self.leftover = chunk[..., whole_secs:].copy()
+
+    def get_stats(self):
+        """
+        Output:
+            dict of np.array (..., n_secs), breaches_per_sec and mean_per_sec
+        """
+        return dict(
+            breaches_per_sec=np.concatenate(self.breaches_per_sec, axis=-1),
+            mean_per_sec=np.concatenate(self.mean_per_sec, axis=-1),
+        )
+
+
+def get_cutoff_stats(filt_el, sampling_rate, voltage_cutoff):
+    """
+    Per second statistics of a whole filtered channel
+    """
+    accumulator = cutoff_stats_accumulator(sampling_rate, voltage_cutoff)
+    accumulator.update(filt_el)
+    return accumulator.get_stats()
+
+
+def calc_cutoff_values(
+    breaches_per_sec,
+    sampling_rate,
+    max_breach_rate,
+    max_secs_above_cutoff,
+    max_mean_breach_rate_persec
+):
+    """
+    Decide when the recording was cut off from breaches per second
+    (same outputs as blech_process_utils.return_cutoff_values)
+
+    Output:
+        breach_rate, breaches_per_sec, secs_above_cutoff,
+        mean_breach_rate_persec, recording_cutoff (secs)
+    """
+    n_secs = len(breaches_per_sec)
+    breach_rate = float(int(np.sum(breaches_per_sec)) * int(sampling_rate)) \
+        / (n_secs * int(sampling_rate))
+    secs_above_cutoff = (breaches_per_sec > 0).sum()
+    if secs_above_cutoff == 0:
+        mean_breach_rate_persec = 0
+    else:
+        mean_breach_rate_persec = np.mean(breaches_per_sec[
+            breaches_per_sec > 0])
+
+    # And if they all exceed the cutoffs,
+    # assume that the headstage fell off mid-experiment
+    recording_cutoff = n_secs
+    if breach_rate >= max_breach_rate and \
+            secs_above_cutoff >= max_secs_above_cutoff and \
+            mean_breach_rate_persec >= max_mean_breach_rate_persec:
+        # Find the first 1 second epoch where the number of cutoff breaches
+        # is higher than the maximum allowed mean breach rate
+        recording_cutoff = np.where(breaches_per_sec >
+                                    max_mean_breach_rate_persec)[0][0]
+
+    return (breach_rate, breaches_per_sec, secs_above_cutoff,
+            mean_breach_rate_persec, recording_cutoff)
+
+
+def get_stats_path(data_dir, name):
+    return os.path.join(data_dir, 'cutoff_stats', f'{name}.npz')
+
+
+def save_cutoff_stats(data_dir, name, stats, sampling_rate, voltage_cutoff, freq,
+                      fingerprint=''):
+    """
+    Save per second statistics of a channel, with the parameters
+    they depend on
+
+    Inputs:
+        data_dir: str, data directory
+        name: str, e.g. 'electrode00' or 'emg08'
+        stats: dict from cutoff_stats_accumulator.get_stats
+        freq: [lower, upper] bandpass cutoffs the channel was filtered with
+        fingerprint: str, of the ingested channel,
+            from ingest_manifest.get_channel_fingerprint
+    """
+    stats_path = get_stats_path(data_dir, name)
+    os.makedirs(os.path.dirname(stats_path), exist_ok=True)
+    np.savez(
+        stats_path,
+        breaches_per_sec=stats['breaches_per_sec'],
+        mean_per_sec=stats['mean_per_sec'],
+        sampling_rate=int(sampling_rate),
+        voltage_cutoff=float(voltage_cutoff),
+        freq=[float(x) for x in freq],
+        fingerprint=fingerprint,
+    )
+
+
+def load_cutoff_stats(data_dir, name, sampling_rate, voltage_cutoff, freq,
+                      n_samples, fingerprint=''):
+    """
+    Load saved per second statistics of a channel, if there are some
+    calculated with the same parameters, from the same ingested data
+
+    Inputs:
+        n_samples: int, length of the channel now
+        fingerprint: str, of the ingested channel now,
+            from ingest_manifest.get_channel_fingerprint
+
+    Output:
+        dict like cutoff_stats_accumulator.get_stats, or None
+    """
+    stats_path = get_stats_path(data_dir, name)
+    if not os.path.exists(stats_path):
+        return None
+    saved = np.load(stats_path)
+    if int(saved['sampling_rate']) != int(sampling_rate) or \
+            float(saved['voltage_cutoff']) != float(voltage_cutoff) or \
+            list(saved['freq']) != [float(x) for x in freq]:
+        return None
+    # Data ingested again since (e.g. changed files on a resumed ingest)
+    if len(saved['breaches_per_sec']) != n_samples // int(sampling_rate) or \
+            'fingerprint' not in saved or \
+            str(saved['fingerprint']) != fingerprint:
+        print(f'Saved cutoff statistics of {name} are out of date')
+        return None
+    return dict(
+        breaches_per_sec=saved['breaches_per_sec'],
+        mean_per_sec=saved['mean_per_sec'],
+    )
@@ -0,0 +1,196 @@
+"""
+Bandpass filtering of electrode data, and the /filtered cache
+
+Channels are filtered in overlapping chunks (see filter_chunked), so
+memory used while filtering doesn't grow with the recording length.
+
+blech_common_avg_reference.py can bandpass filter every electrode in
+the same pass that references it (see car_utils.py), and store the
+filtered signal in /filtered. Downstream steps (blech_process.py,
+blech_make_arrays.py) then read the filtered signal instead of loading
+the raw data and filtering it again.
+
+Filtered data is stored in microvolts, either as float32, or as int16
+scaled by the scale attribute of the array.
+"""
+
+import numpy as np
+import tables
+from scipy.signal import butter, sosfiltfilt
+
+# Microvolts per bit of Intan amplifier data
+AMPLIFIER_SCALE = 0.195
+
+
+def get_bandpass_sos(freq, sampling_rate):
+    """
+    Second order sections of the bandpass filter used for spike detection
+    (same filter as clustering.get_filtered_electrode)
+    """
+    return butter(2, [2.0*freq[0]/sampling_rate, 2.0*freq[1]/sampling_rate],
+                  btype='bandpass', output='sos')
+
+
+def get_pad_samples(freq, sampling_rate):
+    """
+    Samples of context needed either side of a block, for the filtered
+    block to match filtering the whole recording.
+    10 periods of the lower cutoff, by which the filter has settled
+    """
+    return int(np.ceil(10 * sampling_rate / freq[0]))
+
+
+def bandpass_block(data, sos):
+    """
+    Scale raw data to microvolts and bandpass filter it
+
+    Inputs:
+        data: np.array (..., n_samples)
+        sos: np.array, from get_bandpass_sos
+
+    Output:
+        np.array like data, float64
+    """
+    return sosfiltfilt(sos, AMPLIFIER_SCALE * data, axis=-1)
+
+
+def filter_chunked(data, freq, sampling_rate, chunk_samples, dtype=np.float64,
+                   on_chunk=None):
+    """
+    Zero phase bandpass filter whole channels, chunk by chunk
+
+    Every chunk is filtered with get_pad_samples of context from
+    either side, which is then dropped, so the output matches filtering
+    the whole channel at once, but only chunk sized temporary copies
+    are made. The ends of the recording are padded as by sosfiltfilt.
+
+    Inputs:
+        data: np.array (n_samples,) or (n_channels, n_samples),
+            raw amplifier data, filtered along the last axis
+        freq: [lower, upper] bandpass cutoffs
+        sampling_rate: int
+        chunk_samples: int, samples filtered at a time
+        dtype: type of the output, chunks are filtered in float64
+        on_chunk: function called with every filtered chunk (in dtype),
+            in order, e.g. cutoff_stats_accumulator.update
+
+    Output:
+        np.array like data, dtype, microvolts
+    """
+    sos = get_bandpass_sos(freq, sampling_rate)
+    pad = get_pad_samples(freq, sampling_rate)
+    n_samples = data.shape[-1]
+    filtered = np.empty(data.shape, dtype=dtype)
+    for chunk_start in range(0, n_samples, chunk_samples):
+        chunk_end = min(chunk_start + chunk_samples, n_samples)
+        read_start = max(chunk_start - pad, 0)
+        read_end = min(chunk_end + pad, n_samples)
+        filtered[..., chunk_start:chunk_end] = bandpass_block(
+            data[..., read_start:read_end], sos)[
+                ..., chunk_start - read_start:chunk_end - read_start]
+        if on_chunk is not None:
+            on_chunk(filtered[..., chunk_start:chunk_end])
+    return filtered
+
+
+def create_filtered_array(
+        hf5, name, expected_rows, freq, sampling_rate, dtype='float32'):
+    """
+    Create the array holding the filtered signal of one channel,
+    replacing any previous one
+
+    Inputs:
+        hf5: tables file opened in 'r+' mode
+        name: str, e.g. 'electrode00' or 'emg08'
+        expected_rows: int
+        freq: [lower, upper] bandpass cutoffs the data is filtered with
+        sampling_rate: int
+        dtype: 'float32' or 'int16'
+
+    Output:
+        tables.EArray
+    """
+    if '/filtered' not in hf5:
+        hf5.create_group('/', 'filtered')
+    if f'/filtered/{name}' in hf5:
+        hf5.remove_node('/filtered', name)
+    if dtype == 'float32':
+        atom = tables.Float32Atom()
+    elif dtype == 'int16':
+        atom = tables.Int16Atom()
+    else:
+        raise Exception(f'Filtered dtype {dtype} not supported, '
+                        'use "float32" or "int16"')
+    filtered_array = hf5.create_earray(
+        '/filtered', name, atom, (0,),
+        expectedrows=expected_rows)
+    filtered_array._v_attrs.scale = AMPLIFIER_SCALE if dtype == 'int16' else 1.0
+    filtered_array._v_attrs.freq = [float(x) for x in freq]
+    filtered_array._v_attrs.sampling_rate = int(sampling_rate)
+    return filtered_array
+
+
+def to_filtered_dtype(data, dtype):
+    """
+    Convert filtered data (microvolts) to the type it is stored as
+    """
+    if dtype == 'int16':
+        dtype_info = np.iinfo(np.int16)
+        return np.clip(np.round(data / AMPLIFIER_SCALE),
+                       dtype_info.min, dtype_info.max).astype(np.int16)
+    return data.astype(dtype)
+
+
+def get_filtered_node(hf5, name, freq, sampling_rate):
+    """
+    Get the cached filtered array of a channel, if there is one
+    filtered with the given cutoffs and sampling rate
+
+    Output:
+        tables.EArray or None
+    """
+    if f'/filtered/{name}' not in hf5:
+        return None
+    filtered_array = hf5.get_node('/filtered', name)
+    attrs = filtered_array._v_attrs
+    if list(attrs.freq) != [float(x) for x in freq] or \
+            attrs.sampling_rate != int(sampling_rate):
+        print(f'/filtered/{name} was filtered with different parameters, '
+              'filtering again')
+        return None
+    return filtered_array
+
+
+def read_filtered(filtered_array, dtype=np.float64):
+    """
+    Read a cached filtered array, in microvolts
+
+    Output:
+        np.array, dtype
+    """
+    data = filtered_array[:].astype(dtype, copy=False)
+    if filtered_array._v_attrs.scale != 1.0:
+        data *= data.dtype.type(filtered_array._v_attrs.scale)
+    return data
+
+
+def get_filter_settings(freq, sampling_rate, dtype='float32'):
+    """
+    Everything needed to filter blocks of data and store them,
+    see car_utils.reference_filter_group
+
+    Inputs:
+        freq: [lower, upper] bandpass cutoffs
+        sampling_rate: int
+        dtype: 'float32' or 'int16', type filtered data is stored as
+
+    Output:
+        dict
+    """
+    return dict(
+        freq=freq,
+        sampling_rate=sampling_rate,
+        sos=get_bandpass_sos(freq, sampling_rate),
+        pad=get_pad_samples(freq, sampling_rate),
+        dtype=dtype,
+    )
@@ -0,0 +1,250 @@
+"""
+Resumable ingest
+
+Every array written by blech_clust.py ingest is recorded in an
+/ingest_manifest table, along with the size, modification time and a
+fast content hash of its source file, and the layout entry it was
+written from. When ingest is re-run, only arrays whose entry changed
+(or which are missing from the HDF5 file) are imported again.
+"""
+
+import os
+import hashlib
+import tables
+import numpy as np
+import pandas as pd
+from utils.session_join import get_segments
+from utils.raw_data_backend import dat_channel
+
+raw_groups = ['raw', 'raw_emg']
+ingest_groups = ['raw', 'raw_emg', 'digital_in', 'digital_out']
+manifest_cols = ['filename', 'file_size', 'mtime', 'content_hash', 'layout_key']
+
+
+class manifest_row(tables.IsDescription):
+    """
+    Row of the /ingest_manifest table, one row per ingested array
+    """
+    node = tables.StringCol(64)
+    filename = tables.StringCol(1024)
+    file_size = tables.Int64Col()
+    mtime = tables.Float64Col()
+    content_hash = tables.StringCol(32)
+    layout_key = tables.StringCol(256)
+
+
+def file_fingerprint(filename, sample_bytes=2**20):
+    """
+    Size, modification time and a fast content hash of a file
+
+    The hash covers the file size and sample_bytes from the start,
+    middle and end of the file, so it costs the same for any file size
+    Files of joined sessions cover the file of every session
+
+    Output:
+        tuple (size, mtime, hex digest)
+    """
+    segments = get_segments(filename)
+    paths = [filename] if segments is None else segments[0]
+    file_hash = hashlib.blake2b(digest_size=16)
+    total_size = 0
+    last_mtime = 0
+    for path in paths:
+        file_stat = os.stat(path)
+        total_size += file_stat.st_size
+        last_mtime = max(last_mtime, file_stat.st_mtime)
+        file_hash.update(str(file_stat.st_size).encode('utf-8'))
+        offsets = np.unique([
+            0,
+            max(file_stat.st_size//2 - sample_bytes//2, 0),
+            max(file_stat.st_size - sample_bytes, 0)])
+        with open(path, 'rb') as this_file:
+            for offset in offsets:
+                this_file.seek(int(offset))
+                file_hash.update(this_file.read(sample_bytes))
+    return total_size, last_mtime, file_hash.hexdigest()
+
+
+def get_raw_node(row):
+    """
+    HDF5 path of the array a row of the electrode layout is written to,
+    or None if the channel is not ingested
+    """
+    car_group = row.CAR_group.lower()
+    if car_group in ['none', 'na']:
+        return None
+    if 'emg' in car_group:
+        return f'/raw_emg/emg{row.electrode_ind:02}'
+    return f'/raw/electrode{row.electrode_ind:02}'
+
+
+def build_manifest(
+        electrode_layout_frame,
+        dig_in_nums,
+        dig_in_file_list,
+        file_type,
+        storage_params):
+    """
+    Manifest entries for the arrays an ingest of the current files would write
+
+    Inputs:
+        electrode_layout_frame: pd.DataFrame, layout read from csv,
+            or None if amplifier data is not copied to HDF5
+        dig_in_nums: list of digital inputs, as used to name /digital_in arrays
+        dig_in_file_list: list of digital input files
+        file_type: e.g. ['one file per channel']
+        storage_params: dict, usually params_dict['ingest_params']
+
+    Output:
+        pd.DataFrame indexed by node, with columns manifest_cols
+    """
+    fingerprints = {}
+
+    def get_entry(node, filename, layout_key):
+        if filename not in fingerprints:
+            fingerprints[filename] = file_fingerprint(filename)
+        return [node, filename, *fingerprints[filename], layout_key]
+
+    storage_key = ','.join([
+        str(storage_params[x]) for x in
+        ['compact_storage', 'complib', 'complevel', 'chunk_samples']])
+    entries = []
+    if electrode_layout_frame is not None:
+        for num, row in electrode_layout_frame.iterrows():
+            node = get_raw_node(row)
+            if node is None:
+                continue
+            # Single file data is read from the column given by the row number
+            layout_key = f'{row.CAR_group}|{num}|{storage_key}'
+            entries.append(get_entry(node, row.filename, layout_key))
+    # All dig-ins are read together, so each depends on the full list
+    dig_in_key = ','.join([str(x) for x in dig_in_nums])
+    for i, dig_in_num in enumerate(dig_in_nums):
+        # All dig-ins share a file, except with one file per channel
+        if file_type != ['one file per channel']:
+            dig_in_filename = dig_in_file_list[0]
+        else:
+            dig_in_filename = dig_in_file_list[i]
+        entries.append(get_entry(
+            f'/digital_in/dig_in_{dig_in_num}', dig_in_filename, dig_in_key))
+    return pd.DataFrame(
+        entries, columns=['node'] + manifest_cols).set_index('node')
+
+
+def read_manifest(hf5):
+    """
+    Load /ingest_manifest, empty if the file predates it
+    """
+    if '/ingest_manifest' not in hf5:
+        return pd.DataFrame(
+            columns=['node'] + manifest_cols).set_index('node')
+    manifest = pd.DataFrame(hf5.root.ingest_manifest.read())
+    for col in ['node', 'filename', 'content_hash', 'layout_key']:
+        manifest[col] = manifest[col].str.decode('utf-8')
+    return manifest.set_index('node')
+
+
+def get_channel_fingerprint(hf5, channel):
+    """
+    Identify the data of a raw channel as ingested, so results saved
+    from it (e.g. cutoff_stats) can be checked against a later ingest
+
+    Inputs:
+        hf5: open tables file
+        channel: tables.EArray, or dat_channel for the .dat backend
+
+    Output:
+        str, empty if the channel isn't in /ingest_manifest
+    """
+    if isinstance(channel, dat_channel):
+        return f'{file_fingerprint(channel.filename)[2]}|{channel.channel}'
+    manifest = read_manifest(hf5)
+    if channel._v_pathname not in manifest.index:
+        return ''
+    entry = manifest.loc[channel._v_pathname]
+    return f'{entry.content_hash}|{entry.layout_key}'
+
+
+def write_manifest(hf5, manifest):
+    """
+    Replace /ingest_manifest with the given entries
+    """
+    if '/ingest_manifest' in hf5:
+        hf5.remove_node('/', 'ingest_manifest')
+    table = hf5.create_table(
+        '/', 'ingest_manifest', manifest_row,
+        'Source files of ingested arrays')
+    for node, entry in manifest.iterrows():
+        this_row = table.row
+        this_row['node'] = node
+        for col in manifest_cols:
+            this_row[col] = entry[col]
+        this_row.append()
+    table.flush()
+
+
+def prepare_ingest(hf5, manifest, resume=True):
+    """
+    Work out which arrays need to be imported, and remove them along with
+    any arrays no longer in the manifest, so importing can start afresh
+
+    Arrays in /raw can't be reused once common average referencing
+    has been run on them, as they no longer hold the recorded data
+
+    Inputs:
+        hf5: tables file opened in 'r+' mode
+        manifest: pd.DataFrame, from build_manifest
+        resume: if False, every array is imported again
+
+    Output:
+        set of nodes to import
+    """
+    old_manifest = read_manifest(hf5)
+    for this_group in ingest_groups:
+        if '/'+this_group not in hf5:
+            hf5.create_group('/', this_group)
+    referenced = 'car_applied' in hf5.root.raw._v_attrs
+    if referenced and resume:
+        print('Raw electrodes were common average referenced, '
+              're-importing them')
+
+    import_nodes = set()
+    for node, entry in manifest.iterrows():
+        unchanged = resume and node in old_manifest.index \
+            and node in hf5 \
+            and list(old_manifest.loc[node, manifest_cols]) == \
+            list(entry[manifest_cols]) \
+            and not (referenced and node.startswith('/raw/'))
+        if not unchanged:
+            import_nodes.add(node)
+    # Dig-ins are read and written to /digital_in_events together
+    dig_in_nodes = [x for x in manifest.index if x.startswith('/digital_in/')]
+    if any([x in import_nodes for x in dig_in_nodes]):
+        import_nodes.update(dig_in_nodes)
+
+    for this_group in raw_groups + ['digital_in']:
+        for this_node in hf5.list_nodes('/'+this_group):
+            if this_node._v_pathname in import_nodes or \
+                    this_node._v_pathname not in manifest.index:
+                this_node._f_remove()
+    if referenced:
+        del hf5.root.raw._v_attrs.car_applied
+
+    # Keep entries only for arrays that were kept, so an interrupted
+    # ingest resumes from where it stopped
+    write_manifest(hf5, manifest.drop(index=list(import_nodes)))
+    hf5.flush()
+    print(f'{len(import_nodes)} of {len(manifest)} arrays to import, '
+          f'{len(manifest) - len(import_nodes)} unchanged since last ingest')
+    return import_nodes
+
+
+def filter_layout(electrode_layout_frame, import_nodes):
+    """
+    Rows of the electrode layout which are written to the given nodes
+    (row numbers are kept, as they give the columns in amplifier.dat)
+    """
+    wanted_rows = [
+        get_raw_node(row) in import_nodes
+        for num, row in electrode_layout_frame.iterrows()]
+    return electrode_layout_frame.loc[wanted_rows]
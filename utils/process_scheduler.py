@@ -0,0 +1,554 @@
+"""
+Run blech_process.py (and cluster_stability.py) on every electrode
+of a data directory, in parallel
+
+Replaces running GNU parallel repeatedly from bash: every job (a batch
+of detection_params['batch_size'] electrodes) is retried on failure up
+to scheduler_params['max_retries'] times, with the reason of every
+failure (exit code and last line of output) kept. Each attempt is
+appended to process_results.log (tab separated) in the data directory,
+and output of each attempt goes to temp/process_logs.
+
+Electrodes are complete once blech_process.py and cluster_stability.py
+have both run on them. Complete electrodes are never run again, unless
+--rerun is passed: they are read from process_results.log, and checked
+against memory_monitor_clustering, which blech_clust.py clears
+when a session is set up again.
+
+Jobs are started only while the memory they are expected to need fits
+in a RAM budget (see memory_estimator), so long recordings don't run
+out of memory, and short ones can use every CPU allowed.
+
+Usage:
+    python utils/process_scheduler.py <data_dir> [--n_jobs N] [--rerun]
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+import multiprocessing
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+import psutil
+import tables
+
+script_path = os.path.realpath(__file__)
+blech_clust_dir = os.path.dirname(os.path.dirname(script_path))
+sys.path.append(blech_clust_dir)
+from utils.blech_utils import imp_metadata, get_param_group  # noqa: E402
+from utils.raw_data_backend import list_raw_channels  # noqa: E402
+
+# Bytes held per sample of an electrode by blech_process.py: the raw
+# int16 data and its stacked copy, and about 3 arrays the size of the
+# filtered data (filtered data, detection and feature temporaries)
+raw_bytes_per_sample = 4
+filtered_copies = 3
+
+# Scheduler settings used for keys missing from
+# params_dict['scheduler_params'], matching
+# params/_templates/sorting_params_template.json
+scheduler_defaults = {
+    'max_retries': 3,
+    'ram_budget_gb': None,
+    'ram_reserve_gb': 4,
+    'base_memory_gb': 0.5,
+    'memory_safety_factor': 1.25,
+}
+
+results_columns = [
+    'electrode', 'batch', 'attempt', 'start_time', 'seconds',
+    'exit_code', 'peak_rss_mb', 'status', 'reason', 'log_path']
+
+
+def get_process_electrodes(info_dict, layout_frame):
+    """
+    Electrodes to spike sort: those in a CAR group, except EMG
+    (same selection as blech_clust.py)
+
+    Output:
+        list of int
+    """
+    all_electrodes = [
+        electrode
+        for region_name, region_elecs in info_dict['electrode_layout'].items()
+        if region_name != 'emg'
+        for group in region_elecs
+        for electrode in group]
+    electrode_frame = layout_frame.loc[
+        layout_frame.electrode_ind.isin(all_electrodes)]
+    electrode_frame = electrode_frame.loc[
+        ~electrode_frame.CAR_group.isin(['none', 'None', 'na'])]
+    electrode_frame = electrode_frame.loc[
+        ~electrode_frame.CAR_group.str.contains('emg')]
+    return [int(x) for x in electrode_frame.electrode_ind.values]
+
+
+def get_job_count(n_jobs, params_dict):
+    """
+    Jobs run at once: leave 2 CPUs free, and use at most max_parallel_cpu
+    """
+    return max(1, min(
+        n_jobs,
+        multiprocessing.cpu_count() - 2,
+        params_dict['max_parallel_cpu']))
+
+
+def run_command(args, log_file):
+    """
+    Run a command, with output appended to log_file
+
+    Output:
+        exit code, peak RSS (MB) of the command
+    """
+    process = subprocess.Popen(
+        args,
+        cwd=blech_clust_dir,
+        stdin=subprocess.DEVNULL,
+        stdout=log_file,
+        stderr=subprocess.STDOUT)
+    # os.wait4 gives the peak RSS of this process only
+    _, status, usage = os.wait4(process.pid, 0)
+    # Negative signal number if killed, as for Popen.returncode
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is in KB on Linux
+    return process.returncode, usage.ru_maxrss / 2**10
+
+
+def get_error_message(log_path):
+    """
+    The exception of the last traceback in the output of a command,
+    or else its last line
+    """
+    with open(log_path, 'r', errors='replace') as log_file:
+        # Leaving out blank and divider lines
+        lines = [x.rstrip() for x in log_file.readlines()
+                 if any([c.isalnum() for c in x])]
+    traceback_starts = [
+        i for i, x in enumerate(lines) if x.startswith('Traceback')]
+    if len(traceback_starts) > 0:
+        # Frames of a traceback are indented, the exception isn't
+        error_lines = [x for x in lines[traceback_starts[-1] + 1:]
+                       if not x.startswith(' ')]
+        if len(error_lines) > 0:
+            return error_lines[0]
+    if len(lines) > 0:
+        return lines[-1].strip()
+    return ''
+
+
+def get_failure_reason(exit_code, log_path):
+    """
+    Exit code (or signal) and the error of a failed command
+    """
+    if exit_code < 0:
+        reason = f'killed by signal {-exit_code}'
+        if exit_code == -9:
+            reason += ' (out of memory?)'
+    else:
+        reason = f'exit code {exit_code}'
+    return f'{reason} : {get_error_message(log_path)}'
+
+
+def get_recording_samples(hdf5_name):
+    """
+    Samples per electrode in the recording
+    """
+    with tables.open_file(hdf5_name, 'r') as hf5:
+        channels = list_raw_channels(hf5, 'raw')
+        if len(channels) == 0:
+            return 0
+        return channels[0].shape[0]
+
+
+class memory_estimator():
+    """
+    Estimate the peak memory (MB) of a blech_process.py job
+
+    Before any job on the session has finished, the estimate is
+    base_memory_gb plus, per electrode, the recording length times the
+    bytes held per sample at the processing precision. Once jobs have
+    finished, their peak RSS (from process_results.log, or from
+    memory_monitor_clustering for electrodes run some other way) is
+    used instead: the largest peak seen, adjusted for the number of
+    electrodes in the job, times safety_factor.
+    """
+
+    def __init__(self, n_samples, sampling_rate, dtype, scheduler_params):
+        itemsize = np.dtype(dtype).itemsize
+        self.electrode_mb = n_samples * \
+            (raw_bytes_per_sample + filtered_copies * itemsize) / 2**20
+        self.base_mb = scheduler_params['base_memory_gb'] * 2**10
+        self.safety_factor = scheduler_params['memory_safety_factor']
+        # (electrodes in job, peak RSS MB) of finished jobs
+        self.history = []
+        print(f'Recording of {n_samples / sampling_rate:.0f} s at {dtype} '
+              f'precision, {self.electrode_mb:.0f} MB of data per electrode')
+
+    def load_history(self, results_path, memory_dir):
+        """
+        Peaks of earlier jobs on this session
+        """
+        logged = []
+        if os.path.exists(results_path):
+            results_frame = pd.read_csv(results_path, sep='\t')
+            results_frame = results_frame.loc[
+                results_frame.status == 'complete']
+            for _, job_frame in results_frame.groupby(
+                    ['batch', 'start_time']):
+                self.add_job(
+                    len(str(job_frame.batch.iloc[0]).split(',')),
+                    job_frame.peak_rss_mb.max())
+            logged = results_frame.electrode.unique().tolist()
+        # Written by blech_process.py at the end of every electrode,
+        # with the peak RSS of the process (taken as one electrode per job)
+        for memory_path in sorted(glob(os.path.join(memory_dir, '*.txt'))):
+            electrode_num = int(os.path.basename(memory_path).split('.')[0])
+            if electrode_num in logged:
+                continue
+            with open(memory_path, 'r') as memory_file:
+                try:
+                    self.add_job(1, float(memory_file.read().strip()))
+                except ValueError:
+                    continue
+
+    def add_job(self, n_electrodes, peak_mb):
+        self.history.append((n_electrodes, peak_mb))
+
+    def estimate(self, n_electrodes):
+        if len(self.history) == 0:
+            return self.base_mb + n_electrodes * self.electrode_mb
+        return self.safety_factor * max([
+            peak_mb + (n_electrodes - n_seen) * self.electrode_mb
+            for n_seen, peak_mb in self.history])
+
+
+def get_ram_budget(scheduler_params):
+    """
+    RAM (MB) jobs may use at once: ram_budget_gb, or if that is null,
+    the RAM available now less ram_reserve_gb
+    """
+    if scheduler_params['ram_budget_gb'] is not None:
+        return scheduler_params['ram_budget_gb'] * 2**10
+    available_mb = psutil.virtual_memory().available / 2**20
+    return available_mb - scheduler_params['ram_reserve_gb'] * 2**10
+
+
+class process_scheduler():
+    """
+    Run batches of electrodes through blech_process.py and
+    cluster_stability.py on a pool of n_jobs, retrying failures
+
+    If a memory_estimator and ram_budget_mb are given, jobs are only
+    started while the estimated memory of running jobs fits in the
+    budget (one job is always allowed to run)
+    """
+
+    def __init__(self, data_dir, params_dict, electrode_batches,
+                 n_jobs, max_retries, rerun=False,
+                 estimator=None, ram_budget_mb=None):
+        self.data_dir = os.path.abspath(data_dir)
+        self.params_dict = params_dict
+        self.n_jobs = n_jobs
+        self.max_retries = max_retries
+        self.estimator = estimator
+        self.ram_budget_mb = ram_budget_mb
+        # Electrodes killed (probably for memory), given more on retries
+        self.killed = []
+        self.results_path = os.path.join(self.data_dir, 'process_results.log')
+        self.log_dir = os.path.join(self.data_dir, 'temp', 'process_logs')
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.lock = threading.Lock()
+
+        complete = [] if rerun else self.get_complete_electrodes()
+        self.n_electrodes = sum([len(x) for x in electrode_batches])
+        self.complete = [x for batch in electrode_batches
+                         for x in batch if x in complete]
+        self.failed = {}
+        # Queue of (electrodes, attempt)
+        self.queue = [
+            ([x for x in batch if x not in complete], 1)
+            for batch in electrode_batches]
+        self.queue = [x for x in self.queue if len(x[0]) > 0]
+        if len(self.complete) > 0:
+            print(f'Skipping {len(self.complete)} complete electrodes : '
+                  f'{self.complete}')
+        if self.estimator is not None:
+            self.estimator.load_history(
+                self.results_path,
+                os.path.join(self.data_dir, 'memory_monitor_clustering'))
+
+    def get_complete_electrodes(self):
+        """
+        Electrodes logged as complete whose outputs are still there
+        """
+        if not os.path.exists(self.results_path):
+            return []
+        results_frame = pd.read_csv(self.results_path, sep='\t')
+        logged = results_frame.loc[
+            results_frame.status == 'complete', 'electrode'].unique()
+        return [
+            int(x) for x in logged
+            if os.path.exists(self.get_memory_path(x))]
+
+    def get_memory_path(self, electrode_num):
+        # Written by blech_process.py once an electrode is done
+        return os.path.join(
+            self.data_dir, 'memory_monitor_clustering', f'{electrode_num:02}.txt')
+
+    def log_results(self, rows):
+        with self.lock:
+            results_frame = pd.DataFrame(rows)[results_columns]
+            results_frame.to_csv(
+                self.results_path, sep='\t', mode='a', index=False,
+                header=not os.path.exists(self.results_path))
+
+    def run_job(self, electrodes, attempt):
+        """
+        Run blech_process.py on a batch of electrodes, then
+        cluster_stability.py on every electrode it finished
+
+        Errors of the scheduler itself (e.g. a command which can't be
+        started) fail the job, rather than stopping every other job
+
+        Output:
+            list of rows (dicts) of process_results.log, one per electrode
+        """
+        batch_str = ','.join([str(x) for x in electrodes])
+        log_path = os.path.join(
+            self.log_dir,
+            f'electrodes_{batch_str.replace(",", "_")}_attempt{attempt}.log')
+        start_time = time.time()
+        try:
+            rows = self.run_batch(electrodes, attempt, log_path, start_time)
+        except Exception as error:
+            rows = [dict(
+                electrode=electrode_num,
+                batch=batch_str,
+                attempt=attempt,
+                start_time=time.strftime(
+                    '%Y-%m-%d %H:%M:%S', time.localtime(start_time)),
+                seconds=round(time.time() - start_time, 1),
+                exit_code=1,
+                peak_rss_mb=np.nan,
+                status='failed',
+                reason=f'scheduler error : {type(error).__name__}: {error}',
+                log_path=log_path)
+                for electrode_num in electrodes]
+        self.log_results(rows)
+        return rows
+
+    def run_batch(self, electrodes, attempt, log_path, start_time):
+        """
+        Commands of run_job, output to log_path
+        """
+        batch_str = ','.join([str(x) for x in electrodes])
+        # Written again by blech_process.py for every electrode it finishes
+        for electrode_num in electrodes:
+            if os.path.exists(self.get_memory_path(electrode_num)):
+                os.remove(self.get_memory_path(electrode_num))
+        rows = []
+        with open(log_path, 'w') as log_file:
+            exit_code, peak_rss = run_command(
+                [sys.executable, 'blech_process.py', self.data_dir] +
+                [str(x) for x in electrodes],
+                log_file)
+            if exit_code != 0:
+                process_reason = get_failure_reason(exit_code, log_path)
+            else:
+                process_reason = 'blech_process.py finished without ' \
+                    f'completing the electrode : {get_error_message(log_path)}'
+            for electrode_num in electrodes:
+                # Electrodes of a failed batch may have finished
+                # before the failure
+                if os.path.exists(self.get_memory_path(electrode_num)):
+                    electrode_exit_code, _ = run_command(
+                        [sys.executable, 'utils/cluster_stability.py',
+                         self.data_dir, str(electrode_num)],
+                        log_file)
+                    reason = '' if electrode_exit_code == 0 else \
+                        'cluster_stability.py ' + \
+                        get_failure_reason(electrode_exit_code, log_path)
+                else:
+                    electrode_exit_code = exit_code if exit_code != 0 else 1
+                    reason = process_reason
+                rows.append(dict(
+                    electrode=electrode_num,
+                    batch=batch_str,
+                    attempt=attempt,
+                    start_time=time.strftime(
+                        '%Y-%m-%d %H:%M:%S', time.localtime(start_time)),
+                    seconds=round(time.time() - start_time, 1),
+                    exit_code=electrode_exit_code,
+                    peak_rss_mb=round(peak_rss, 1),
+                    status='complete' if electrode_exit_code == 0 else 'failed',
+                    reason=reason,
+                    log_path=log_path))
+        return rows
+
+    def handle_results(self, attempt, rows):
+        """
+        Record complete electrodes, and queue failed ones again
+        """
+        if self.estimator is not None and \
+                any([x['status'] == 'complete' for x in rows]):
+            # Peak of the whole job, which all its rows share
+            self.estimator.add_job(len(rows), rows[0]['peak_rss_mb'])
+        failed = []
+        for row in rows:
+            electrode_num = row['electrode']
+            if row['status'] == 'complete':
+                self.complete.append(electrode_num)
+                self.failed.pop(electrode_num, None)
+                print(f'Electrode {electrode_num} complete '
+                      f'({row["seconds"]} s, peak RSS {row["peak_rss_mb"]} MB)')
+            else:
+                failed.append(electrode_num)
+                self.failed[electrode_num] = row['reason']
+                if row['exit_code'] == -9:
+                    self.killed.append(electrode_num)
+                print(f'Electrode {electrode_num} failed '
+                      f'(attempt {attempt}/{self.max_retries}) : {row["reason"]}')
+        if len(failed) > 0 and attempt < self.max_retries:
+            self.queue.append((failed, attempt + 1))
+
+    def get_job_memory(self, electrodes):
+        """
+        Estimated peak memory (MB) of a job, doubled for
+        electrodes which were killed before
+        """
+        if self.estimator is None:
+            return 0
+        job_mb = self.estimator.estimate(len(electrodes))
+        if any([x in self.killed for x in electrodes]):
+            job_mb *= 2
+        return job_mb
+
+    def get_next_job(self, running):
+        """
+        First queued job which fits in the RAM left, removed from the queue
+
+        Output:
+            (electrodes, attempt, estimated MB), or None
+        """
+        if len(running) >= self.n_jobs:
+            return None
+        committed_mb = sum([x[2] for x in running.values()])
+        for i, (electrodes, attempt) in enumerate(self.queue):
+            job_mb = self.get_job_memory(electrodes)
+            if self.ram_budget_mb is None or len(running) == 0 or \
+                    committed_mb + job_mb <= self.ram_budget_mb:
+                if self.ram_budget_mb is not None and \
+                        job_mb > self.ram_budget_mb:
+                    print(f'Electrodes {electrodes} need about '
+                          f'{job_mb:.0f} MB, more than the RAM budget '
+                          f'({self.ram_budget_mb:.0f} MB), running alone')
+                return self.queue.pop(i) + (job_mb,)
+        return None
+
+    def print_progress(self, running):
+        memory_str = ''
+        if self.ram_budget_mb is not None:
+            committed_mb = sum([x[2] for x in running.values()])
+            memory_str = f', {committed_mb / 2**10:.1f}/' \
+                f'{self.ram_budget_mb / 2**10:.1f} GB committed'
+        print(f'=== {len(self.complete)}/{self.n_electrodes} electrodes '
+              f'complete, {len(running)} jobs running, '
+              f'{len(self.queue)} queued{memory_str} ===')
+
+    def run(self):
+        """
+        Run all queued jobs, n_jobs at a time
+
+        Output:
+            dict of electrodes which failed every attempt, with the
+            reason of the last failure
+        """
+        print(f'Processing {sum([len(x[0]) for x in self.queue])} electrodes '
+              f'with up to {self.n_jobs} parallel jobs')
+        if self.ram_budget_mb is not None and len(self.queue) > 0:
+            print(f'RAM budget {self.ram_budget_mb / 2**10:.1f} GB, '
+                  f'about {self.get_job_memory(self.queue[0][0]):.0f} MB '
+                  'per job')
+        # future : (electrodes, attempt, estimated MB)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            self.start_jobs(executor, running)
+            while len(running) > 0:
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    _, attempt, _ = running.pop(future)
+                    self.handle_results(attempt, future.result())
+                self.start_jobs(executor, running)
+                self.print_progress(running)
+        return self.failed
+
+    def start_jobs(self, executor, running):
+        """
+        Start queued jobs while they fit, adding them to running
+        """
+        next_job = self.get_next_job(running)
+        while next_job is not None:
+            future = executor.submit(self.run_job, next_job[0], next_job[1])
+            running[future] = next_job
+            next_job = self.get_next_job(running)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run blech_process.py on all electrodes, with retries')
+    parser.add_argument('dir_name', help='Data directory')
+    parser.add_argument('--n_jobs', type=int,
+                        help='Parallel jobs, defaults to CPUs - 2, '
+                        'at most max_parallel_cpu')
+    parser.add_argument('--rerun', action='store_true',
+                        help='Run electrodes already complete again')
+    args = parser.parse_args()
+
+    metadata_handler = imp_metadata([[], args.dir_name])
+    params_dict = metadata_handler.params_dict
+    electrode_list = get_process_electrodes(
+        metadata_handler.info_dict, metadata_handler.layout)
+    # Electrodes are processed detection_params['batch_size'] at a time
+    # by each job, see blech_process.py
+    batch_size = params_dict.get('detection_params', {}).get('batch_size', 1)
+    electrode_batches = [
+        electrode_list[i:i+batch_size]
+        for i in range(0, len(electrode_list), batch_size)]
+
+    if args.n_jobs is None:
+        n_jobs = get_job_count(len(electrode_batches), params_dict)
+    else:
+        n_jobs = args.n_jobs
+    scheduler_params = get_param_group(
+        params_dict, 'scheduler_params', scheduler_defaults)
+    estimator = memory_estimator(
+        get_recording_samples(metadata_handler.hdf5_name),
+        params_dict['sampling_rate'],
+        params_dict.get('processing_dtype', 'float64'),
+        scheduler_params)
+    scheduler = process_scheduler(
+        metadata_handler.dir_name,
+        params_dict,
+        electrode_batches,
+        n_jobs,
+        scheduler_params['max_retries'],
+        rerun=args.rerun,
+        estimator=estimator,
+        ram_budget_mb=get_ram_budget(scheduler_params))
+    failed = scheduler.run()
+
+    if len(failed) > 0:
+        print('=== Electrodes which failed every attempt ===')
+        for electrode_num, reason in sorted(failed.items()):
+            print(f'{electrode_num:02} : {reason}')
+        print(f'See {scheduler.results_path} and {scheduler.log_dir}')
+        exit(1)
+    print('=== All electrodes complete ===')
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import tables
 import os
+from utils.raw_data_backend import list_raw_channels
 
 def get_all_channels(hf5_path, downsample_rate = 100):
 	"""
@@ -24,8 +25,9 @@ def get_all_channels(hf5_path, downsample_rate = 100):
 		chan_names: np.array (n_chans,)
 	"""
 	hf5 = tables.open_file(hf5_path, 'r')
-	raw = hf5.list_nodes('/raw')
-	raw_emg = hf5.list_nodes('/raw_emg')
+	# Channels may be HDF5 arrays or views of the raw .dat files
+	raw = list_raw_channels(hf5, 'raw')
+	raw_emg = list_raw_channels(hf5, 'raw_emg')
 	all_chans = []
 	chan_names = []
 	for node in [raw, raw_emg]:
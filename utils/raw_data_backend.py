@@ -0,0 +1,190 @@
+"""
+Zero-copy access to raw Intan .dat files
+
+Rather than copying amplifier data into /raw and /raw_emg, ingest can
+record where every channel lives in the original .dat files in a
+/raw_dat_map table. Downstream steps then get lazily sliced np.memmap
+views of the .dat files, named exactly like the HDF5 arrays they replace.
+
+Common average referencing cannot rewrite the original files, so for
+these sessions the reference of every CAR group is stored in
+/car_reference instead, and subtracted when a channel is loaded.
+"""
+
+import os
+import tables
+import numpy as np
+from utils.session_join import map_dat_file, get_file_size
+
+
+class dat_map_row(tables.IsDescription):
+    """
+    Row of the /raw_dat_map table, one row per channel
+    filename is relative to the directory of the HDF5 file
+    """
+    group = tables.StringCol(16)
+    name = tables.StringCol(32)
+    filename = tables.StringCol(1024)
+    n_channels = tables.Int32Col()
+    channel = tables.Int32Col()
+    n_samples = tables.Int64Col()
+
+
+class dat_channel():
+    """
+    Lazily sliced view of one channel of an Intan .dat file
+
+    Mimics the parts of tables.EArray used downstream
+    (slicing, shape, dtype, len, _v_name and _v_pathname)
+    """
+
+    def __init__(self, group, name, filename, n_channels, channel, n_samples):
+        self._v_name = name
+        self._v_pathname = f'/{group}/{name}'
+        self.filename = filename
+        self.n_channels = n_channels
+        self.channel = channel
+        self.dtype = np.dtype('int16')
+        self.shape = (n_samples,)
+        # (n_samples, n_channels), chained across joined sessions
+        self.data = map_dat_file(filename, self.dtype, n_samples)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        # tables.EArray accepts float slice bounds, so cast them like it does
+        if isinstance(key, slice):
+            key = slice(*[
+                int(x) if x is not None else None
+                for x in (key.start, key.stop, key.step)])
+        # Copy so only the requested samples are ever held in memory
+        return np.array(self.data[key, self.channel])
+
+
+def is_dat_backend(hf5):
+    return '/raw_dat_map' in hf5
+
+
+def write_dat_map(
+        hf5,
+        electrode_layout_frame,
+        file_type,
+        num_recorded_samples):
+    """
+    Record where every channel in electrode_layout_frame lives,
+    replacing any previous map
+
+    Inputs:
+        hf5: tables file opened in 'r+' mode, in the data directory
+        electrode_layout_frame: pd.DataFrame, layout read from csv
+        file_type: 'one file per channel' or 'one file per signal type'
+        num_recorded_samples: int, from time.dat
+    """
+    if '/raw_dat_map' in hf5:
+        hf5.remove_node('/', 'raw_dat_map')
+    table = hf5.create_table(
+        '/', 'raw_dat_map', dat_map_row,
+        'Location of raw channels in Intan .dat files')
+    hdf5_dir = os.path.dirname(os.path.abspath(hf5.filename))
+    for num, row in electrode_layout_frame.iterrows():
+        car_group = row.CAR_group.lower()
+        if car_group in ['none', 'na']:
+            continue
+        if 'emg' in car_group:
+            group, name = 'raw_emg', f'emg{row.electrode_ind:02}'
+        else:
+            group, name = 'raw', f'electrode{row.electrode_ind:02}'
+        file_size = get_file_size(row.filename) // 2
+        if file_type == ['one file per signal type']:
+            n_channels = file_size // num_recorded_samples
+            channel = num
+        else:
+            n_channels = 1
+            channel = 0
+        this_row = table.row
+        this_row['group'] = group
+        this_row['name'] = name
+        this_row['filename'] = os.path.relpath(
+            os.path.abspath(row.filename), hdf5_dir)
+        this_row['n_channels'] = n_channels
+        this_row['channel'] = channel
+        this_row['n_samples'] = file_size // n_channels
+        this_row.append()
+    table.flush()
+
+
+def list_raw_channels(hf5, group='raw'):
+    """
+    List raw channels in a group, as memmap views if the session uses
+    the .dat backend, otherwise as the HDF5 arrays
+
+    Inputs:
+        hf5: open tables file
+        group: 'raw' or 'raw_emg'
+
+    Output:
+        list of dat_channel or tables.EArray, sorted by name
+    """
+    if not is_dat_backend(hf5):
+        if f'/{group}' not in hf5:
+            return []
+        return hf5.list_nodes(f'/{group}')
+    hdf5_dir = os.path.dirname(os.path.abspath(hf5.filename))
+    rows = hf5.root.raw_dat_map.read_where(f'group == b"{group}"')
+    channels = [
+        dat_channel(
+            group,
+            row['name'].decode('utf-8'),
+            os.path.join(hdf5_dir, row['filename'].decode('utf-8')),
+            int(row['n_channels']),
+            int(row['channel']),
+            int(row['n_samples']))
+        for row in rows]
+    return sorted(channels, key=lambda x: x._v_name)
+
+
+def create_car_reference(hf5, group_name, electrode_inds, expected_rows):
+    """
+    Create the array holding the common average reference of a CAR group,
+    so it can be subtracted from .dat backed channels when they are loaded
+
+    Output:
+        tables.EArray, float32, to append the reference to
+    """
+    if '/car_reference' not in hf5:
+        hf5.create_group('/', 'car_reference')
+    if f'/car_reference/{group_name}' in hf5:
+        hf5.remove_node('/car_reference', group_name)
+    ref_array = hf5.create_earray(
+        '/car_reference', group_name, tables.Float32Atom(), (0,),
+        expectedrows=expected_rows)
+    ref_array._v_attrs.electrodes = [int(x) for x in electrode_inds]
+    return ref_array
+
+
+def get_referenced_channel(hf5, group, name):
+    """
+    Load a full .dat backed channel, subtracting the CAR reference
+    of its group if one has been calculated
+
+    Inputs:
+        hf5: open tables file
+        group: 'raw' or 'raw_emg'
+        name: e.g. 'electrode00'
+
+    Output:
+        np.array (n_samples,)
+    """
+    wanted_channel = [
+        x for x in list_raw_channels(hf5, group) if x._v_name == name]
+    if len(wanted_channel) == 0:
+        raise Exception(f'/{group}/{name} not in /raw_dat_map')
+    data = wanted_channel[0][:]
+    if '/car_reference' not in hf5 or group != 'raw':
+        return data
+    electrode_ind = int(name.split('electrode')[-1])
+    for ref_array in hf5.list_nodes('/car_reference'):
+        if electrode_ind in ref_array._v_attrs.electrodes:
+            return data - ref_array[:]
+    return data
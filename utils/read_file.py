@@ -2,69 +2,302 @@
 import tables
 import os
 import numpy as np
+import pandas as pd
 import tqdm
+import time
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.session_join import map_dat_file
+
+# Ingest settings used for keys missing from params_dict['ingest_params'],
+# matching params/_templates/sorting_params_template.json
+ingest_defaults = {
+	'raw_data_backend': 'hdf5',
+	'block_samples': 600000,
+	'n_workers': 8,
+	'resume_ingest': True,
+	'compact_storage': True,
+	'complib': 'blosc:lz4',
+	'complevel': 1,
+	'chunk_samples': 65536,
+	}
+
+def create_raw_earray(
+		hf5, group_name, array_name, expected_rows, storage_params = None):
+	"""
+	Create an extendable array for raw amplifier data
+
+	If storage_params['compact_storage'] is set, data is kept as int16
+	(as written by the Intan system), in chunks of
+	storage_params['chunk_samples'] time samples, compressed using
+	storage_params['complib'] at storage_params['complevel'].
+	Otherwise the legacy int32, unfiltered layout is used.
+
+	Inputs:
+		hf5: tables file opened in 'r+' mode
+		group_name: str, e.g. '/raw'
+		array_name: str, e.g. 'electrode00'
+		expected_rows: int, number of samples expected in the array
+		storage_params: dict, usually params_dict['ingest_params']
+
+	Output:
+		tables.EArray
+	"""
+	if storage_params is None or not storage_params['compact_storage']:
+		return hf5.create_earray(
+				group_name, array_name, tables.IntAtom(), (0,),
+				expectedrows = expected_rows)
+	filters = tables.Filters(
+			complevel = storage_params['complevel'],
+			complib = storage_params['complib'],
+			shuffle = True)
+	return hf5.create_earray(
+			group_name, array_name, tables.Int16Atom(), (0,),
+			filters = filters,
+			chunkshape = (storage_params['chunk_samples'],),
+			expectedrows = expected_rows)
+
+class dig_in_event(tables.IsDescription):
+	"""
+	Row of the /digital_in_events table, one row per pulse
+	onset is the first high sample, offset the first low sample after it
+	"""
+	dig_in_name = tables.StringCol(32)
+	dig_in_num = tables.Int32Col()
+	onset = tables.Int64Col()
+	offset = tables.Int64Col()
+
+class dig_in_edge_tracker():
+	"""
+	Run-length encode pulses on digital inputs, one block of samples
+	at a time, so edges can be collected while dig-ins are ingested
+	"""
+
+	def __init__(self, dig_in_names, dig_in_nums):
+		self.dig_in_names = list(dig_in_names)
+		self.dig_in_nums = [int(x) for x in dig_in_nums]
+		self.prev_state = np.zeros(len(self.dig_in_names), dtype = np.int8)
+		self.sample_offset = np.zeros(len(self.dig_in_names), dtype = np.int64)
+		self.onsets = [[] for x in self.dig_in_names]
+		self.offsets = [[] for x in self.dig_in_names]
+
+	def update(self, dig_inputs, dig_in_inds = None):
+		"""
+		dig_inputs: np.array (n_dig_ins, n_samples) of 0/1, following
+			on directly from the previous block for the same dig-ins
+		dig_in_inds: indices (into dig_in_names) of the rows of
+			dig_inputs, defaults to all dig-ins
+		"""
+		if dig_in_inds is None:
+			dig_in_inds = np.arange(len(self.dig_in_names))
+		for i, this_input in zip(dig_in_inds, dig_inputs):
+			# Prepend last state of the previous block so edges at
+			# block boundaries are not lost
+			edges = np.diff(np.concatenate(
+				[self.prev_state[i:i+1], this_input.astype(np.int8)]))
+			edge_inds = np.flatnonzero(edges)
+			edge_vals = edges[edge_inds]
+			self.onsets[i].append(
+					edge_inds[edge_vals > 0] + self.sample_offset[i])
+			self.offsets[i].append(
+					edge_inds[edge_vals < 0] + self.sample_offset[i])
+			self.prev_state[i] = this_input[-1]
+			self.sample_offset[i] += len(this_input)
+
+	def write_table(self, hf5):
+		"""
+		Write all pulses to /digital_in_events, replacing any previous table
+
+		Pulses touching the edges of the recording, i.e. already high at
+		the first sample or still high at the last, are left out (with a
+		warning): their true onset or offset wasn't recorded, and
+		np.diff of the dig-in (as used before this table) finds neither
+		"""
+		if '/digital_in_events' in hf5:
+			hf5.remove_node('/', 'digital_in_events')
+		table = hf5.create_table(
+				'/', 'digital_in_events', dig_in_event,
+				'Digital input pulse onsets and offsets (samples)')
+		for i, (name, num) in enumerate(
+				zip(self.dig_in_names, self.dig_in_nums)):
+			onsets = np.concatenate(self.onsets[i] or [[]]).astype(np.int64)
+			offsets = np.concatenate(self.offsets[i] or [[]]).astype(np.int64)
+			if len(offsets) < len(onsets):
+				print(f'{name} is high at the end of the recording, '
+						'leaving out its last pulse')
+				onsets = onsets[:-1]
+			if len(onsets) > 0 and onsets[0] == 0:
+				print(f'{name} is high at the start of the recording, '
+						'leaving out its first pulse')
+				onsets, offsets = onsets[1:], offsets[1:]
+			rows = np.empty(len(onsets), dtype = table.dtype)
+			rows['dig_in_name'] = name
+			rows['dig_in_num'] = num
+			rows['onset'] = onsets
+			rows['offset'] = offsets
+			table.append(rows)
+		table.flush()
+
+def read_dig_in_events(hf5):
+	"""
+	Load the /digital_in_events table written at ingest
+
+	Input:
+		hf5: open tables file
+
+	Output:
+		pd.DataFrame with columns dig_in_name, dig_in_num, onset, offset
+	"""
+	events = pd.DataFrame(hf5.root.digital_in_events.read())
+	events['dig_in_name'] = events['dig_in_name'].str.decode('utf-8')
+	return events
 
 def read_digins(hdf5_name, dig_in_int, dig_in_file_list): 
 	atom = tables.IntAtom()
 	hf5 = tables.open_file(hdf5_name, 'r+')
 	# Read digital inputs, and append to the respective hdf5 arrays
 	print('Reading dig-ins')
+	edge_tracker = dig_in_edge_tracker(
+			[f'dig_in_{x}' for x in dig_in_int], dig_in_int)
 	for i, (dig_int, dig_in_filename) in \
 			enumerate(zip(dig_in_int, dig_in_file_list)):
 		dig_in_name = f'dig_in_{dig_int}'
 		print(f'Reading {dig_in_name}')
-		inputs = np.fromfile(dig_in_filename,
-					   dtype = np.dtype('uint16'))
+		inputs = np.asarray(map_dat_file(dig_in_filename, 'uint16')[:])
 		hf5_dig_array = hf5.create_earray('/digital_in', dig_in_name, atom, (0,))
 		hf5_dig_array.append(inputs)
+		edge_tracker.update(inputs[None, :], [i])
 		hf5.flush()
+	edge_tracker.write_table(hf5)
 	hf5.close()
 		
-def read_digins_single_file(hdf5_name, dig_in, dig_in_file_list): 
-	num_dig_ins = len(dig_in)
+def decode_dig_in_words(words, dig_in):
+	"""
+	Unpack digital input states from Intan digital words
+
+	Every uint16 word in digitalin.dat (and in the digital input
+	blocks of .rhd files) holds the state of all 16 digital inputs,
+	with input n stored in bit n
+
+	Inputs:
+		words: np.array (n_samples,), uint16
+		dig_in: list of digital input numbers to extract
+
+	Output:
+		np.array (len(dig_in), n_samples), uint8 of 0/1
+	"""
+	bits = np.array(dig_in, dtype = np.uint16)[:, None]
+	return ((words[None, :] >> bits) & 1).astype(np.uint8)
+
+def read_digins_single_file(
+		hdf5_name, dig_in, dig_in_file_list, block_samples = 600000): 
+	"""
+	Decode digitalin.dat into one uint8 array per digital input
+
+	digitalin.dat is memory-mapped and decoded in blocks of
+	block_samples samples using bitwise ops, see decode_dig_in_words
+	Pulse onsets and offsets are written to /digital_in_events
+	"""
 	hf5 = tables.open_file(hdf5_name, 'r+')
 	# Read digital inputs, and append to the respective hdf5 arrays
 	print('Reading dig-ins')
-	atom = tables.IntAtom()
-	for i in dig_in:
-		dig_inputs = hf5.create_earray('/digital_in', 'dig_in_%i' % i, atom, (0,))
-	d_inputs = np.fromfile(dig_in_file_list[0], dtype=np.dtype('uint16'))
-	d_inputs_str = d_inputs.astype('str')
-	d_in_str_int = d_inputs_str.astype('int64')
-	d_diff = np.diff(d_in_str_int)
-	dig_inputs = np.zeros((num_dig_ins,len(d_inputs)))
-	for n_i in range(num_dig_ins):
-		start_ind = np.where(d_diff == n_i + 1)[0]
-		end_ind = np.where(d_diff == -1*(n_i + 1))[0]
-		for s_i in range(len(start_ind)):
-			dig_inputs[n_i,start_ind[s_i]:end_ind[s_i]] = 1
-	for i in tqdm.tqdm(range(num_dig_ins)):		
-		exec("hf5.root.digital_in.dig_in_"+str(i)+".append(dig_inputs[i,:])")
+	atom = tables.UInt8Atom()
+	d_inputs = map_dat_file(dig_in_file_list[0], 'uint16')
+	dig_in_arrays = [
+			hf5.create_earray(
+				'/digital_in', f'dig_in_{i}', atom, (0,),
+				expectedrows = len(d_inputs))
+			for i in dig_in]
+	edge_tracker = dig_in_edge_tracker(
+			[f'dig_in_{i}' for i in dig_in], dig_in)
+	block_starts = np.arange(0, len(d_inputs), block_samples)
+	for block_start in tqdm.tqdm(block_starts):
+		dig_inputs = decode_dig_in_words(
+				np.asarray(d_inputs[block_start:block_start+block_samples]),
+				dig_in)
+		for hf5_dig_array, this_dig_in in zip(dig_in_arrays, dig_inputs):
+			hf5_dig_array.append(this_dig_in)
+		edge_tracker.update(dig_inputs)
+	edge_tracker.write_table(hf5)
 	hf5.flush()
 	hf5.close()
 
-# TODO: Remove exec statements throughout file
-def read_emg_channels(hdf5_name, electrode_layout_frame):
-	atom = tables.IntAtom()
+def read_channel_file(filename):
+	"""
+	Load a single one-file-per-channel amplifier file
+	"""
+	return np.array(map_dat_file(filename, 'int16')[:])
+
+def write_channel_files(
+		hf5, channel_list, n_workers = 8, storage_params = None):
+	"""
+	Read one-file-per-channel amplifier files with a pool of reader
+	threads, and append them to the HDF5 file from this thread only,
+	as the HDF5 file must only ever have a single writer
+
+	Reads run at most 2*n_workers files ahead of the writer so memory
+	stays bounded regardless of the number of channels
+
+	Inputs:
+		hf5: tables file opened in 'r+' mode
+		channel_list: list of (filename, hdf5 group, array name) tuples
+		n_workers: number of reader threads
+		storage_params: dict, see create_raw_earray
+	"""
+	total_bytes = 0
+	start_time = time.time()
+	pending = deque()
+	progress = tqdm.tqdm(total = len(channel_list))
+
+	def write_oldest():
+		this_future, group_name, array_name = pending.popleft()
+		data = this_future.result()
+		hf5_el_array = create_raw_earray(
+				hf5, group_name, array_name, len(data), storage_params)
+		hf5_el_array.append(data)
+		hf5.flush()
+		progress.update()
+		return data.nbytes
+
+	with ThreadPoolExecutor(max_workers = n_workers) as executor:
+		for filename, group_name, array_name in channel_list:
+			print(f'Reading : {filename} --> {group_name}/{array_name}')
+			pending.append(
+					(executor.submit(read_channel_file, filename),
+					 group_name, array_name))
+			if len(pending) >= 2*n_workers:
+				total_bytes += write_oldest()
+		while pending:
+			total_bytes += write_oldest()
+	progress.close()
+
+	elapsed = time.time() - start_time
+	print(f'Read {len(channel_list)} channels, '
+		  f'{total_bytes/1e6:.1f} MB in {elapsed:.1f} s '
+		  f'({total_bytes/1e6/max(elapsed, 1e-6):.1f} MB/s)')
+
+def read_emg_channels(
+		hdf5_name, electrode_layout_frame, n_workers = 8, storage_params = None):
 	# Read EMG data from amplifier channels
-	hf5 = tables.open_file(hdf5_name, 'r+')
-	for num,row in tqdm.tqdm(electrode_layout_frame.iterrows()):
-		# Loading should use file name 
-		# but writing should use channel ind so that channels from 
-		# multiple boards are written into a monotonic sequence
+	# Loading should use file name 
+	# but writing should use channel ind so that channels from 
+	# multiple boards are written into a monotonic sequence
+	channel_list = []
+	for num,row in electrode_layout_frame.iterrows():
 		if 'emg' in row.CAR_group.lower():
-			print(f'Reading : {row.filename, row.CAR_group}')
-			port = row.port
-			channel_ind = row.electrode_ind
-			data = np.fromfile(row.filename, dtype = np.dtype('int16'))
 			# Label raw_emg with electrode_ind so it's more easily identifiable
-			array_name = f'emg{channel_ind:02}'
-			hf5_el_array = hf5.create_earray('/raw_emg', array_name, atom, (0,))
-			hf5_el_array.append(data)
-			hf5.flush()
+			channel_ind = row.electrode_ind
+			channel_list.append(
+					(row.filename, '/raw_emg', f'emg{channel_ind:02}'))
+	hf5 = tables.open_file(hdf5_name, 'r+')
+	write_channel_files(
+			hf5, channel_list,
+			n_workers = n_workers, storage_params = storage_params)
 	hf5.close()
 
-def read_electrode_channels(hdf5_name, electrode_layout_frame):
+def read_electrode_channels(
+		hdf5_name, electrode_layout_frame, n_workers = 8, storage_params = None):
 	"""
 	# Loading should use file name 
 	# but writing should use channel ind so that channels from 
@@ -72,54 +305,319 @@ def read_electrode_channels(hdf5_name, electrode_layout_frame):
 	# Note: That channels inds may not be contiguous if there are
 	# EMG channels in the middle
 	"""
-	atom = tables.IntAtom()
-	# Read EMG data from amplifier channels
+	channel_list = []
+	for num,row in electrode_layout_frame.iterrows():
+		emg_bool = 'emg' not in row.CAR_group.lower()
+		none_bool = row.CAR_group.lower() not in ['none','na']
+		if emg_bool and none_bool:
+			channel_ind = row.electrode_ind
+			channel_list.append(
+					(row.filename, '/raw', f'electrode{channel_ind:02}'))
 	hf5 = tables.open_file(hdf5_name, 'r+')
-	for num,row in tqdm.tqdm(electrode_layout_frame.iterrows()):
+	write_channel_files(
+			hf5, channel_list,
+			n_workers = n_workers, storage_params = storage_params)
+	hf5.close()
+	
+def create_layout_arrays(
+		hf5, electrode_layout_frame, expected_rows, storage_params = None):
+	"""
+	Create the /raw and /raw_emg arrays for data files holding
+	every amplifier channel, where row number num of the layout
+	is channel num of the file
+
+	Output:
+		list of (num, tables.EArray)
+	"""
+	# Loading should use file name 
+	# but writing should use channel ind so that channels from 
+	# multiple boards are written into a monotonic sequence
+	column_arrays = []
+	for num,row in electrode_layout_frame.iterrows():
 		emg_bool = 'emg' not in row.CAR_group.lower()
 		none_bool = row.CAR_group.lower() not in ['none','na']
+		channel_ind = row.electrode_ind
 		if emg_bool and none_bool:
 			print(f'Reading : {row.filename, row.CAR_group}')
-			port = row.port
-			channel_ind = row.electrode_ind
-			data = np.fromfile(row.filename, dtype = np.dtype('int16'))
 			# Label raw_emg with electrode_ind so it's more easily identifiable
 			array_name = f'electrode{channel_ind:02}'
-			hf5_el_array = hf5.create_earray('/raw', array_name, atom, (0,))
-			hf5_el_array.append(data)
-			hf5.flush()
-	hf5.close()
-	
+			group_name = '/raw'
+		elif not(emg_bool) and none_bool:
+			array_name = f'emg{channel_ind:02}'
+			group_name = '/raw_emg'
+		else:
+			continue
+		hf5_el_array = create_raw_earray(
+				hf5, group_name, array_name, expected_rows, storage_params)
+		column_arrays.append((num, hf5_el_array))
+	return column_arrays
+
 def read_electrode_emg_channels_single_file(
         hdf5_name, 
         electrode_layout_frame, 
         electrodes_list, 
         num_recorded_samples, 
-        emg_channels):
-    # Read EMG data from amplifier channels
+        emg_channels,
+        block_samples = 600000,
+        storage_params = None):
+	"""
+	Stream amplifier.dat into the /raw and /raw_emg arrays
+
+	amplifier.dat is memory-mapped rather than loaded, and is
+	de-interleaved in blocks of block_samples time samples, so peak
+	memory is set by block_samples and the channel count, not by
+	the length of the recording
+	"""
+	# Read EMG data from amplifier channels
 	hf5 = tables.open_file(hdf5_name, 'r+')
-	atom = tables.IntAtom()
-	amplifier_data = np.fromfile(electrodes_list[0], dtype = np.dtype('int16'))
-	num_electrodes = int(len(amplifier_data)/num_recorded_samples)
-	amp_reshape = np.reshape(amplifier_data,(int(len(amplifier_data)/num_electrodes),num_electrodes)).T
-	for num,row in tqdm.tqdm(electrode_layout_frame.iterrows()):
-        # Loading should use file name 
-        # but writing should use channel ind so that channels from 
-        # multiple boards are written into a monotonic sequence
-		emg_bool = 'emg' not in row.CAR_group.lower()
-		none_bool = row.CAR_group.lower() not in ['none','na']
-		if emg_bool and none_bool:
-			print(f'Reading : {row.filename, row.CAR_group}')
-			port = row.port
-			channel_ind = row.electrode_ind
-            #el = hf5.create_earray('/raw_emg', f'emg{emg_counter:02}', atom, (0,))
-            # Label raw_emg with electrode_ind so it's more easily identifiable
-			el = hf5.create_earray('/raw', f'electrode{channel_ind:02}', atom, (0,))
-			exec(f"hf5.root.raw.electrode{channel_ind:02}.append(amp_reshape[num,:])")
-			hf5.flush()
-		elif not(emg_bool) and none_bool:
-			port = row.port
-			channel_ind = row.electrode_ind
-			el = hf5.create_earray('/raw_emg', f'emg{channel_ind:02}', atom, (0,))
-			exec(f"hf5.root.raw_emg.emg{channel_ind:02}.append(amp_reshape[num,:])")
+	amplifier_data = map_dat_file(
+			electrodes_list[0], 'int16', num_recorded_samples)
+
+	# Create all arrays first and keep track of which column of
+	# amplifier.dat goes to which array
+	column_arrays = create_layout_arrays(
+			hf5, electrode_layout_frame,
+			amplifier_data.shape[0], storage_params)
+
+	block_starts = np.arange(0, amplifier_data.shape[0], block_samples)
+	for block_start in tqdm.tqdm(block_starts):
+		# Transpose so every channel is contiguous in memory
+		this_block = np.ascontiguousarray(
+				amplifier_data[block_start:block_start+block_samples].T)
+		for num, hf5_el_array in column_arrays:
+			hf5_el_array.append(this_block[num])
+		del this_block
+	hf5.flush()
+	hf5.close()
+
+############################################################
+# Traditional Intan .rhd files
+############################################################
+# Signal types of channels in the .rhd header
+rhd_signal_types = [
+		'amplifier', 'aux_input', 'supply_voltage',
+		'board_adc', 'board_dig_in', 'board_dig_out']
+
+def get_rhd_file_list(file_list):
+	"""
+	Traditional Intan data files in a directory, in recording order
+	(info.rhd from .dat exports only holds a header)
+	"""
+	return sorted([x for x in file_list
+				   if x.endswith('.rhd') and x != 'info.rhd'])
+
+def read_qstring(fid):
+	"""
+	Read a length prefixed UTF-16 string from an .rhd header
+	"""
+	length, = struct.unpack('<I', fid.read(4))
+	if length == 0xFFFFFFFF:
+		return ''
+	return fid.read(length).decode('utf-16-le')
+
+def read_rhd_header(filename):
+	"""
+	Parse the header of a traditional Intan .rhd file
+
+	Output:
+		dict with sample_rate, version, num_samples_per_data_block,
+		header_bytes, num_temp_sensor_channels, one list of channel
+		dicts per entry of rhd_signal_types, and num_data_blocks
+	"""
+	with open(filename, 'rb') as fid:
+		magic_number, = struct.unpack('<I', fid.read(4))
+		if magic_number != 0xc6912702:
+			raise Exception(f'{filename} is not an Intan .rhd file')
+		version = struct.unpack('<hh', fid.read(4))
+		header = {'version': version}
+		header['sample_rate'], = struct.unpack('<f', fid.read(4))
+		# DSP, bandwidth, notch filter and impedance test settings
+		fid.read(2 + 6*4 + 2 + 2*4)
+		header['notes'] = [read_qstring(fid) for i in range(3)]
+		header['num_temp_sensor_channels'] = 0
+		if version >= (1, 1):
+			header['num_temp_sensor_channels'], = \
+					struct.unpack('<h', fid.read(2))
+		if version >= (1, 3):
+			fid.read(2)
+		if version >= (2, 0):
+			read_qstring(fid)
+		for signal_type in rhd_signal_types:
+			header[signal_type] = []
+		num_signal_groups, = struct.unpack('<h', fid.read(2))
+		for group_num in range(num_signal_groups):
+			group_name = read_qstring(fid)
+			group_prefix = read_qstring(fid)
+			group_enabled, num_channels, num_amp_channels = \
+					struct.unpack('<hhh', fid.read(6))
+			if not (group_enabled and num_channels > 0):
+				continue
+			for channel_num in range(num_channels):
+				native_channel_name = read_qstring(fid)
+				custom_channel_name = read_qstring(fid)
+				channel_info = struct.unpack('<hhhhhhhhhhff', fid.read(28))
+				native_order, custom_order, signal_type, \
+						channel_enabled, chip_channel, board_stream = \
+						channel_info[:6]
+				if channel_enabled:
+					header[rhd_signal_types[signal_type]].append({
+						'port_prefix': group_prefix,
+						'native_channel_name': native_channel_name,
+						'custom_channel_name': custom_channel_name,
+						'native_order': native_order,
+						'chip_channel': chip_channel,
+						'board_stream': board_stream})
+		header['header_bytes'] = fid.tell()
+	# Data blocks hold 128 samples from version 2 onwards
+	header['num_samples_per_data_block'] = 128 if version[0] > 1 else 60
+	block_bytes = rhd_block_dtype(header).itemsize
+	data_bytes = os.path.getsize(filename) - header['header_bytes']
+	if data_bytes % block_bytes != 0:
+		raise Exception(
+				f'{filename} does not hold a whole number of data blocks')
+	header['num_data_blocks'] = data_bytes // block_bytes
+	return header
+
+def rhd_block_dtype(header):
+	"""
+	numpy dtype of one data block of an .rhd file
+
+	Amplifier and board ADC channels hold num_samples_per_data_block
+	samples per channel per block, aux inputs a quarter of that,
+	supply voltage and temperature sensors one sample, and all
+	digital inputs (and outputs) share one 16 bit word per sample
+	"""
+	num_samples = header['num_samples_per_data_block']
+	timestamp_type = '<i4' if header['version'] >= (1, 2) else '<u4'
+	fields = [
+		('timestamps', timestamp_type, (num_samples,)),
+		('amplifier', '<u2', (len(header['amplifier']), num_samples)),
+		('aux_input', '<u2', (len(header['aux_input']), num_samples//4)),
+		('supply_voltage', '<u2', (len(header['supply_voltage']),)),
+		('temperature', '<i2', (header['num_temp_sensor_channels'],)),
+		('board_adc', '<u2', (len(header['board_adc']), num_samples)),
+		]
+	if len(header['board_dig_in']) > 0:
+		fields.append(('board_dig_in', '<u2', (num_samples,)))
+	if len(header['board_dig_out']) > 0:
+		fields.append(('board_dig_out', '<u2', (num_samples,)))
+	return np.dtype([x for x in fields if np.prod(x[2]) > 0])
+
+def map_rhd_blocks(filename, header = None):
+	"""
+	Memory-map the data blocks of an .rhd file as a structured array
+	with one element per block, see rhd_block_dtype
+	"""
+	if header is None:
+		header = read_rhd_header(filename)
+	return np.memmap(
+			filename, dtype = rhd_block_dtype(header), mode = 'r',
+			offset = header['header_bytes'],
+			shape = (header['num_data_blocks'],))
+
+def count_rhd_samples(rhd_file_list):
+	"""
+	Total number of samples per channel across .rhd files
+	"""
+	total_samples = 0
+	for filename in rhd_file_list:
+		header = read_rhd_header(filename)
+		total_samples += \
+				header['num_data_blocks'] * header['num_samples_per_data_block']
+	return total_samples
+
+def amplifier_to_int16(amplifier_data):
+	"""
+	Convert offset binary amplifier samples (.rhd) to the signed
+	values written to .dat files, i.e. subtract 32768
+	"""
+	return (amplifier_data ^ np.uint16(0x8000)).view(np.int16)
+
+def read_rhd_dig_in_words(rhd_file_list):
+	"""
+	Digital input words of all .rhd files, one uint16 per sample,
+	as they would be written to digitalin.dat
+	"""
+	all_words = []
+	for filename in rhd_file_list:
+		blocks = map_rhd_blocks(filename)
+		if 'board_dig_in' in blocks.dtype.names:
+			all_words.append(np.ravel(blocks['board_dig_in']))
+	if len(all_words) == 0:
+		return np.zeros(0, dtype = np.uint16)
+	return np.concatenate(all_words)
+
+def read_rhd_files(
+		hdf5_name,
+		rhd_file_list,
+		electrode_layout_frame,
+		dig_in,
+		blocks_per_chunk = 5000,
+		storage_params = None):
+	"""
+	Stream traditional Intan .rhd files into the same HDF5 layout
+	used for .dat files
+
+	Data blocks are memory-mapped and decoded blocks_per_chunk at a
+	time, so peak memory does not depend on the length of the
+	recording. Amplifier channels are written according to the
+	electrode layout (row number num is amplifier channel num),
+	and digital inputs are decoded as for digitalin.dat
+
+	Inputs:
+		hdf5_name: str
+		rhd_file_list: list of .rhd files, in recording order
+		electrode_layout_frame: pd.DataFrame, rows to read
+		dig_in: list of digital input numbers to read
+		blocks_per_chunk: int
+		storage_params: dict, see create_raw_earray
+	"""
+	hf5 = tables.open_file(hdf5_name, 'r+')
+	total_samples = count_rhd_samples(rhd_file_list)
+	column_arrays = create_layout_arrays(
+			hf5, electrode_layout_frame, total_samples, storage_params)
+	if len(dig_in) > 0:
+		print('Reading dig-ins')
+	dig_in_arrays = [
+			hf5.create_earray(
+				'/digital_in', f'dig_in_{i}', tables.UInt8Atom(), (0,),
+				expectedrows = total_samples)
+			for i in dig_in]
+	edge_tracker = dig_in_edge_tracker(
+			[f'dig_in_{i}' for i in dig_in], dig_in)
+
+	last_timestamp = None
+	for filename in rhd_file_list:
+		print(f'Reading : {filename}')
+		blocks = map_rhd_blocks(filename)
+		block_starts = np.arange(0, len(blocks), blocks_per_chunk)
+		for block_start in tqdm.tqdm(block_starts):
+			this_chunk = blocks[block_start:block_start+blocks_per_chunk]
+			timestamps = np.ravel(this_chunk['timestamps'])
+			if last_timestamp is not None \
+					and timestamps[0] != last_timestamp + 1:
+				print(f'Warning: timestamps jump from {last_timestamp} '
+					  f'to {timestamps[0]} in {filename}')
+			if np.any(np.diff(timestamps) != 1):
+				print(f'Warning: missing samples in {filename}')
+			last_timestamp = timestamps[-1]
+			if len(column_arrays) > 0:
+				# (blocks, channels, samples) -> (channels, blocks x samples)
+				amplifier_data = amplifier_to_int16(
+						this_chunk['amplifier'].transpose(1, 0, 2).reshape(
+							this_chunk['amplifier'].shape[1], -1))
+				for num, hf5_el_array in column_arrays:
+					hf5_el_array.append(amplifier_data[num])
+				del amplifier_data
+			if len(dig_in) > 0:
+				dig_inputs = decode_dig_in_words(
+						np.ravel(this_chunk['board_dig_in']), dig_in)
+				for hf5_dig_array, this_dig_in in \
+						zip(dig_in_arrays, dig_inputs):
+					hf5_dig_array.append(this_dig_in)
+				edge_tracker.update(dig_inputs)
+		del blocks
+	if len(dig_in) > 0:
+		edge_tracker.write_table(hf5)
+	hf5.flush()
 	hf5.close()
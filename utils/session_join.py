@@ -0,0 +1,221 @@
+"""
+Virtual concatenation of recording sessions
+
+blech_dat_file_join.py --virtual writes a joined_sessions.json file
+(and a copy of info.rhd) into an otherwise empty directory. That
+directory can then be processed like a single session. Reads of a .dat
+file in it go through chained memory maps of the same file in every
+session, in order, so no raw data is copied.
+"""
+
+import os
+import json
+import numpy as np
+import tables
+
+join_file_name = 'joined_sessions.json'
+
+
+class chained_memmap():
+    """
+    Several arrays presented as one array, concatenated along the
+    first (time) axis. Slicing only reads the segments it covers.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.bounds = np.concatenate(
+            [[0], np.cumsum([len(x) for x in segments])]).astype(int)
+        self.shape = (self.bounds[-1],) + segments[0].shape[1:]
+        self.dtype = segments[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        row_key, other_keys = key[0], key[1:]
+        if isinstance(row_key, (int, np.integer)):
+            if row_key < 0:
+                row_key += len(self)
+            segment = np.searchsorted(self.bounds, row_key, side='right') - 1
+            return self.segments[segment][
+                (row_key - self.bounds[segment],) + other_keys]
+        start, stop, step = row_key.indices(len(self))
+        if step < 1:
+            raise Exception('Only positive steps are supported')
+        pieces = []
+        for segment, seg_start, seg_stop in zip(
+                self.segments, self.bounds[:-1], self.bounds[1:]):
+            # First wanted sample in this segment
+            first = start + max(0, -(-(seg_start - start) // step)) * step
+            last = min(stop, seg_stop)
+            if first < last:
+                pieces.append(np.asarray(segment[
+                    (slice(first - seg_start, last - seg_start, step),)
+                    + other_keys]))
+        if len(pieces) == 0:
+            return np.asarray(self.segments[0][(slice(0, 0),) + other_keys])
+        return np.concatenate(pieces)
+
+
+def get_join_info(dir_name):
+    """
+    Contents of the join file in dir_name, or None if it isn't a joined session
+    """
+    join_path = os.path.join(dir_name, join_file_name)
+    if not os.path.exists(join_path):
+        return None
+    with open(join_path, 'r') as join_file:
+        return json.load(join_file)
+
+
+def is_joined(dir_name):
+    return get_join_info(dir_name) is not None
+
+
+def get_segments(filename):
+    """
+    Paths and sample counts of a virtual file in every joined session,
+    or None if filename is an actual file (or not in a joined session)
+    """
+    if os.path.exists(filename):
+        return None
+    join_info = get_join_info(os.path.dirname(os.path.abspath(filename)))
+    if join_info is None:
+        return None
+    paths = [os.path.join(x, os.path.basename(filename))
+             for x in join_info['sessions']]
+    return paths, join_info['num_samples']
+
+
+def map_dat_file(filename, dtype, n_samples=None):
+    """
+    Memory-map a .dat file, chaining the file of every session if
+    it is part of a joined session
+
+    Inputs:
+        filename: str
+        dtype: numpy dtype of the file
+        n_samples: if given, map as (n_samples, channels)
+            (per session sample counts are used for joined sessions)
+
+    Output:
+        np.memmap or chained_memmap
+    """
+    segments = get_segments(filename)
+    if segments is None:
+        data = np.memmap(filename, dtype=np.dtype(dtype), mode='r')
+        if n_samples is not None:
+            data = data.reshape((n_samples, -1))
+        return data
+    segment_maps = []
+    for path, segment_samples in zip(*segments):
+        data = np.memmap(path, dtype=np.dtype(dtype), mode='r')
+        if n_samples is not None:
+            data = data.reshape((segment_samples, -1))
+        segment_maps.append(data)
+    return chained_memmap(segment_maps)
+
+
+def get_file_size(filename):
+    """
+    Size of a file in bytes, summed across sessions if it is virtual
+    """
+    segments = get_segments(filename)
+    if segments is None:
+        return os.path.getsize(filename)
+    return sum([os.path.getsize(x) for x in segments[0]])
+
+
+def list_session_files(dir_name):
+    """
+    Files in dir_name, including the virtual .dat files of a joined session
+    """
+    file_list = os.listdir(dir_name)
+    join_info = get_join_info(dir_name)
+    if join_info is not None:
+        file_list += [x for x in join_info['files'] if x not in file_list]
+    return file_list
+
+
+def count_recorded_samples(dir_name):
+    """
+    Number of samples per channel, from the size of time.dat
+    (float32 timestamps), or from the join file
+    """
+    join_info = get_join_info(dir_name)
+    if join_info is not None:
+        return int(np.sum(join_info['num_samples']))
+    return os.path.getsize(os.path.join(dir_name, 'time.dat')) // 4
+
+
+def write_join_file(output_dir, session_dirs):
+    """
+    Check that sessions can be joined and write the join file
+
+    All sessions must hold the same .dat files, recorded at the
+    same sampling rate with the same number of channels per file
+
+    Inputs:
+        output_dir: str, directory for the joined session
+        session_dirs: list of session directories, in recording order
+    """
+    session_dirs = [os.path.abspath(x) for x in session_dirs]
+    files = sorted([x for x in os.listdir(session_dirs[0])
+                    if x.endswith('.dat')])
+    sampling_rates = [
+        np.fromfile(os.path.join(x, 'info.rhd'), dtype=np.dtype('float32'))[2]
+        for x in session_dirs]
+    if len(np.unique(sampling_rates)) > 1:
+        raise Exception(f'Sampling rates differ : {sampling_rates}')
+    num_samples = [count_recorded_samples(x) for x in session_dirs]
+    for this_file in files:
+        channels = []
+        for this_dir, this_samples in zip(session_dirs, num_samples):
+            this_path = os.path.join(this_dir, this_file)
+            if not os.path.exists(this_path):
+                raise Exception(f'{this_path} not found')
+            channels.append(os.path.getsize(this_path) / this_samples)
+        if len(np.unique(channels)) > 1:
+            raise Exception(f'Channel counts of {this_file} differ across sessions')
+    join_info = {
+        'sessions': session_dirs,
+        'num_samples': [int(x) for x in num_samples],
+        'files': files}
+    with open(os.path.join(output_dir, join_file_name), 'w') as join_file:
+        json.dump(join_info, join_file, indent=4)
+    return join_info
+
+
+class session_segment(tables.IsDescription):
+    """
+    Row of the /session_segments table, one row per joined session
+    """
+    session = tables.StringCol(1024)
+    start = tables.Int64Col()
+    n_samples = tables.Int64Col()
+
+
+def write_segment_table(hf5, dir_name):
+    """
+    Record the sample at which every joined session starts,
+    so times in the joined recording can be traced back to sessions
+    """
+    join_info = get_join_info(dir_name)
+    if '/session_segments' in hf5:
+        hf5.remove_node('/', 'session_segments')
+    table = hf5.create_table(
+        '/', 'session_segments', session_segment,
+        'Sessions making up a joined recording')
+    starts = np.cumsum([0] + join_info['num_samples'][:-1])
+    for session, start, n_samples in zip(
+            join_info['sessions'], starts, join_info['num_samples']):
+        this_row = table.row
+        this_row['session'] = session
+        this_row['start'] = start
+        this_row['n_samples'] = n_samples
+        this_row.append()
+    table.flush()